@@ -1,538 +1,327 @@
-import streamlit as st
-import pandas as pd
-import random
-import time
-from datetime import datetime, timedelta
-import hashlib
-import sqlite3
 import os
-from streamlit.components.v1 import html
 
-# Use a persistent database path for deployment
-def get_db_path():
-    if os.path.exists('chat_app.db'):
-        return 'chat_app.db'
-    else:
-        return '/tmp/chat_app.db'  # Use tmp directory for deployment
+import streamlit as st
 
-# Initialize session state
-if 'logged_in' not in st.session_state:
-    st.session_state.logged_in = False
-if 'current_user' not in st.session_state:
-    st.session_state.current_user = None
-if 'chat_partner' not in st.session_state:
-    st.session_state.chat_partner = None
-if 'chat_messages' not in st.session_state:
-    st.session_state.chat_messages = []
-if 'waiting_for_match' not in st.session_state:
-    st.session_state.waiting_for_match = False
-if 'in_chat' not in st.session_state:
-    st.session_state.in_chat = False
-if 'db_initialized' not in st.session_state:
-    st.session_state.db_initialized = False
-if 'session_id' not in st.session_state:
-    st.session_state.session_id = None
-if 'last_message_check' not in st.session_state:
-    st.session_state.last_message_check = datetime.now()
-if 'active_sessions' not in st.session_state:
-    st.session_state.active_sessions = {}
+from chat_state import (
+    enter_chat,
+    fetch_new_messages,
+    flush_outbox,
+    init_session_state,
+    leave_chat,
+    load_earlier_messages,
+    send_chat_message,
+)
+from database import (
+    register_user,
+    authenticate_user,
+    set_user_offline,
+    is_session_active,
+    end_chat_session,
+)
+from interests import INTERESTS
+from login_tokens import issue_token, remember_chat, resolve_token, revoke_token
+from metrics import increment, phase, registry
+from search import search
+from services import start_services
+from styles import APP_CSS
 
-# Database setup
-def init_db():
-    if st.session_state.db_initialized:
-        return
-        
-    db_path = get_db_path()
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    
-    # Users table with online status
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  username TEXT UNIQUE,
-                  password TEXT,
-                  gender TEXT,
-                  preference TEXT,
-                  interests TEXT,
-                  online BOOLEAN DEFAULT FALSE,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    # Chat sessions table
-    c.execute('''CREATE TABLE IF NOT EXISTS chat_sessions
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user1_id INTEGER,
-                  user2_id INTEGER,
-                  start_time TIMESTAMP,
-                  end_time TIMESTAMP,
-                  active BOOLEAN DEFAULT TRUE)''')
-    
-    # Messages table
-    c.execute('''CREATE TABLE IF NOT EXISTS messages
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  session_id INTEGER,
-                  sender_id INTEGER,
-                  message TEXT,
-                  timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  read BOOLEAN DEFAULT FALSE)''')
-    
-    # Active sessions table for matching
-    c.execute('''CREATE TABLE IF NOT EXISTS active_sessions
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  session_key TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    # Add online status column if it doesn't exist
-    try:
-        c.execute("ALTER TABLE users ADD COLUMN online BOOLEAN DEFAULT FALSE")
-    except sqlite3.OperationalError:
-        pass  # Column already exists
-    
-    # Add active column to chat_sessions if it doesn't exist
-    try:
-        c.execute("ALTER TABLE chat_sessions ADD COLUMN active BOOLEAN DEFAULT TRUE")
-    except sqlite3.OperationalError:
-        pass  # Column already exists
-    
-    # Add read column to messages if it doesn't exist
-    try:
-        c.execute("ALTER TABLE messages ADD COLUMN read BOOLEAN DEFAULT FALSE")
-    except sqlite3.OperationalError:
-        pass  # Column already exists
-    
-    conn.commit()
-    conn.close()
-    st.session_state.db_initialized = True
+# Initialize session state
+init_session_state()
 
-# Password hashing
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+# Ids of existing accounts allowed to see the dashboard and metrics views and
+# to search every chat (comma separated). Ids, not usernames: anyone can
+# register a free username, but ids are handed out once and never reused.
+ADMIN_USER_IDS = {int(user_id) for user_id in os.environ.get('CHAT_APP_ADMIN_IDS', '').split(',') if user_id.strip()}
 
-# User registration
-def register_user(username, password, gender, preference, interests):
-    db_path = get_db_path()
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    
-    hashed_password = hash_password(password)
-    interests_str = ','.join(interests)
-    
-    try:
-        c.execute("INSERT INTO users (username, password, gender, preference, interests, online) VALUES (?, ?, ?, ?, ?, ?)",
-                  (username, hashed_password, gender, preference, interests_str, False))
-        conn.commit()
-        conn.close()
-        return True
-    except sqlite3.IntegrityError:
-        conn.close()
-        return False
+# Whether a logged-in user has admin rights
+def is_admin(user):
+    return user['id'] in ADMIN_USER_IDS
 
-# User authentication
-def authenticate_user(username, password):
-    db_path = get_db_path()
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    
-    hashed_password = hash_password(password)
-    
-    c.execute("SELECT id, username, gender, preference, interests FROM users WHERE username = ? AND password = ?",
-              (username, hashed_password))
-    user = c.fetchone()
-    
-    # Mark user as online
-    if user:
-        c.execute("UPDATE users SET online = TRUE WHERE username = ?", (username,))
-        conn.commit()
-    
-    conn.close()
-    
-    if user:
-        return {
-            'id': user[0],
-            'username': user[1],
-            'gender': user[2],
-            'preference': user[3],
-            'interests': user[4].split(',') if user[4] else []
-        }
-    return None
+increment('reruns')
 
-# Mark user as offline
-def set_user_offline(user_id):
-    db_path = get_db_path()
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    
-    c.execute("UPDATE users SET online = FALSE WHERE id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+# Database, matchmaking and presence are set up once per server process
+matchmaker, presence = start_services()
 
-# Find a matching partner from REAL users in the database
-def find_match(current_user):
-    db_path = get_db_path()
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    
-    # Get user's preference and gender
-    user_pref = current_user['preference']
-    user_gender = current_user['gender']
-    user_interests = current_user['interests']
-    
-    # Define target gender based on preference
-    if user_pref == 'Straight':
-        if user_gender == 'Male':
-            target_gender = 'Female'
-        else:
-            target_gender = 'Male'
-    elif user_pref == 'Gay':
-        target_gender = 'Male'
-    elif user_pref == 'Lesbian':
-        target_gender = 'Female'
-    else:  # Bisexual
-        target_gender = None  # No gender restriction
-    
-    # Build query based on preference
-    if target_gender:
-        query = """
-            SELECT id, username, gender, preference, interests 
-            FROM users 
-            WHERE id != ? 
-            AND gender = ?
-            AND online = TRUE
-            AND (preference = ? OR preference = 'Bisexual')
-        """
-        params = (current_user['id'], target_gender, user_pref)
+# Resume a session from the login token in the URL (after a reload or a lost
+# websocket) without a password check
+if not st.session_state.logged_in and 'token' in st.query_params:
+    restored = resolve_token(st.query_params['token'])
+    if restored:
+        st.session_state.logged_in = True
+        st.session_state.current_user = restored['user']
+        st.session_state.login_token = st.query_params['token']
+        if restored['chat']:
+            enter_chat(restored['chat']['session_id'], restored['chat']['partner'])
     else:
-        # For bisexual users, match with anyone who would also match with them
-        query = """
-            SELECT id, username, gender, preference, interests 
-            FROM users 
-            WHERE id != ? 
-            AND online = TRUE
-            AND (
-                (gender = 'Male' AND (preference = 'Bisexual' OR preference = 'Gay' OR preference = 'Straight' AND gender = 'Female')) OR
-                (gender = 'Female' AND (preference = 'Bisexual' OR preference = 'Lesbian' OR preference = 'Straight' AND gender = 'Male'))
-            )
-        """
-        params = (current_user['id'],)
-    
-    c.execute(query, params)
-    potential_matches = c.fetchall()
-    
-    # Convert to list of dictionaries and calculate common interests
-    matches = []
-    for match in potential_matches:
-        match_interests = match[4].split(',') if match[4] else []
-        common_interests = set(user_interests).intersection(set(match_interests))
-        
-        matches.append({
-            'id': match[0],
-            'username': match[1],
-            'gender': match[2],
-            'preference': match[3],
-            'common_interests': list(common_interests)
-        })
-    
-    # Sort by number of common interests (most first)
-    matches.sort(key=lambda x: len(x['common_interests']), reverse=True)
-    
-    conn.close()
-    
-    # Return the best match if available
-    return matches[0] if matches else None
+        del st.query_params['token']
 
-# Start a chat session
-def start_chat_session(user1_id, user2_id):
-    db_path = get_db_path()
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    
-    c.execute("INSERT INTO chat_sessions (user1_id, user2_id, start_time) VALUES (?, ?, ?)",
-              (user1_id, user2_id, datetime.now()))
-    session_id = c.lastrowid
-    
-    conn.commit()
-    conn.close()
-    
-    return session_id
+# App layout
+st.set_page_config(page_title="Anonymous Chat", page_icon="💬", layout="wide")
 
-# Send a message
-def send_message(session_id, sender_id, message):
-    db_path = get_db_path()
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    
-    c.execute("INSERT INTO messages (session_id, sender_id, message) VALUES (?, ?, ?)",
-              (session_id, sender_id, message))
-    
-    conn.commit()
-    conn.close()
+# Custom CSS
+st.markdown(APP_CSS, unsafe_allow_html=True)
 
-# Get new messages for a session
-def get_new_messages(session_id, last_check_time):
-    db_path = get_db_path()
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    
-    c.execute("""
-        SELECT sender_id, message, timestamp 
-        FROM messages 
-        WHERE session_id = ? 
-        AND timestamp > ?
-        ORDER BY timestamp ASC
-    """, (session_id, last_check_time))
-    
-    messages = c.fetchall()
-    conn.close()
+# Seconds between live updates of the waiting and chat screens.
+# Only the fragments below rerun on this timer; login, registration and the
+# idle home page do not poll at all.
+LIVE_UPDATE_INTERVAL = 1
+
+# Waiting screen: re-check the matchmaking ticket without rerunning the page
+@st.fragment(run_every=LIVE_UPDATE_INTERVAL)
+def live_match_status():
+    presence.heartbeat(st.session_state.current_user)
+    ticket = matchmaker.poll(st.session_state.current_user['id'])
+    if ticket is None or ticket.matched:
+        st.rerun()
     
-    return messages
+    st.info("Looking for a matching partner...")
+    st.write("You'll be connected as soon as someone compatible is looking too.")
 
-# Get all messages for a session
-def get_all_messages(session_id):
-    db_path = get_db_path()
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
+# Chat messages: only this container reruns on the timer
+@st.fragment(run_every=LIVE_UPDATE_INTERVAL)
+def live_chat():
+    presence.heartbeat(st.session_state.current_user)
     
-    c.execute("""
-        SELECT sender_id, message, timestamp 
-        FROM messages 
-        WHERE session_id = ? 
-        ORDER BY timestamp ASC
-    """, (session_id,))
+    # Partner left: rerun the whole page to show the notice
+    if not is_session_active(st.session_state.session_id):
+        st.rerun()
     
-    messages = c.fetchall()
-    conn.close()
+    # Messages held back by the rate limit go out as it allows
+    flush_outbox()
+    fetch_new_messages()
     
-    return messages
+    with phase('render'):
+        if not st.session_state.history_complete:
+            if st.button("Load earlier messages"):
+                load_earlier_messages()
+        
+        chat_container = st.container(height=400)
+        
+        # One pre-rendered HTML block for the whole window
+        with chat_container:
+            window = st.session_state.chat_messages[-st.session_state.chat_window:]
+            st.markdown(''.join(msg['html'] for msg in window), unsafe_allow_html=True)
+        
+        if st.session_state.outbox:
+            st.caption(f"{len(st.session_state.outbox)} message(s) waiting to send...")
 
-# Check if session is still active
-def is_session_active(session_id):
-    db_path = get_db_path()
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
+# Admin-only view of the metrics registry
+def render_metrics():
+    st.title("Metrics")
     
-    c.execute("SELECT active FROM chat_sessions WHERE id = ?", (session_id,))
-    result = c.fetchone()
+    gauges = registry.gauges()
+    for col, (name, value) in zip(st.columns(len(gauges) or 1), gauges.items()):
+        col.metric(name.replace('_', ' ').capitalize(), value)
+    st.write(f"Script reruns: {registry.counters().get('reruns', 0)}")
     
-    conn.close()
+    st.dataframe(registry.summary())
     
-    return result[0] if result else False
+    prometheus_text = registry.export_prometheus()
+    st.download_button("Download Prometheus metrics", prometheus_text, file_name="metrics.prom", mime="text/plain")
+    with st.expander("Prometheus text"):
+        st.code(prometheus_text)
+
+# Admin-only activity dashboard, read from the rollup tables
+def render_dashboard():
+    # pandas is only loaded once an admin opens the dashboard
+    from dashboard import DASHBOARD_MINUTES, activity_frame, interest_frame, session_length_frame
+    
+    st.title("Dashboard")
+    
+    activity = activity_frame()
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Online users", presence.alive_count())
+    col2.metric("Waiting for a match", matchmaker.waiting_count())
+    col3.metric("Matches last minute", int(activity['matches'].iloc[-1]))
+    
+    st.subheader(f"Matches per minute (last {DASHBOARD_MINUTES} min, UTC)")
+    st.line_chart(activity[['matches', 'ended']])
+    st.subheader("Messages per minute")
+    st.bar_chart(activity['messages'])
+    
+    st.subheader("Session length")
+    st.bar_chart(session_length_frame())
+    
+    st.subheader("Messages per session by shared interest")
+    interests = interest_frame()
+    st.bar_chart(interests['messages_per_session'])
+    st.dataframe(interests)
 
-# End a chat session
-def end_chat_session(session_id):
-    db_path = get_db_path()
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
+# Search the user's past chats (admins search every chat)
+def render_search():
+    st.subheader("Search your chats")
+    query = st.text_input("Search messages", key="search_query", placeholder="Search messages",
+                          label_visibility="collapsed",
+                          on_change=lambda: st.session_state.update(search_page=0))
+    if not query:
+        return
     
-    c.execute("UPDATE chat_sessions SET active = FALSE, end_time = ? WHERE id = ?",
-              (datetime.now(), session_id))
+    user = st.session_state.current_user
+    moderator = is_admin(user)
+    with phase('search'):
+        results, has_more = search(query, None if moderator else user['id'], st.session_state.search_page)
     
-    conn.commit()
-    conn.close()
-
-# Initialize database
-init_db()
-
-# App layout
-st.set_page_config(page_title="Anonymous Chat", page_icon="💬", layout="wide")
-
-# Custom CSS
-st.markdown("""
-    <style>
-    .main {
-        background-color: #f8f9fa;
-    }
-    .stButton>button {
-        width: 100%;
-        background-color: #4CAF50;
-        color: white;
-    }
-    .chat-container {
-        background-color: #f0f2f6;
-        border-radius: 10px;
-        padding: 20px;
-        height: 500px;
-        overflow-y: scroll;
-    }
-    .message {
-        padding: 10px;
-        border-radius: 10px;
-        margin-bottom: 10px;
-    }
-    .user-message {
-        background-color: #dcf8c6;
-        margin-left: 20%;
-    }
-    .partner-message {
-        background-color: #ffffff;
-        margin-right: 20%;
-    }
-    .waiting {
-        text-align: center;
-        padding: 40px;
-    }
-    /* Auto-refresh styling */
-    .stAlert {
-        padding: 10px;
-        border-radius: 5px;
-        margin-bottom: 10px;
-    }
-    </style>
-    """, unsafe_allow_html=True)
+    if not results:
+        st.write("No messages found.")
+        return
+    for result in results:
+        if moderator:
+            sender = f"User {result['sender_id']}"
+        else:
+            sender = "You" if result['sender_id'] == user['id'] else "Partner"
+        st.markdown(f"<small>{sender} · chat {result['session_id']} · {result['timestamp']}</small><br>"
+                    f"{result['snippet_html']}", unsafe_allow_html=True)
+    
+    col1, col2 = st.columns(2)
+    if st.session_state.search_page > 0 and col1.button("Previous results"):
+        st.session_state.search_page -= 1
+        st.rerun()
+    if has_more and col2.button("More results"):
+        st.session_state.search_page += 1
+        st.rerun()
 
 # Main app logic
 if not st.session_state.logged_in:
-    # Login/Registration page
-    tab1, tab2 = st.tabs(["Login", "Register"])
-    
-    with tab1:
-        st.header("Login to Anonymous Chat")
-        login_username = st.text_input("Username", key="login_username")
-        login_password = st.text_input("Password", type="password", key="login_password")
+    with phase('auth'):
+        # Login/Registration page
+        tab1, tab2 = st.tabs(["Login", "Register"])
         
-        if st.button("Login"):
-            user = authenticate_user(login_username, login_password)
-            if user:
-                st.session_state.logged_in = True
-                st.session_state.current_user = user
-                st.success("Logged in successfully!")
-                st.rerun()
-            else:
-                st.error("Invalid username or password")
-    
-    with tab2:
-        st.header("Create a New Account")
-        reg_username = st.text_input("Choose a Username", key="reg_username")
-        reg_password = st.text_input("Choose a Password", type="password", key="reg_password")
-        reg_gender = st.selectbox("Gender", ["Male", "Female", "Other"], key="reg_gender")
-        reg_preference = st.selectbox("Preference", ["Straight", "Gay", "Lesbian", "Bisexual"], key="reg_preference")
-        reg_interests = st.multiselect("Interests", 
-                                      ["Music", "Sports", "Movies", "Books", "Travel", "Food", "Art", "Technology", "Gaming", "Fitness"],
-                                      key="reg_interests")
+        with tab1:
+            st.header("Login to Anonymous Chat")
+            login_username = st.text_input("Username", key="login_username")
+            login_password = st.text_input("Password", type="password", key="login_password")
+            
+            if st.button("Login"):
+                user = authenticate_user(login_username, login_password)
+                if user:
+                    st.session_state.logged_in = True
+                    st.session_state.current_user = user
+                    st.session_state.login_token = issue_token(user)
+                    st.query_params['token'] = st.session_state.login_token
+                    st.success("Logged in successfully!")
+                    st.rerun()
+                else:
+                    st.error("Invalid username or password")
         
-        if st.button("Register"):
-            if reg_username and reg_password and reg_interests:
-                if register_user(reg_username, reg_password, reg_gender, reg_preference, reg_interests):
-                    st.success("Account created successfully! Please login.")
+        with tab2:
+            st.header("Create a New Account")
+            reg_username = st.text_input("Choose a Username", key="reg_username")
+            reg_password = st.text_input("Choose a Password", type="password", key="reg_password")
+            reg_gender = st.selectbox("Gender", ["Male", "Female", "Other"], key="reg_gender")
+            reg_preference = st.selectbox("Preference", ["Straight", "Gay", "Lesbian", "Bisexual"], key="reg_preference")
+            reg_interests = st.multiselect("Interests", 
+                                          INTERESTS,
+                                          key="reg_interests")
+            
+            if st.button("Register"):
+                if reg_username and reg_password and reg_interests:
+                    if register_user(reg_username, reg_password, reg_gender, reg_preference, reg_interests):
+                        st.success("Account created successfully! Please login.")
+                    else:
+                        st.error("Username already exists. Please choose another.")
                 else:
-                    st.error("Username already exists. Please choose another.")
-            else:
-                st.error("Please fill all fields")
+                    st.error("Please fill all fields")
 
 else:
-    # User is logged in
+    # User is logged in; every rerun counts as a presence heartbeat
+    presence.heartbeat(st.session_state.current_user)
+    
     st.sidebar.title(f"Welcome, {st.session_state.current_user['username']}!")
     st.sidebar.write(f"Gender: {st.session_state.current_user['gender']}")
     st.sidebar.write(f"Preference: {st.session_state.current_user['preference']}")
     st.sidebar.write(f"Interests: {', '.join(st.session_state.current_user['interests'])}")
     
+    if is_admin(st.session_state.current_user):
+        if st.sidebar.toggle("Show dashboard", key="show_dashboard"):
+            render_dashboard()
+            st.stop()
+        if st.sidebar.toggle("Show metrics", key="show_metrics"):
+            render_metrics()
+            st.stop()
+    
     if st.sidebar.button("Logout"):
         # Mark user as offline
         set_user_offline(st.session_state.current_user['id'])
         
+        # Leave the matchmaking pool if still waiting
+        matchmaker.cancel(st.session_state.current_user['id'])
+        presence.leave(st.session_state.current_user['id'])
+        
         # End active chat session if exists
         if st.session_state.session_id:
             end_chat_session(st.session_state.session_id)
         
+        # Forget the login token so the URL no longer resumes this session
+        revoke_token(st.session_state.login_token)
+        st.session_state.login_token = None
+        st.query_params.clear()
+        
         st.session_state.logged_in = False
         st.session_state.current_user = None
-        st.session_state.chat_partner = None
-        st.session_state.chat_messages = []
         st.session_state.waiting_for_match = False
-        st.session_state.in_chat = False
-        st.session_state.session_id = None
+        leave_chat()
         st.rerun()
     
     if not st.session_state.in_chat:
         # Main page - not in chat
         st.title("Anonymous Chat Platform")
-        st.write("Click the button below to find someone to chat with based on your preferences and interests.")
         
-        if st.button("Find a Chat Partner"):
-            st.session_state.waiting_for_match = True
-            st.rerun()
+        if st.session_state.chat_notice:
+            st.error(st.session_state.chat_notice)
+            st.session_state.chat_notice = None
+        st.write("Click the button below to find someone to chat with based on your preferences and interests.")
         
-        if st.session_state.waiting_for_match:
-            st.info("Looking for a matching partner...")
-            
-            # Find a real match from the database
-            with st.spinner("Searching for someone with similar interests..."):
-                # Try to find a match multiple times with delay
-                max_attempts = 10
-                for attempt in range(max_attempts):
-                    partner = find_match(st.session_state.current_user)
-                    if partner:
-                        break
-                    time.sleep(1)  # Wait 1 second between attempts
+        with phase('matchmaking'):
+            if st.session_state.waiting_for_match:
+                ticket = matchmaker.poll(st.session_state.current_user['id'])
                 
-                if partner:
-                    st.session_state.chat_partner = partner
+                if ticket is not None and ticket.matched:
                     st.session_state.waiting_for_match = False
-                    st.session_state.in_chat = True
-                    st.session_state.chat_messages = []
-                    
-                    # Start a chat session
-                    st.session_state.session_id = start_chat_session(
-                        st.session_state.current_user['id'],
-                        partner['id']
-                    )
-                    
+                    enter_chat(ticket.session_id, ticket.partner)
+                    remember_chat(st.session_state.login_token, ticket.session_id, ticket.partner)
+                    matchmaker.acknowledge(st.session_state.current_user['id'])
                     st.rerun()
-                else:
-                    st.error("No suitable matches found. Please try again later.")
+                elif ticket is None:
+                    # Ticket was dropped (e.g. cancelled from another tab)
                     st.session_state.waiting_for_match = False
                     st.rerun()
+                else:
+                    # Still in the waiting pool; the status fragment re-checks the ticket
+                    live_match_status()
+                
+                    if st.button("Cancel Search"):
+                        matchmaker.cancel(st.session_state.current_user['id'])
+                        st.session_state.waiting_for_match = False
+                        st.rerun()
+            elif st.button("Find a Chat Partner"):
+                matchmaker.request_match(st.session_state.current_user)
+                st.session_state.waiting_for_match = True
+                st.rerun()
+        
+        render_search()
     
     else:
         # Chat interface
         st.title("Anonymous Chat")
         
+        # Check if partner is still connected
+        if not is_session_active(st.session_state.session_id):
+            # Shown once on the home page instead of holding this thread
+            st.session_state.chat_notice = "Your chat partner has left the conversation."
+            remember_chat(st.session_state.login_token)
+            leave_chat()
+            st.rerun()
+        
         if st.session_state.chat_partner:
             partner = st.session_state.chat_partner
             st.subheader(f"Chat with: Anonymous ({partner['gender']}, {partner['preference']})")
             st.write(f"Common interests: {', '.join(partner['common_interests'])}")
         
-        # Check for new messages periodically
-        current_time = datetime.now()
-        if (current_time - st.session_state.last_message_check).seconds > 2:  # Check every 2 seconds
-            # Get new messages from the database
-            new_messages = get_new_messages(
-                st.session_state.session_id, 
-                st.session_state.last_message_check
-            )
-            
-            # Add new messages to the chat
-            for msg in new_messages:
-                sender_id, message_text, timestamp = msg
-                if sender_id == st.session_state.current_user['id']:
-                    sender = 'You'
-                else:
-                    sender = 'Partner'
-                
-                # Add message to chat if not already present
-                message_exists = any(m['text'] == message_text and m['sender'] == sender for m in st.session_state.chat_messages)
-                if not message_exists:
-                    st.session_state.chat_messages.append({
-                        'sender': sender,
-                        'text': message_text,
-                        'timestamp': timestamp
-                    })
-            
-            st.session_state.last_message_check = current_time
-        
         # Display auto-refresh notice
-        st.info("💬 Chat is auto-refreshing every few seconds...")
-        
-        # Chat container
-        chat_container = st.container(height=400)
+        st.info("💬 New messages appear automatically.")
         
-        with chat_container:
-            for msg in st.session_state.chat_messages:
-                if msg['sender'] == 'You':
-                    st.markdown(f"<div class='message user-message'><b>You:</b> {msg['text']}</div>", 
-                               unsafe_allow_html=True)
-                else:
-                    st.markdown(f"<div class='message partner-message'><b>Partner:</b> {msg['text']}</div>", 
-                               unsafe_allow_html=True)
+        # Chat container (refreshes itself while the rest of the page stays put)
+        live_chat()
         
         # Message input
         col1, col2 = st.columns([6, 1])
@@ -542,35 +331,17 @@ else:
             send_btn = st.button("Send")
         
         if send_btn and new_message:
-            # Add user message to local state
-            st.session_state.chat_messages.append({
-                'sender': 'You',
-                'text': new_message,
-                'timestamp': datetime.now()
-            })
-            
-            # Save message to database
-            send_message(
-                st.session_state.session_id,
-                st.session_state.current_user['id'],
-                new_message
-            )
-            
-            # Update last check time
-            st.session_state.last_message_check = datetime.now()
+            # Publish to the message bus (persisted in the background) unless
+            # over the send rate; the rerun below fetches it back through the
+            # cursor like any other
+            st.session_state.send_notice = send_chat_message(new_message)
             
             # Clear input field
             st.rerun()
         
-        # Check if partner is still connected
-        if not is_session_active(st.session_state.session_id):
-            st.error("Your chat partner has left the conversation.")
-            time.sleep(2)
-            st.session_state.chat_partner = None
-            st.session_state.chat_messages = []
-            st.session_state.in_chat = False
-            st.session_state.session_id = None
-            st.rerun()
+        if st.session_state.send_notice:
+            st.warning(st.session_state.send_notice)
+            st.session_state.send_notice = None
         
         if st.button("End Chat"):
             # Mark user as offline
@@ -578,22 +349,7 @@ else:
             
             # End the chat session
             end_chat_session(st.session_state.session_id)
+            remember_chat(st.session_state.login_token)
             
-            st.session_state.chat_partner = None
-            st.session_state.chat_messages = []
-            st.session_state.in_chat = False
-            st.session_state.session_id = None
+            leave_chat()
             st.rerun()
-
-# Add auto-refresh JavaScript
-auto_refresh = """
-<script>
-function refreshPage() {
-    setTimeout(function() {
-        window.location.reload();
-    }, 3000); // Refresh every 3 seconds
-}
-window.onload = refreshPage;
-</script>
-"""
-html(auto_refresh)
@@ -0,0 +1,253 @@
+"""Move ended chat sessions out of the live tables into a compressed archive.
+
+Sessions that ended more than CHAT_APP_ARCHIVE_AFTER minutes ago are copied,
+in batches, into an archive database file next to the main one (one row per
+session, its messages stored as zlib-compressed JSON) and then deleted from
+chat_sessions and messages. Archived messages are also full-text indexed, so
+search.py still finds them. Archived sessions older than
+CHAT_APP_RETENTION_DAYS are purged, and so are expired login tokens. The app
+runs this in a background thread; it can also be run by hand:
+
+    python archive.py --older-than 60 --retention-days 365
+"""
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from database import (
+    BUSY_TIMEOUT_MS,
+    delete_chat_sessions,
+    get_db_path,
+    get_ended_sessions,
+    get_session_messages,
+    purge_login_tokens,
+)
+from metrics import increment, timed
+
+logger = logging.getLogger(__name__)
+
+# Minutes after a session ends before it is archived
+ARCHIVE_AFTER = float(os.environ.get('CHAT_APP_ARCHIVE_AFTER', '60'))
+# Days an archived session is kept (0 keeps them forever)
+RETENTION_DAYS = float(os.environ.get('CHAT_APP_RETENTION_DAYS', '365'))
+# Sessions moved per transaction
+ARCHIVE_BATCH = 500
+# Seconds between archival runs
+ARCHIVE_INTERVAL = 60
+
+# Archive file: CHAT_APP_ARCHIVE_DB, or <main db name>_archive.db beside it
+def get_archive_path():
+    if os.environ.get('CHAT_APP_ARCHIVE_DB'):
+        return os.environ['CHAT_APP_ARCHIVE_DB']
+    root, ext = os.path.splitext(get_db_path())
+    return f'{root}_archive{ext or ".db"}'
+
+@contextmanager
+def archive_connection():
+    conn = sqlite3.connect(get_archive_path(), timeout=BUSY_TIMEOUT_MS / 1000)
+    try:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute('''CREATE TABLE IF NOT EXISTS archived_sessions
+                        (session_id INTEGER PRIMARY KEY,
+                         user1_id INTEGER,
+                         user2_id INTEGER,
+                         start_time TIMESTAMP,
+                         end_time TIMESTAMP,
+                         message_count INTEGER,
+                         messages BLOB)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_archived_sessions_end_time ON archived_sessions (end_time)")
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'archived_messages_fts'").fetchone():
+            _create_archive_search(conn)
+        yield conn
+    finally:
+        conn.close()
+
+# Search index of the archive: archived messages are also kept uncompressed
+# in archived_messages, indexed by archived_messages_fts (kept in step by
+# triggers), so archived chats stay searchable. Archives made before the
+# index existed are indexed from their compressed copies.
+def _create_archive_search(conn):
+    with conn:
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_archived_sessions_user1 ON archived_sessions (user1_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_archived_sessions_user2 ON archived_sessions (user2_id)")
+        conn.execute('''CREATE TABLE IF NOT EXISTS archived_messages
+                        (id INTEGER PRIMARY KEY,
+                         session_id INTEGER NOT NULL,
+                         sender_id INTEGER,
+                         message TEXT,
+                         timestamp TIMESTAMP)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_archived_messages_session_id ON archived_messages (session_id, id)")
+        conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS archived_messages_fts USING fts5
+                        (message, content = 'archived_messages', content_rowid = 'id')''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS archived_messages_fts_insert AFTER INSERT ON archived_messages BEGIN
+                            INSERT INTO archived_messages_fts (rowid, message) VALUES (new.id, new.message);
+                        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS archived_messages_fts_delete AFTER DELETE ON archived_messages BEGIN
+                            INSERT INTO archived_messages_fts (archived_messages_fts, rowid, message)
+                            VALUES ('delete', old.id, old.message);
+                        END''')
+        for session_id, messages in conn.execute("SELECT session_id, messages FROM archived_sessions").fetchall():
+            conn.executemany("INSERT OR IGNORE INTO archived_messages (id, session_id, sender_id, message, timestamp) "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             [(message_id, session_id, *message) for message_id, *message in _decompress(messages)])
+
+def _compress(messages):
+    return zlib.compress(json.dumps(messages, separators=(',', ':')).encode())
+
+def _decompress(blob):
+    return json.loads(zlib.decompress(blob))
+
+# Archive sessions that ended more than `older_than` minutes ago.
+# Each batch is committed to the archive before it is deleted from the live
+# tables, and re-archiving a session replaces its row, so an interrupted run
+# is simply picked up by the next one. Returns (sessions, messages) moved.
+@timed(family='archive')
+def archive_ended_sessions(older_than=ARCHIVE_AFTER, batch_size=ARCHIVE_BATCH):
+    cutoff = datetime.now() - timedelta(minutes=older_than)
+    moved_sessions = moved_messages = 0
+    with archive_connection() as archive:
+        while True:
+            sessions = get_ended_sessions(cutoff, batch_size)
+            if not sessions:
+                break
+            session_ids = [s[0] for s in sessions]
+            rows = get_session_messages(session_ids)
+            messages = {}
+            for session_id, *message in rows:
+                messages.setdefault(session_id, []).append(message)
+
+            with archive:
+                archive.execute("DELETE FROM archived_messages WHERE session_id IN (SELECT value FROM json_each(?))",
+                                (json.dumps(session_ids),))
+                archive.executemany("INSERT INTO archived_messages (session_id, id, sender_id, message, timestamp) "
+                                    "VALUES (?, ?, ?, ?, ?)", rows)
+                archive.executemany("""
+                    INSERT OR REPLACE INTO archived_sessions
+                    (session_id, user1_id, user2_id, start_time, end_time, message_count, messages)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, [(session_id, user1_id, user2_id, start_time, end_time,
+                       len(messages.get(session_id, [])), _compress(messages.get(session_id, [])))
+                      for session_id, user1_id, user2_id, start_time, end_time in sessions])
+            moved_messages += delete_chat_sessions(session_ids)
+            moved_sessions += len(sessions)
+            if len(sessions) < batch_size:
+                break
+
+    increment('archived_sessions', moved_sessions)
+    increment('archived_messages', moved_messages)
+    return moved_sessions, moved_messages
+
+# Delete archived sessions that ended more than `retention_days` ago
+@timed(family='archive')
+def purge_archive(retention_days=RETENTION_DAYS):
+    if not retention_days:
+        return 0
+    cutoff = datetime.now() - timedelta(days=retention_days)
+    with archive_connection() as archive:
+        with archive:
+            archive.execute("DELETE FROM archived_messages WHERE session_id IN "
+                            "(SELECT session_id FROM archived_sessions WHERE end_time < ?)", (cutoff.isoformat(' '),))
+            purged = archive.execute("DELETE FROM archived_sessions WHERE end_time < ?",
+                                     (cutoff.isoformat(' '),)).rowcount
+    increment('purged_sessions', purged)
+    return purged
+
+# Messages of an archived session as (id, sender_id, message, timestamp)
+# tuples, or None if the session is not in the archive
+def get_archived_messages(session_id):
+    with archive_connection() as archive:
+        row = archive.execute("SELECT messages FROM archived_sessions WHERE session_id = ?",
+                              (session_id,)).fetchone()
+    if row is None:
+        return None
+    return [tuple(message) for message in _decompress(row[0])]
+
+# Full-text search over every archived message, like
+# database.search_messages: the best `limit` matches as (id, session_id,
+# sender_id, timestamp, snippet, rank) rows
+@timed(family='archive')
+def search_archived_messages(match_query, limit):
+    with archive_connection() as archive:
+        return archive.execute("""
+            SELECT m.id, m.session_id, m.sender_id, m.timestamp,
+                   snippet(archived_messages_fts, 0, char(2), char(3), '…', 12),
+                   bm25(archived_messages_fts) AS rank
+            FROM archived_messages_fts
+            JOIN archived_messages m ON m.id = archived_messages_fts.rowid
+            WHERE archived_messages_fts MATCH ?
+            ORDER BY rank, m.id DESC
+            LIMIT ?
+        """, (match_query, limit)).fetchall()
+
+# Archived messages of a user's chat sessions, like
+# database.get_session_messages: (session_id, id, sender_id, message,
+# timestamp) rows ordered by session then id
+@timed(family='archive')
+def get_archived_user_messages(user_id):
+    with archive_connection() as archive:
+        return archive.execute("""
+            SELECT session_id, id, sender_id, message, timestamp
+            FROM archived_messages
+            WHERE session_id IN (SELECT session_id FROM archived_sessions WHERE user1_id = ?
+                                 UNION
+                                 SELECT session_id FROM archived_sessions WHERE user2_id = ?)
+            ORDER BY session_id, id
+        """, (user_id, user_id)).fetchall()
+
+# Delete expired login tokens (nothing else ever removes them)
+@timed(family='archive')
+def purge_expired_tokens():
+    purged = purge_login_tokens(int(time.time()))
+    increment('purged_login_tokens', purged)
+    return purged
+
+def _archive_loop():
+    while True:
+        time.sleep(ARCHIVE_INTERVAL)
+        try:
+            archive_ended_sessions()
+            purge_archive()
+            purge_expired_tokens()
+        except Exception:
+            logger.exception("Archival run failed")
+
+_archiving = False
+_archiving_lock = threading.Lock()
+
+# Start the background archival thread (once per process)
+def start_archiving():
+    global _archiving
+    with _archiving_lock:
+        if not _archiving:
+            threading.Thread(target=_archive_loop, name='archiver', daemon=True).start()
+            _archiving = True
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--older-than', type=float, default=ARCHIVE_AFTER, help='minutes since a session ended')
+    parser.add_argument('--retention-days', type=float, default=RETENTION_DAYS, help='days archived sessions are kept (0 = forever)')
+    parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH, help='sessions moved per transaction')
+    args = parser.parse_args(argv)
+
+    from database import flush_writes, init_db
+    init_db()
+    sessions, messages = archive_ended_sessions(args.older_than, args.batch_size)
+    purged = purge_archive(args.retention_days)
+    tokens = purge_expired_tokens()
+    flush_writes()
+    print(f"Archived {sessions} sessions ({messages} messages) to {get_archive_path()}, purged {purged}, "
+          f"deleted {tokens} expired login tokens")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
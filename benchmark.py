@@ -0,0 +1,399 @@
+"""Load test for the chat app against a throwaway SQLite database.
+
+Scripts synthetic users through register -> login -> find match -> chat ->
+end chat, calling the data helpers directly from many threads, then drives a
+few full Streamlit sessions through streamlit.testing's AppTest. Reports
+p50/p99 latencies, reruns per second and SQLite write-lock contention.
+
+With a shared coordination backend the synthetic users can be spread over
+several processes, partners landing in different ones, to measure how
+throughput scales with cores:
+
+    python benchmark.py --users 200 --messages 20
+    python benchmark.py --backend sqlite --processes 4 --app-users 0
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from coordination import BACKENDS
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'My_App_02.py')
+
+# Script time budgets: the first run in a fresh server process (importing the
+# app's modules and one-time setup) and a median rerun of a live session
+COLD_START_BUDGET_MS = 1000
+RERUN_BUDGET_MS = 50
+
+# Pairs of (gender, preference) that are always compatible with each other
+PAIR_PROFILES = [
+    (('Male', 'Straight'), ('Female', 'Straight')),
+    (('Male', 'Gay'), ('Male', 'Gay')),
+    (('Female', 'Lesbian'), ('Female', 'Lesbian')),
+]
+
+# Latency samples per operation, shared by all user threads
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.lock_errors = 0
+
+    def time(self, name, fn, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except sqlite3.OperationalError as e:
+            if 'locked' in str(e):
+                with self._lock:
+                    self.lock_errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.samples[name].append(elapsed)
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def summarize(samples):
+    return {
+        name: {
+            'count': len(values),
+            'p50_ms': percentile(values, 50) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+        }
+        for name, values in sorted(samples.items())
+    }
+
+# One synthetic user: register, log in, get matched, chat, leave
+def run_user(recorder, index, gender, preference, messages, match_timeout):
+    import database
+    from matchmaking import get_matchmaker
+    from message_bus import fetch_messages, send_message
+    from interests import INTERESTS
+
+    rng = random.Random(index)
+    username = f'bench_user_{index}'
+    interests = rng.sample(INTERESTS, rng.randint(1, 4))
+
+    recorder.time('register_user', database.register_user, username, 'secret', gender, preference, interests)
+    user = recorder.time('authenticate_user', database.authenticate_user, username, 'secret')
+    recorder.time('find_match', database.find_match, user)
+
+    matchmaker = get_matchmaker()
+    ticket = recorder.time('request_match', matchmaker.request_match, user)
+    deadline = time.monotonic() + match_timeout
+    while not ticket.matched and time.monotonic() < deadline:
+        time.sleep(0.005)
+        # Shared backends hand out snapshots, so re-read the ticket
+        ticket = matchmaker.poll(user['id']) or ticket
+    if not ticket.matched:
+        matchmaker.cancel(user['id'])
+        return False
+    matchmaker.acknowledge(user['id'])
+    session_id = ticket.session_id
+
+    cursor = 0
+    for i in range(messages):
+        recorder.time('send_message', send_message, session_id, user['id'], f'message {i} from {username}')
+        new_messages = recorder.time('fetch_messages', fetch_messages, session_id, cursor)
+        if new_messages:
+            cursor = new_messages[-1][0]
+        recorder.time('get_new_messages', database.get_new_messages, session_id, cursor)
+        recorder.time('is_session_active', database.is_session_active, session_id)
+
+    recorder.time('end_chat_session', database.end_chat_session, session_id)
+    recorder.time('set_user_offline', database.set_user_offline, user['id'])
+    return True
+
+# A client spamming Send through the rate limiter until stopped; returns
+# (messages sent, sends refused)
+def run_abuser(index, stop):
+    import database
+    from message_bus import send_message_limited
+    from rate_limit import RateLimited
+
+    user_id = -1 - index  # not a real user, so never matched with one
+    session_id = database.start_chat_session(user_id, user_id)
+    sent = refused = 0
+    while not stop.is_set():
+        try:
+            send_message_limited(session_id, user_id, f'spam from abuser {index}')
+            sent += 1
+        except RateLimited:
+            refused += 1
+        time.sleep(0.001)
+    return sent, refused
+
+# Run some of the synthetic users in this process; users is a list of
+# (index, gender, preference)
+def run_users(users, messages, concurrency, match_timeout, abusers=0):
+    import database
+
+    recorder = Recorder()
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=abusers or 1) as abuse_pool:
+        abuse = [abuse_pool.submit(run_abuser, i, stop) for i in range(abusers)]
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = [
+                pool.submit(run_user, recorder, i, gender, preference, messages, match_timeout)
+                for i, gender, preference in users
+            ]
+            matched = sum(1 for future in futures if future.result())
+        stop.set()
+        abuse = [future.result() for future in abuse]
+    database.flush_writes()
+    return {
+        'matched': matched,
+        'samples': dict(recorder.samples),
+        'lock_errors': recorder.lock_errors,
+        'writer': dict(database.get_writer().stats),
+        'abuse_sent': sum(sent for sent, refused in abuse),
+        'abuse_refused': sum(refused for sent, refused in abuse),
+    }
+
+# Worker process entry point (environment is inherited from the parent)
+def _run_process(users, messages, concurrency, match_timeout, abusers):
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+    import database
+    database.init_db()
+    try:
+        return run_users(users, messages, concurrency, match_timeout, abusers)
+    finally:
+        database.get_writer().close()
+
+def run_helpers(users, messages, concurrency, match_timeout, processes=1, abusers=0):
+    profiles = []
+    for i in range(users // 2):
+        profiles.extend(PAIR_PROFILES[i % len(PAIR_PROFILES)])
+    indexed = [(i, gender, preference) for i, (gender, preference) in enumerate(profiles)]
+
+    started = time.perf_counter()
+    if processes == 1:
+        results = [run_users(indexed, messages, concurrency, match_timeout, abusers)]
+    else:
+        # Deal users out round-robin so most partners are in other processes
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = [
+                pool.submit(_run_process, indexed[p::processes], messages, max(1, concurrency // processes),
+                            match_timeout, abusers // processes + (p < abusers % processes))
+                for p in range(processes)
+            ]
+            results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+
+    samples = defaultdict(list)
+    writer = defaultdict(float)
+    for result in results:
+        for name, values in result['samples'].items():
+            samples[name].extend(values)
+        for name, value in result['writer'].items():
+            writer[name] += value
+    return {
+        'users': len(profiles),
+        'processes': processes,
+        'matched': sum(result['matched'] for result in results),
+        'seconds': elapsed,
+        'latency': summarize(samples),
+        'lock_errors': sum(result['lock_errors'] for result in results),
+        'abusers': abusers,
+        'abuse_sent': sum(result['abuse_sent'] for result in results),
+        'abuse_refused': sum(result['abuse_refused'] for result in results),
+        'writer': dict(writer),
+    }
+
+# Run in a fresh interpreter: time importing Streamlit, the app's first
+# script run and an idle rerun of the same session
+COLD_START_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+imported = time.perf_counter()
+at = AppTest.from_file(sys.argv[1], default_timeout=60).run()
+first_run = time.perf_counter()
+at.run()
+print(json.dumps({
+    'streamlit_import_ms': (imported - started) * 1000,
+    'first_run_ms': (first_run - imported) * 1000,
+    'idle_rerun_ms': (time.perf_counter() - first_run) * 1000,
+}))
+"""
+
+def measure_cold_start():
+    result = subprocess.run([sys.executable, '-c', COLD_START_SCRIPT, APP_PATH],
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+# Drive real Streamlit sessions and count script reruns
+def run_app(app_users, messages, match_timeout):
+    from streamlit.testing.v1 import AppTest
+
+    reruns = 0
+    run_times = []
+
+    def run(at):
+        nonlocal reruns
+        started = time.perf_counter()
+        at.run()
+        run_times.append(time.perf_counter() - started)
+        reruns += 1
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+        return at
+
+    def click(at, label):
+        next(b for b in at.button if b.label == label).click()
+        return run(at)
+
+    started = time.perf_counter()
+    sessions = []
+    for i in range(app_users):
+        gender, preference = PAIR_PROFILES[0][i % 2]
+        at = run(AppTest.from_file(APP_PATH, default_timeout=60))
+        at.text_input(key='reg_username').input(f'bench_app_{i}')
+        at.text_input(key='reg_password').input('secret')
+        at.selectbox(key='reg_gender').select(gender)
+        at.selectbox(key='reg_preference').select(preference)
+        at.multiselect(key='reg_interests').set_value(['Music'])
+        click(at, 'Register')
+        at.text_input(key='login_username').input(f'bench_app_{i}')
+        at.text_input(key='login_password').input('secret')
+        click(at, 'Login')
+        click(at, 'Find a Chat Partner')
+        sessions.append(at)
+
+    # Matching happens in batch rounds: rerun the waiting screens (as their
+    # live fragment would) until everyone is in a chat
+    deadline = time.monotonic() + match_timeout
+    for at in sessions:
+        run(at)
+        while not at.session_state.in_chat:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"App sessions not matched within {match_timeout}s")
+            time.sleep(0.05)
+            run(at)
+    for i in range(messages):
+        for at in sessions:
+            if at.session_state.in_chat:
+                at.text_input(key='new_message').input(f'app message {i}')
+                click(at, 'Send')
+    for at in sessions:
+        if at.session_state.in_chat:
+            click(at, 'End Chat')
+    elapsed = time.perf_counter() - started
+
+    return {
+        'sessions': app_users,
+        'reruns': reruns,
+        'seconds': elapsed,
+        'reruns_per_second': reruns / elapsed if elapsed else 0.0,
+        'rerun_p50_ms': percentile(run_times, 50) * 1000,
+        'rerun_p99_ms': percentile(run_times, 99) * 1000,
+    }
+
+def print_report(report):
+    helpers = report['helpers']
+    print(f"Helpers: {helpers['users']} users in {helpers['processes']} process(es), "
+          f"{helpers['matched']} matched in {helpers['seconds']:.2f}s")
+    print(f"  {'operation':<20}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, stats in helpers['latency'].items():
+        print(f"  {name:<20}{stats['count']:>8}{stats['p50_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+
+    if helpers['abusers']:
+        print(f"Abuse: {helpers['abusers']} spamming clients, {helpers['abuse_sent']} messages sent, "
+              f"{helpers['abuse_refused']} refused by the rate limiter")
+
+    writer = report['writer']
+    print(f"SQLite writer: {int(writer['writes'])} writes in {int(writer['batches'])} batches, "
+          f"{int(writer['failed'])} failed, {writer['lock_wait'] * 1000:.1f} ms waiting for the write lock, "
+          f"{helpers['lock_errors']} 'database is locked' errors")
+
+    app = report.get('app')
+    if app:
+        print(f"App: {app['sessions']} sessions, {app['reruns']} reruns in {app['seconds']:.2f}s "
+              f"({app['reruns_per_second']:.1f}/s, p50 {app['rerun_p50_ms']:.1f} ms, p99 {app['rerun_p99_ms']:.1f} ms)")
+
+    startup = report.get('startup')
+    if startup:
+        print(f"Startup: streamlit import {startup['streamlit_import_ms']:.0f} ms, "
+              f"first run {startup['first_run_ms']:.0f} ms, idle rerun {startup['idle_rerun_ms']:.1f} ms")
+    for name, budget in report['budgets'].items():
+        status = 'over' if budget['measured_ms'] > budget['budget_ms'] else 'ok'
+        print(f"Budget {name}: {budget['measured_ms']:.1f} ms of {budget['budget_ms']:.0f} ms ({status})")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200, help='synthetic users driven through the helpers')
+    parser.add_argument('--messages', type=int, default=20, help='messages each user sends')
+    parser.add_argument('--concurrency', type=int, default=32, help='user threads running at once (over all processes)')
+    parser.add_argument('--backend', choices=BACKENDS, default='memory', help='coordination backend (CHAT_APP_BACKEND)')
+    parser.add_argument('--processes', type=int, default=1, help='processes the synthetic users are spread over')
+    parser.add_argument('--match-timeout', type=float, default=10.0, help='seconds a user waits for a partner')
+    parser.add_argument('--abusers', type=int, default=0, help='clients spamming Send through the rate limiter meanwhile')
+    parser.add_argument('--app-users', type=int, default=4, help='Streamlit sessions driven through AppTest (0 to skip)')
+    parser.add_argument('--app-messages', type=int, default=5, help='messages each AppTest session sends')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('--max-p99-ms', type=float, help='exit non-zero if any helper p99 exceeds this')
+    parser.add_argument('--cold-start-budget-ms', type=float, default=COLD_START_BUDGET_MS,
+                        help='budget for the first script run in a fresh process')
+    parser.add_argument('--rerun-budget-ms', type=float, default=RERUN_BUDGET_MS, help='budget for a median script rerun')
+    parser.add_argument('--enforce-budgets', action='store_true', help='exit non-zero if a time budget is exceeded')
+    args = parser.parse_args(argv)
+    if args.processes > 1 and args.backend == 'memory':
+        parser.error("--processes needs a shared --backend (sqlite or redis)")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['CHAT_APP_DB'] = os.path.join(tmp, 'bench.db')
+        os.environ['CHAT_APP_BACKEND'] = args.backend
+        sys.path.insert(0, os.path.dirname(APP_PATH))
+        import database
+        database.init_db()
+
+        helpers = run_helpers(args.users, args.messages, args.concurrency, args.match_timeout, args.processes,
+                              args.abusers)
+        report = {'helpers': helpers, 'writer': helpers.pop('writer')}
+        report['budgets'] = {}
+        if args.app_users:
+            report['app'] = run_app(args.app_users, args.app_messages, args.match_timeout)
+            report['startup'] = measure_cold_start()
+            report['budgets'] = {
+                'cold_start': {'measured_ms': report['startup']['first_run_ms'], 'budget_ms': args.cold_start_budget_ms},
+                'rerun_p50': {'measured_ms': report['app']['rerun_p50_ms'], 'budget_ms': args.rerun_budget_ms},
+            }
+        database.flush_writes()
+        database.close_pool()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    if args.enforce_budgets:
+        over = [name for name, budget in report['budgets'].items() if budget['measured_ms'] > budget['budget_ms']]
+        if over:
+            print(f"Over budget: {', '.join(over)}", file=sys.stderr)
+            return 1
+    if args.max_p99_ms is not None:
+        slow = [name for name, stats in report['helpers']['latency'].items() if stats['p99_ms'] > args.max_p99_ms]
+        if slow:
+            print(f"p99 over {args.max_p99_ms} ms: {', '.join(slow)}", file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
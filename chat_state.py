@@ -0,0 +1,147 @@
+import html
+
+import streamlit as st
+
+from message_bus import fetch_earlier_messages, fetch_messages, send_message_limited
+from metrics import phase
+from rate_limit import RateLimited
+
+# Messages rendered in the chat view, and page size for older history
+CHAT_WINDOW = 50
+HISTORY_PAGE = 50
+# Over-rate messages held back and sent as the rate limit allows
+OUTBOX_LIMIT = 5
+
+# Per-browser-session state and its initial values
+SESSION_DEFAULTS = {
+    'logged_in': False,
+    'current_user': None,
+    'chat_partner': None,
+    'chat_messages': [],
+    'chat_window': CHAT_WINDOW,
+    'history_complete': True,
+    'waiting_for_match': False,
+    'in_chat': False,
+    'session_id': None,
+    'last_message_id': 0,
+    'login_token': None,
+    'chat_notice': None,
+    'send_notice': None,
+    'outbox': [],
+    'active_sessions': {},
+    'search_page': 0,
+}
+
+# Fill in whatever the session doesn't have yet
+def init_session_state():
+    for key, default in SESSION_DEFAULTS.items():
+        if key not in st.session_state:
+            st.session_state[key] = default.copy() if isinstance(default, (list, dict)) else default
+
+# Enter a chat session showing its latest messages; the cursor starts after
+# them, so polling only ever asks for newer ones
+def enter_chat(session_id, partner):
+    leave_chat()
+    st.session_state.chat_partner = partner
+    st.session_state.in_chat = True
+    st.session_state.session_id = session_id
+
+    recent = fetch_earlier_messages(session_id, None, CHAT_WINDOW)
+    st.session_state.chat_messages = _chat_messages(recent)
+    st.session_state.history_complete = len(recent) < CHAT_WINDOW
+    if recent:
+        st.session_state.last_message_id = recent[-1][0]
+
+# Drop the current chat and its messages from the session
+def leave_chat():
+    st.session_state.chat_partner = None
+    st.session_state.chat_messages = []
+    st.session_state.chat_window = CHAT_WINDOW
+    st.session_state.history_complete = True
+    st.session_state.last_message_id = 0
+    st.session_state.outbox = []
+    st.session_state.in_chat = False
+    st.session_state.session_id = None
+
+# Chat message with its HTML rendered (and escaped) once, up front
+def chat_message(message_id, sender, text, timestamp):
+    css_class = 'user-message' if sender == 'You' else 'partner-message'
+    return {
+        'id': message_id,
+        'sender': sender,
+        'text': text,
+        'timestamp': timestamp,
+        'html': f"<div class='message {css_class}'><b>{sender}:</b> {html.escape(text)}</div>"
+    }
+
+# Chat messages for (id, sender_id, text, timestamp) rows
+def _chat_messages(rows):
+    current_user_id = st.session_state.current_user['id']
+    return [chat_message(message_id, 'You' if sender_id == current_user_id else 'Partner', message_text, timestamp)
+            for message_id, sender_id, message_text, timestamp in rows]
+
+# Pull messages newer than the cursor into the session's chat list
+def fetch_new_messages():
+    with phase('message_poll'):
+        # Fetch messages newer than the last one we have (message id cursor);
+        # served from the message bus
+        new_messages = fetch_messages(
+            st.session_state.session_id,
+            st.session_state.last_message_id
+        )
+
+        # Add new messages to the chat
+        for msg in new_messages:
+            message_id, sender_id, message_text, timestamp = msg
+            if sender_id == st.session_state.current_user['id']:
+                sender = 'You'
+            else:
+                sender = 'Partner'
+
+            st.session_state.chat_messages.append(chat_message(message_id, sender, message_text, timestamp))
+            st.session_state.last_message_id = message_id
+
+        # Keep only the visible window; older messages can be paged back in
+        overflow = len(st.session_state.chat_messages) - st.session_state.chat_window
+        if overflow > 0:
+            del st.session_state.chat_messages[:overflow]
+            st.session_state.history_complete = False
+
+# Page older messages in front of the ones already loaded
+def load_earlier_messages():
+    if st.session_state.chat_messages:
+        before_id = st.session_state.chat_messages[0]['id']
+    else:
+        before_id = st.session_state.last_message_id + 1
+    earlier = fetch_earlier_messages(st.session_state.session_id, before_id, HISTORY_PAGE)
+    st.session_state.chat_messages[:0] = _chat_messages(earlier)
+    st.session_state.chat_window += len(earlier)
+    if len(earlier) < HISTORY_PAGE:
+        st.session_state.history_complete = True
+
+# Send a chat message through the rate limiter. Over-rate messages wait in
+# the outbox (in order, behind any already waiting); returns a notice for the
+# user when the message could not be sent or queued, else None.
+def send_chat_message(text):
+    if not st.session_state.outbox:
+        try:
+            send_message_limited(st.session_state.session_id, st.session_state.current_user['id'], text)
+            return None
+        except RateLimited as e:
+            if e.reason == 'busy':
+                return "The chat server is busy right now. Please try again in a moment."
+
+    if len(st.session_state.outbox) >= OUTBOX_LIMIT:
+        return "You're sending messages too quickly; that one wasn't sent."
+    st.session_state.outbox.append(text)
+    return None
+
+# Send queued messages while the rate limit allows
+def flush_outbox():
+    while st.session_state.outbox:
+        try:
+            send_message_limited(st.session_state.session_id, st.session_state.current_user['id'],
+                                 st.session_state.outbox[0])
+        except RateLimited:
+            return
+        st.session_state.outbox.pop(0)
@@ -0,0 +1,37 @@
+import os
+import threading
+
+# Where state shared between app processes lives (CHAT_APP_BACKEND):
+#   memory - this process only; fine for a single Streamlit server
+#   sqlite - tables in the shared database file; any number of server
+#            processes on one host
+#   redis  - a Redis-compatible server at CHAT_APP_REDIS_URL; the database
+#            file still holds users, sessions and message history
+# This covers the matchmaking pool, presence and chat message fan-out.
+BACKENDS = ('memory', 'sqlite', 'redis')
+
+def get_backend():
+    backend = os.environ.get('CHAT_APP_BACKEND', 'memory')
+    if backend not in BACKENDS:
+        raise ValueError(f"CHAT_APP_BACKEND must be one of {', '.join(BACKENDS)}, not {backend!r}")
+    return backend
+
+# True when other processes may change matchmaking, presence or chat state
+def is_shared():
+    return get_backend() != 'memory'
+
+_redis = None
+_redis_lock = threading.Lock()
+
+# Shared Redis client (the redis package is only needed for this backend)
+def get_redis():
+    global _redis
+    with _redis_lock:
+        if _redis is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError("CHAT_APP_BACKEND=redis needs the redis package (pip install redis)")
+            _redis = redis.Redis.from_url(os.environ.get('CHAT_APP_REDIS_URL', 'redis://localhost:6379/0'),
+                                          decode_responses=True)
+        return _redis
@@ -0,0 +1,37 @@
+import pandas as pd
+
+from database import get_interest_stats, get_minutely_stats, get_session_length_stats
+from interests import INTERESTS
+
+# Minutes of history on the activity charts
+DASHBOARD_MINUTES = 60
+
+# Activity over the last `minutes` minutes (UTC), one row per minute with
+# zeros where nothing happened: matches (sessions started), ended, messages
+def activity_frame(minutes=DASHBOARD_MINUTES):
+    now = pd.Timestamp.now(tz='UTC').tz_localize(None).floor('min')
+    index = pd.date_range(end=now, periods=minutes, freq='min')
+    frame = pd.DataFrame(get_minutely_stats(index[0].strftime('%Y-%m-%d %H:%M')),
+                         columns=['minute', 'matches', 'ended', 'messages'])
+    frame.index = pd.to_datetime(frame.pop('minute'))
+    return frame.reindex(index, fill_value=0)
+
+def _length_label(max_seconds):
+    if max_seconds < 0:
+        return "longer"
+    return f"≤ {max_seconds}s" if max_seconds < 60 else f"≤ {max_seconds // 60} min"
+
+# Ended sessions per length bucket, shortest first
+def session_length_frame():
+    rows = get_session_length_stats()
+    rows.sort(key=lambda row: row[0] < 0)  # open-ended bucket last
+    return pd.DataFrame({'sessions': [sessions for _, sessions in rows]},
+                        index=pd.Index([_length_label(max_seconds) for max_seconds, _ in rows], name='length'))
+
+# Ended sessions, messages and messages per session for each shared interest
+def interest_frame():
+    frame = pd.DataFrame(get_interest_stats(), columns=['bit', 'sessions', 'messages'])
+    frame = frame[frame['bit'] < len(INTERESTS)]
+    frame.index = pd.Index([INTERESTS[bit] for bit in frame.pop('bit')], name='interest')
+    frame['messages_per_session'] = (frame['messages'] / frame['sessions']).round(1)
+    return frame
@@ -0,0 +1,1026 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+from coordination import is_shared
+from interests import decode_interests, encode_interests, popcount_sql
+from metrics import registry, timed
+from migrations import SHARD_MIGRATIONS, migrate
+from writer import WriteBehindWriter
+
+logger = logging.getLogger(__name__)
+
+# Connection tuning
+POOL_SIZE = 16
+BUSY_TIMEOUT_MS = 5000
+STATEMENT_CACHE_SIZE = 256
+# Largest possible SQLite rowid
+MAX_ROWID = 2 ** 63 - 1
+# Chat sessions whose liveness is kept in memory
+SESSION_CACHE_SIZE = 50000
+
+# Use a persistent database path for deployment
+# (CHAT_APP_DB overrides it, e.g. for benchmarks against a temp database)
+def get_db_path():
+    if os.environ.get('CHAT_APP_DB'):
+        return os.environ['CHAT_APP_DB']
+    if os.path.exists('chat_app.db'):
+        return 'chat_app.db'
+    else:
+        return '/tmp/chat_app.db'  # Use tmp directory for deployment
+
+# Process-wide pool of SQLite connections.
+# Connections are checked out per call and handed back afterwards, so every
+# Streamlit script thread reuses the same open handles (and their prepared
+# statement caches) instead of paying for connect/close on each helper call.
+class ConnectionPool:
+    def __init__(self, db_path, size=POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._closed = False
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            conn.close()
+            return
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Get the shared pool, reopening it if the database path changed
+def get_pool():
+    global _pool
+    db_path = get_db_path()
+    pool = _pool
+    if pool is not None and pool.db_path == db_path:
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.db_path != db_path:
+            if _pool is not None:
+                _pool.close()
+            _pool = ConnectionPool(db_path)
+        return _pool
+
+# Close every pooled connection (e.g. before switching databases)
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+    with _message_shards_lock:
+        _close_message_shards()
+
+# Borrow a pooled connection for reads
+@contextmanager
+def connection():
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+# Borrow a pooled connection and commit (or roll back) on exit
+@contextmanager
+def transaction():
+    with connection() as conn:
+        with conn:
+            yield conn
+
+# Background writer shared by every write helper
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = WriteBehindWriter(connection)
+            atexit.register(_writer.close)
+            registry.register_gauge('write_queue_depth', _writer.pending)
+        return _writer
+
+# Queue a write (a function taking a connection) for the next group commit.
+# With wait=True, block until it is committed and return its result;
+# otherwise return a Future.
+def write(op, *args, wait=False):
+    future = get_writer().submit(op, *args)
+    return future.result() if wait else future
+
+# Wait until every queued write is committed
+def flush_writes():
+    if _writer is not None:
+        _writer.flush()
+    for shard in _open_message_shards():
+        shard.writer.flush()
+
+# Writes queued on the busiest writer (the main database's or a message shard's)
+def pending_writes():
+    return max([get_writer().pending()] + [shard.writer.pending() for shard in get_message_shards()])
+
+# Sharded message storage.
+# CHAT_APP_MESSAGE_SHARDS=N (N > 0) moves messages out of the main database
+# into N files beside it, <name>_messages_<i>.db. All of a chat session's
+# messages live in one shard, picked by hashing the session id, and every
+# shard has its own connection pool and writer, so sends to different shards
+# commit in parallel instead of queueing for one file's write lock. 0 (the
+# default) keeps messages in the main database. Existing messages must be
+# moved before N changes: python shards.py rebalance.
+def get_message_shard_count():
+    return int(os.environ.get('CHAT_APP_MESSAGE_SHARDS', '0'))
+
+def get_message_shard_path(index, db_path=None):
+    root, ext = os.path.splitext(db_path or get_db_path())
+    return f'{root}_messages_{index}{ext or ".db"}'
+
+# Shard of a chat session (the same in every process and after restarts)
+def shard_for_session(session_id, shards):
+    return zlib.crc32(int(session_id).to_bytes(8, 'little', signed=True)) % shards
+
+class MessageShard:
+    def __init__(self, path, index, count):
+        self.path = path
+        self.index = index
+        self.count = count
+        self.pool = ConnectionPool(path)
+        with self.connection() as conn:
+            migrate(conn, SHARD_MIGRATIONS)
+        self.writer = WriteBehindWriter(self.connection)
+        atexit.register(self.writer.close)
+
+    @contextmanager
+    def connection(self):
+        conn = self.pool.acquire()
+        try:
+            yield conn
+        finally:
+            self.pool.release(conn)
+
+    def write(self, op, *args, wait=False):
+        future = self.writer.submit(op, *args)
+        return future.result() if wait else future
+
+    def close(self):
+        self.writer.close()
+        self.pool.close()
+
+_message_shards = None  # (db_path, [MessageShard])
+_message_shards_lock = threading.Lock()
+
+# Shards of the current database ([] when messages are not sharded),
+# reopened if the database path or shard count changed
+def get_message_shards():
+    global _message_shards
+    db_path, count = get_db_path(), get_message_shard_count()
+    shards = _message_shards
+    if shards is not None and shards[0] == db_path and len(shards[1]) == count:
+        return shards[1]
+    with _message_shards_lock:
+        if _message_shards is None or _message_shards[0] != db_path or len(_message_shards[1]) != count:
+            _close_message_shards()
+            _message_shards = (db_path, [MessageShard(get_message_shard_path(i, db_path), i, count) for i in range(count)])
+        return _message_shards[1]
+
+# Shards opened so far, without opening any
+def _open_message_shards():
+    shards = _message_shards
+    return shards[1] if shards is not None else []
+
+def _close_message_shards():
+    global _message_shards
+    for shard in _open_message_shards():
+        shard.close()
+    _message_shards = None
+
+# Shard holding a session's messages, or None if they are in the main database
+def get_message_shard(session_id):
+    shards = get_message_shards()
+    return shards[shard_for_session(session_id, len(shards))] if shards else None
+
+# Borrow a connection to the database holding a session's messages
+@contextmanager
+def message_connection(session_id):
+    shard = get_message_shard(session_id)
+    with (shard.connection() if shard else connection()) as conn:
+        yield conn
+
+# Split session ids (or rows, with `key` giving their session id) by the
+# shard they belong to: [(shard or None, items)]
+def _group_by_shard(items, key=lambda item: item):
+    shards = get_message_shards()
+    if not shards:
+        return [(None, list(items))] if items else []
+    groups = {}
+    for item in items:
+        groups.setdefault(shard_for_session(key(item), len(shards)), []).append(item)
+    return [(shards[index], group) for index, group in groups.items()]
+
+# Participants of the given sessions as (id, user1_id, user2_id) rows, for a
+# shard's copy of chat_sessions ([] when messages are not sharded)
+@timed
+def message_participants(session_ids):
+    if not get_message_shards():
+        return []
+    return _session_participants(session_ids)
+
+def _session_participants(session_ids):
+    rows = []
+    for session_id in set(session_ids):
+        state = get_session_state(session_id)
+        if state is not None:
+            rows.append((session_id, *state['user_ids']))
+    return rows
+
+# Database setup
+# Runs pending migrations once per process and database path; later calls
+# (one per Streamlit rerun) return without touching the database.
+_initialized_paths = set()
+
+@timed
+def init_db():
+    db_path = get_db_path()
+    if db_path in _initialized_paths:
+        return
+
+    if is_shared() and not os.environ.get('CHAT_APP_DB'):
+        logger.warning("Shared backend without CHAT_APP_DB: processes started from different "
+                       "directories may open different databases (using %s)", db_path)
+    with connection() as conn:
+        migrate(conn)
+    _check_message_layout()
+    get_message_shards()
+    _initialized_paths.add(db_path)
+
+# Refuse to start if CHAT_APP_MESSAGE_SHARDS doesn't match where the existing
+# messages are. The layout is recorded when a database is first used (0 for
+# one that already has messages in its main messages table).
+def _check_message_layout():
+    configured = get_message_shard_count()
+    with connection() as conn:
+        has_messages = conn.execute("SELECT EXISTS (SELECT 1 FROM messages)").fetchone()[0]
+    recorded = int(get_or_create_setting('message_shards', str(0 if has_messages else configured)))
+    if recorded != configured:
+        raise RuntimeError(f"Messages are stored in {recorded} shard(s) (0 = the main database) but "
+                           f"CHAT_APP_MESSAGE_SHARDS={configured}; run python shards.py rebalance first")
+
+# Password hashing
+def hash_password(password):
+    return hashlib.sha256(password.encode()).hexdigest()
+
+# User registration
+@timed
+def register_user(username, password, gender, preference, interests):
+    hashed_password = hash_password(password)
+    interests_str = ','.join(interests)
+    interests_mask = encode_interests(interests)
+
+    # Wait for the commit so the account can log in right away
+    try:
+        write(_insert_user, username, hashed_password, gender, preference, interests_str, interests_mask, wait=True)
+        return True
+    except sqlite3.IntegrityError:
+        return False
+
+def _insert_user(conn, username, hashed_password, gender, preference, interests_str, interests_mask):
+    conn.execute("INSERT INTO users (username, password, gender, preference, interests, interests_mask, online) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                 (username, hashed_password, gender, preference, interests_str, interests_mask, False))
+
+# User authentication
+@timed
+def authenticate_user(username, password):
+    hashed_password = hash_password(password)
+
+    with connection() as conn:
+        user = conn.execute("SELECT id, username, gender, preference, interests, interests_mask FROM users WHERE username = ? AND password = ?",
+                            (username, hashed_password)).fetchone()
+
+    # Mark user as online
+    if user:
+        write(_set_online, user[0], True)
+
+    return _user_from_row(user) if user else None
+
+def _user_from_row(row):
+    return {
+        'id': row[0],
+        'username': row[1],
+        'gender': row[2],
+        'preference': row[3],
+        'interests': row[4].split(',') if row[4] else [],
+        'interests_mask': row[5]
+    }
+
+# Look up a user by id (no password check)
+@timed
+def get_user(user_id):
+    with connection() as conn:
+        user = conn.execute("SELECT id, username, gender, preference, interests, interests_mask FROM users WHERE id = ?",
+                            (user_id,)).fetchone()
+    return _user_from_row(user) if user else None
+
+def _set_online(conn, user_id, online):
+    conn.execute("UPDATE users SET online = ? WHERE id = ?", (online, user_id))
+
+# Mark user as offline
+@timed
+def set_user_offline(user_id):
+    write(_set_online, user_id, False)
+
+# Shared-interest count of each candidate, computed inside SQLite
+_OVERLAP_SQL = popcount_sql('shared_mask')
+
+# Find the best matching partners from REAL users in the database.
+# Candidates are ranked by shared interests inside the query, so only the
+# top `limit` rows ever reach Python.
+@timed
+def find_matches(current_user, limit=5):
+    # Get user's preference and gender
+    user_pref = current_user['preference']
+    user_gender = current_user['gender']
+    user_mask = current_user.get('interests_mask')
+    if user_mask is None:
+        user_mask = encode_interests(current_user['interests'])
+
+    # Define target gender based on preference
+    if user_pref == 'Straight':
+        if user_gender == 'Male':
+            target_gender = 'Female'
+        else:
+            target_gender = 'Male'
+    elif user_pref == 'Gay':
+        target_gender = 'Male'
+    elif user_pref == 'Lesbian':
+        target_gender = 'Female'
+    else:  # Bisexual
+        target_gender = None  # No gender restriction
+
+    # Build filter based on preference
+    if target_gender:
+        where = """
+            id != ?
+            AND gender = ?
+            AND (preference = ? OR preference = 'Bisexual')
+        """
+        params = (user_mask, current_user['id'], target_gender, user_pref)
+    else:
+        # For bisexual users, match with anyone who would also match with them
+        where = """
+            id != ?
+            AND (
+                (gender = 'Male' AND (preference = 'Bisexual' OR preference = 'Gay' OR preference = 'Straight' AND gender = 'Female')) OR
+                (gender = 'Female' AND (preference = 'Bisexual' OR preference = 'Lesbian' OR preference = 'Straight' AND gender = 'Male'))
+            )
+        """
+        params = (user_mask, current_user['id'])
+
+    # Only consider users who are around
+    where += "AND online = TRUE"
+
+    query = f"""
+        SELECT id, username, gender, preference, shared_mask
+        FROM (
+            SELECT id, username, gender, preference, interests_mask & ? AS shared_mask
+            FROM users
+            WHERE {where}
+        )
+        ORDER BY {_OVERLAP_SQL} DESC, id ASC
+        LIMIT ?
+    """
+
+    with connection() as conn:
+        rows = conn.execute(query, params + (limit,)).fetchall()
+
+    return [{
+        'id': row[0],
+        'username': row[1],
+        'gender': row[2],
+        'preference': row[3],
+        'common_interests': decode_interests(row[4])
+    } for row in rows]
+
+# Find a matching partner from REAL users in the database
+def find_match(current_user):
+    matches = find_matches(current_user, limit=1)
+
+    # Return the best match if available
+    return matches[0] if matches else None
+
+# In-process view of chat session liveness.
+# Starting and ending sessions updates it directly, so the chat screen's
+# "is my partner still here" check is a dict lookup. Sessions this process
+# has not seen yet are loaded from SQLite once.
+class SessionStateCache:
+    def __init__(self, size=SESSION_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # session id -> state dict
+        self._by_user = {}              # user id -> ids of cached active sessions
+
+    def get(self, session_id):
+        with self._lock:
+            state = self._sessions.get(session_id)
+            if state is not None:
+                self._sessions.move_to_end(session_id)
+            return state
+
+    def put(self, session_id, user1_id, user2_id, active, end_time=None):
+        state = {'user_ids': (user1_id, user2_id), 'active': bool(active), 'end_time': end_time}
+        with self._lock:
+            self._sessions[session_id] = state
+            self._sessions.move_to_end(session_id)
+            if state['active']:
+                for user_id in state['user_ids']:
+                    self._by_user.setdefault(user_id, set()).add(session_id)
+            while len(self._sessions) > self.size:
+                evicted_id, evicted = self._sessions.popitem(last=False)
+                self._forget_user_links(evicted_id, evicted)
+        return state
+
+    def end(self, session_id, end_time):
+        with self._lock:
+            state = self._sessions.get(session_id)
+            if state is not None:
+                self._mark_ended(session_id, state, end_time)
+
+    def end_for_user(self, user_id, end_time):
+        with self._lock:
+            for session_id in list(self._by_user.get(user_id, ())):
+                self._mark_ended(session_id, self._sessions[session_id], end_time)
+
+    def _mark_ended(self, session_id, state, end_time):
+        if state['active']:
+            state['active'] = False
+            state['end_time'] = end_time
+            self._forget_user_links(session_id, state)
+
+    def _forget_user_links(self, session_id, state):
+        for user_id in state['user_ids']:
+            sessions = self._by_user.get(user_id)
+            if sessions is not None:
+                sessions.discard(session_id)
+                if not sessions:
+                    del self._by_user[user_id]
+
+_session_cache = SessionStateCache()
+
+# Liveness of a chat session: {'user_ids', 'active', 'end_time'} or None
+@timed
+def get_session_state(session_id):
+    state = _session_cache.get(session_id)
+    # Ended is final; with a shared backend another process may end an
+    # active session, so only the ended state can be trusted from cache
+    if state is not None and (not state['active'] or not is_shared()):
+        return state
+
+    # Let queued starts/ends land first so the cached copy isn't stale
+    if state is None:
+        flush_writes()
+    with connection() as conn:
+        row = conn.execute("SELECT user1_id, user2_id, active, end_time FROM chat_sessions WHERE id = ?",
+                           (session_id,)).fetchone()
+    if row is None:
+        return None
+    return _session_cache.put(session_id, *row)
+
+# Start a chat session (waits for the commit to get the session id)
+@timed
+def start_chat_session(user1_id, user2_id):
+    session_id = write(_insert_chat_session, user1_id, user2_id, datetime.now(), wait=True)
+    _session_cache.put(session_id, user1_id, user2_id, True)
+    return session_id
+
+def _insert_chat_session(conn, user1_id, user2_id, start_time):
+    c = conn.execute("INSERT INTO chat_sessions (user1_id, user2_id, start_time) VALUES (?, ?, ?)",
+                     (user1_id, user2_id, start_time))
+    return c.lastrowid
+
+# Start a chat session for each (user1_id, user2_id) pair in one write;
+# returns the session ids in the same order
+@timed
+def start_chat_sessions(pairs):
+    if not pairs:
+        return []
+    session_ids = write(_insert_chat_sessions, pairs, datetime.now(), wait=True)
+    for session_id, (user1_id, user2_id) in zip(session_ids, pairs):
+        _session_cache.put(session_id, user1_id, user2_id, True)
+    return session_ids
+
+def _insert_chat_sessions(conn, pairs, start_time):
+    return [_insert_chat_session(conn, user1_id, user2_id, start_time) for user1_id, user2_id in pairs]
+
+# Persist messages whose ids were already assigned by the message bus
+# (spread over the shards they belong to). rows are (id, session_id,
+# sender_id, message, timestamp) tuples. Callers holding a lock pass the
+# sessions' message_participants so no session lookup happens here.
+@timed
+def insert_messages(rows, wait=False, participants=None):
+    futures = []
+    for shard, shard_rows in _group_by_shard(rows, key=lambda row: row[1]):
+        if shard is None:
+            futures.append(write(_insert_messages, shard_rows))
+            continue
+        session_ids = {row[1] for row in shard_rows}
+        if participants is None:
+            sessions = _session_participants(session_ids)
+        else:
+            sessions = [session for session in participants if session[0] in session_ids]
+        futures.append(shard.write(_insert_messages, shard_rows, sessions))
+    if wait:
+        for future in futures:
+            future.result()
+
+# sessions: (id, user1_id, user2_id) rows for a shard's chat_sessions
+def _insert_messages(conn, rows, sessions=()):
+    conn.executemany("INSERT OR IGNORE INTO chat_sessions (id, user1_id, user2_id) VALUES (?, ?, ?)", sessions)
+    conn.executemany("INSERT OR IGNORE INTO messages (id, session_id, sender_id, message, timestamp) VALUES (?, ?, ?, ?, ?)",
+                     rows)
+
+# Persist one message and return its new id (waits for the commit)
+@timed
+def insert_message(session_id, sender_id, message, timestamp):
+    shard = get_message_shard(session_id)
+    if shard is None:
+        return write(_insert_message, session_id, sender_id, message, timestamp, wait=True)
+    return shard.write(_insert_shard_message, shard.index, shard.count, _session_participants([session_id]),
+                       session_id, sender_id, message, timestamp, wait=True)
+
+def _insert_message(conn, session_id, sender_id, message, timestamp):
+    c = conn.execute("INSERT INTO messages (session_id, sender_id, message, timestamp) VALUES (?, ?, ?, ?)",
+                     (session_id, sender_id, message, timestamp))
+    return c.lastrowid
+
+# A shard hands out ids congruent to its index (mod the shard count) and above
+# every id it holds or has held, so ids stay unique across shards without a
+# shared counter. A rebalance lifts every shard's floor above the highest id
+# anywhere, which keeps that true under the new layout.
+def _insert_shard_message(conn, index, count, sessions, session_id, sender_id, message, timestamp):
+    conn.executemany("INSERT OR IGNORE INTO chat_sessions (id, user1_id, user2_id) VALUES (?, ?, ?)", sessions)
+    floor = _max_message_id(conn)
+    message_id = floor + 1 + (index - floor - 1) % count
+    conn.execute("INSERT INTO messages (id, session_id, sender_id, message, timestamp) VALUES (?, ?, ?, ?, ?)",
+                 (message_id, session_id, sender_id, message, timestamp))
+    return message_id
+
+def _max_message_id(conn):
+    return conn.execute("""
+        SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'messages'), 0),
+                   COALESCE((SELECT MAX(id) FROM messages), 0))
+    """).fetchone()[0]
+
+# Highest message id handed out so far (including deleted rows), over the
+# main database and every shard
+@timed
+def get_max_message_id():
+    with connection() as conn:
+        highest = _max_message_id(conn)
+    for shard in get_message_shards():
+        with shard.connection() as conn:
+            highest = max(highest, _max_message_id(conn))
+    return highest
+
+# Get messages of a session newer than the given message id
+@timed
+def get_new_messages(session_id, after_id=0):
+    with message_connection(session_id) as conn:
+        return conn.execute("""
+            SELECT id, sender_id, message, timestamp
+            FROM messages
+            WHERE session_id = ?
+            AND id > ?
+            ORDER BY id ASC
+        """, (session_id, after_id)).fetchall()
+
+# Get the latest messages of a session (optionally only those older than
+# before_id, for paging back through history), oldest first
+@timed
+def get_recent_messages(session_id, limit, before_id=None):
+    if before_id is None:
+        before_id = MAX_ROWID
+    with message_connection(session_id) as conn:
+        rows = conn.execute("""
+            SELECT id, sender_id, message, timestamp
+            FROM messages
+            WHERE session_id = ?
+            AND id < ?
+            ORDER BY id DESC
+            LIMIT ?
+        """, (session_id, before_id, limit)).fetchall()
+    rows.reverse()
+    return rows
+
+# Check if session is still active (served from the session cache)
+@timed
+def is_session_active(session_id):
+    state = get_session_state(session_id)
+    return state['active'] if state else False
+
+# Most recent active chat session of a user: (session_id, partner_id) or None
+@timed
+def get_active_chat(user_id):
+    with connection() as conn:
+        row = conn.execute("""
+            SELECT id, CASE WHEN user1_id = ? THEN user2_id ELSE user1_id END
+            FROM chat_sessions
+            WHERE active = TRUE AND (user1_id = ? OR user2_id = ?)
+            ORDER BY id DESC
+            LIMIT 1
+        """, (user_id, user_id, user_id)).fetchone()
+    return tuple(row) if row else None
+
+# End a chat session
+@timed
+def end_chat_session(session_id):
+    end_time = datetime.now()
+    _session_cache.end(session_id, end_time)
+    return write(_end_chat_session, session_id, end_time)
+
+def _end_chat_session(conn, session_id, end_time):
+    was_active = conn.execute("SELECT active FROM chat_sessions WHERE id = ?", (session_id,)).fetchone()
+    conn.execute("UPDATE chat_sessions SET active = FALSE, end_time = ? WHERE id = ?",
+                 (end_time, session_id))
+    if was_active and was_active[0]:
+        _count_sharded_messages(conn, [session_id])
+
+# End every active chat session a user is part of
+@timed
+def end_user_chat_sessions(user_id):
+    end_time = datetime.now()
+    _session_cache.end_for_user(user_id, end_time)
+    return write(_end_user_chat_sessions, user_id, end_time)
+
+def _end_user_chat_sessions(conn, user_id, end_time):
+    ended = conn.execute("UPDATE chat_sessions SET active = FALSE, end_time = ? WHERE active = TRUE AND (user1_id = ? OR user2_id = ?) RETURNING id",
+                         (end_time, user_id, user_id)).fetchall()
+    _count_sharded_messages(conn, [session_id for session_id, in ended])
+
+# The stats_session_ended trigger counts an ended session's messages in the
+# main database; with sharded messages, add what its shard holds instead.
+# Messages still queued on the shard's writer are waited for first (this runs
+# on the main writer's thread, which no shard write ever waits on).
+def _count_sharded_messages(conn, session_ids):
+    for shard, shard_session_ids in _group_by_shard(session_ids):
+        if shard is None:
+            return
+        shard.writer.flush()
+        with shard.connection() as shard_conn:
+            counts = shard_conn.execute("""
+                SELECT COUNT(*), session_id
+                FROM messages
+                WHERE session_id IN (SELECT value FROM json_each(?))
+                GROUP BY session_id
+            """, (json.dumps(shard_session_ids),)).fetchall()
+        conn.executemany("""
+            UPDATE stats_interest SET messages = messages + ?
+            WHERE (SELECT u1.interests_mask & u2.interests_mask
+                   FROM chat_sessions s
+                   JOIN users u1 ON u1.id = s.user1_id
+                   JOIN users u2 ON u2.id = s.user2_id
+                   WHERE s.id = ?) >> bit & 1
+        """, counts)
+
+# Ended chat sessions whose end_time is before `before`, oldest first:
+# (id, user1_id, user2_id, start_time, end_time) rows
+@timed
+def get_ended_sessions(before, limit):
+    with connection() as conn:
+        return conn.execute("""
+            SELECT id, user1_id, user2_id, start_time, end_time
+            FROM chat_sessions
+            WHERE active = FALSE AND end_time < ?
+            ORDER BY end_time
+            LIMIT ?
+        """, (before, limit)).fetchall()
+
+# Messages of several chat sessions: (session_id, id, sender_id, message,
+# timestamp) rows ordered by session then id
+@timed
+def get_session_messages(session_ids):
+    rows = []
+    for shard, shard_session_ids in _group_by_shard(session_ids):
+        with (shard.connection() if shard else connection()) as conn:
+            rows += conn.execute("""
+                SELECT session_id, id, sender_id, message, timestamp
+                FROM messages
+                WHERE session_id IN (SELECT value FROM json_each(?))
+                ORDER BY session_id, id
+            """, (json.dumps(shard_session_ids),)).fetchall()
+    rows.sort(key=lambda row: (row[0], row[1]))
+    return rows
+
+# Remove ended chat sessions and their messages from the live tables
+@timed
+def delete_chat_sessions(session_ids):
+    deleted, session_ids = write(_delete_chat_sessions, json.dumps(list(session_ids)), wait=True)
+    for shard, shard_session_ids in _group_by_shard(session_ids):
+        if shard is not None:
+            deleted += shard.write(_delete_shard_sessions, json.dumps(shard_session_ids), wait=True)
+    return deleted
+
+# Returns (messages deleted, ids of the sessions deleted)
+def _delete_chat_sessions(conn, session_ids_json):
+    ended = "SELECT id FROM chat_sessions WHERE active = FALSE AND id IN (SELECT value FROM json_each(?))"
+    deleted = conn.execute(f"DELETE FROM messages WHERE session_id IN ({ended})", (session_ids_json,)).rowcount
+    session_ids = [row[0] for row in conn.execute(f"DELETE FROM chat_sessions WHERE id IN ({ended}) RETURNING id",
+                                                  (session_ids_json,))]
+    return deleted, session_ids
+
+def _delete_shard_sessions(conn, session_ids_json):
+    deleted = conn.execute("DELETE FROM messages WHERE session_id IN (SELECT value FROM json_each(?))",
+                           (session_ids_json,)).rowcount
+    conn.execute("DELETE FROM chat_sessions WHERE id IN (SELECT value FROM json_each(?))", (session_ids_json,))
+    return deleted
+
+# Full-text search over every chat's messages (match_query is FTS5 query
+# syntax, see search.build_match_query): the best `limit` matches as (id,
+# session_id, sender_id, timestamp, snippet, rank) rows, best first. Matched
+# terms in the snippet are wrapped in \x02 ... \x03 so the caller can escape
+# the text before highlighting.
+# With sharded messages every shard ranks its own matches and the results are
+# merged (BM25 statistics are per shard, which evens out as hashing spreads
+# sessions alike).
+@timed
+def search_messages(match_query, limit):
+    rows = []
+    for shard in get_message_shards() or [None]:
+        with (shard.connection() if shard else connection()) as conn:
+            rows += _search(conn, match_query, limit)
+    rows.sort(key=lambda row: (row[5], -row[0]))
+    return rows[:limit]
+
+def _search(conn, match_query, limit):
+    return conn.execute("""
+        SELECT m.id, m.session_id, m.sender_id, m.timestamp,
+               snippet(messages_fts, 0, char(2), char(3), '…', 12),
+               bm25(messages_fts, 1.0, 0.0) AS rank
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        WHERE messages_fts MATCH ?
+        ORDER BY rank, m.id DESC
+        LIMIT ?
+    """, (match_query, limit)).fetchall()
+
+# Ids of a user's chat sessions in the live tables
+@timed
+def get_user_session_ids(user_id):
+    with connection() as conn:
+        return [row[0] for row in conn.execute("""
+            SELECT id FROM chat_sessions WHERE user1_id = ?
+            UNION
+            SELECT id FROM chat_sessions WHERE user2_id = ?
+        """, (user_id, user_id))]
+
+# Rebuild the search index from the messages table (of every shard)
+def rebuild_search_index():
+    for shard in get_message_shards():
+        shard.write(_rebuild_search_index, wait=True)
+    return write(_rebuild_search_index, wait=True)
+
+def _rebuild_search_index(conn):
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+
+# Dashboard rollups, maintained by triggers (see migration 8).
+# Per-minute activity since `since` ('YYYY-MM-DD HH:MM', UTC):
+# (minute, sessions_started, sessions_ended, messages) rows, oldest first
+@timed
+def get_minutely_stats(since):
+    with connection() as conn:
+        rows = conn.execute("""
+            SELECT minute, sessions_started, sessions_ended, messages
+            FROM stats_minutely
+            WHERE minute >= ?
+            ORDER BY minute
+        """, (since,)).fetchall()
+    shards = get_message_shards()
+    if not shards:
+        return rows
+
+    # Message shards count their own messages
+    minutes = {minute: counts for minute, *counts in rows}
+    for shard in shards:
+        with shard.connection() as conn:
+            for minute, messages in conn.execute("SELECT minute, messages FROM stats_minutely WHERE minute >= ?",
+                                                 (since,)):
+                minutes.setdefault(minute, [0, 0, 0])[2] += messages
+    return [(minute, *counts) for minute, counts in sorted(minutes.items())]
+
+# Ended sessions by length: (max_seconds, sessions) rows, -1 being the
+# open-ended bucket
+@timed
+def get_session_length_stats():
+    with connection() as conn:
+        return conn.execute("SELECT max_seconds, sessions FROM stats_session_length ORDER BY max_seconds").fetchall()
+
+# Ended sessions and their message counts per shared interest:
+# (bit, sessions, messages) rows
+@timed
+def get_interest_stats():
+    with connection() as conn:
+        return conn.execute("SELECT bit, sessions, messages FROM stats_interest ORDER BY bit").fetchall()
+
+# Store a login token (only its hash) until expires_at (unix seconds)
+@timed
+def save_login_token(token_hash, user_id, expires_at):
+    return write(_save_login_token, token_hash, user_id, expires_at)
+
+def _save_login_token(conn, token_hash, user_id, expires_at):
+    conn.execute("INSERT OR REPLACE INTO login_tokens (token_hash, user_id, expires_at) VALUES (?, ?, ?)",
+                 (token_hash, user_id, expires_at))
+
+# User id behind a stored, unexpired login token, or None
+@timed
+def get_login_token_user_id(token_hash, now):
+    flush_writes()
+    with connection() as conn:
+        row = conn.execute("SELECT user_id FROM login_tokens WHERE token_hash = ? AND expires_at > ?",
+                           (token_hash, now)).fetchone()
+    return row[0] if row else None
+
+@timed
+def delete_login_token(token_hash):
+    return write(_delete_login_token, token_hash)
+
+def _delete_login_token(conn, token_hash):
+    conn.execute("DELETE FROM login_tokens WHERE token_hash = ?", (token_hash,))
+
+# Delete login tokens that expired by `now` (unix seconds); returns how many
+@timed
+def purge_login_tokens(now):
+    return write(_purge_login_tokens, now, wait=True)
+
+def _purge_login_tokens(conn, now):
+    return conn.execute("DELETE FROM login_tokens WHERE expires_at <= ?", (now,)).rowcount
+
+# Read an app-wide setting, storing `default` first if it is missing
+@timed
+def get_or_create_setting(key, default):
+    return write(_get_or_create_setting, key, default, wait=True)
+
+def _get_or_create_setting(conn, key, default):
+    conn.execute("INSERT OR IGNORE INTO app_settings (key, value) VALUES (?, ?)", (key, default))
+    return conn.execute("SELECT value FROM app_settings WHERE key = ?", (key,)).fetchone()[0]
+
+# Shared matchmaking pool (CHAT_APP_BACKEND=sqlite).
+# A request is a dict: user, status ('waiting' or 'matched'), partner (the
+# partner's user dict), session_id and created_at (unix seconds).
+def _match_request_from_row(row):
+    user, status, partner, session_id, created_at = row
+    return {
+        'user': json.loads(user),
+        'status': status,
+        'partner': json.loads(partner) if partner else None,
+        'session_id': session_id,
+        'created_at': created_at,
+    }
+
+# Add a user to the pool unless they are already waiting or matched;
+# returns their request
+@timed
+def enqueue_match_request(user, created_at):
+    return write(_enqueue_match_request, user, created_at, wait=True)
+
+def _enqueue_match_request(conn, user, created_at):
+    conn.execute("INSERT OR IGNORE INTO match_queue (user_id, user, created_at) VALUES (?, ?, ?)",
+                 (user['id'], json.dumps(user), created_at))
+    return _match_request_from_row(conn.execute(
+        "SELECT user, status, partner, session_id, created_at FROM match_queue WHERE user_id = ?",
+        (user['id'],)).fetchone())
+
+@timed
+def get_match_request(user_id):
+    with connection() as conn:
+        row = conn.execute("SELECT user, status, partner, session_id, created_at FROM match_queue WHERE user_id = ?",
+                           (user_id,)).fetchone()
+    return _match_request_from_row(row) if row else None
+
+# Remove a user's request (only if it has the given status, when given) and
+# return it, or None if there was nothing to remove
+@timed
+def delete_match_request(user_id, status=None, wait=True):
+    return write(_delete_match_request, user_id, status, wait=wait)
+
+def _delete_match_request(conn, user_id, status):
+    row = conn.execute("""
+        DELETE FROM match_queue
+        WHERE user_id = ? AND (? IS NULL OR status = ?)
+        RETURNING user, status, partner, session_id, created_at
+    """, (user_id, status, status)).fetchone()
+    return _match_request_from_row(row) if row else None
+
+@timed
+def count_match_requests(status='waiting'):
+    with connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM match_queue WHERE status = ?", (status,)).fetchone()[0]
+
+# Pair the waiting pool in one write transaction, so concurrent rounds in
+# other processes can't hand out the same user twice.
+# pair(requests) gets the waiting requests and returns (user, user) pairs;
+# each pair gets a chat session and both requests are marked matched.
+# With seen_since (unix seconds), only users whose presence heartbeat is that
+# recent are offered to pair. Returns (session_id, user1_id, user2_id) for
+# the new sessions.
+@timed
+def match_waiting_users(pair, seen_since=None):
+    sessions = write(_match_waiting_users, pair, datetime.now(), seen_since, wait=True)
+    for session_id, user1_id, user2_id in sessions:
+        _session_cache.put(session_id, user1_id, user2_id, True)
+    return sessions
+
+def _match_waiting_users(conn, pair, start_time, seen_since=None):
+    requests = [_match_request_from_row(row) for row in conn.execute("""
+        SELECT q.user, q.status, q.partner, q.session_id, q.created_at
+        FROM match_queue q
+        LEFT JOIN presence p ON p.user_id = q.user_id
+        WHERE q.status = 'waiting' AND (? IS NULL OR p.last_seen >= ?)
+        ORDER BY q.created_at
+    """, (seen_since, seen_since))]
+    sessions = []
+    for first, second in pair(requests):
+        session_id = _insert_chat_session(conn, first['id'], second['id'], start_time)
+        for user, partner in ((first, second), (second, first)):
+            conn.execute("UPDATE match_queue SET status = 'matched', partner = ?, session_id = ? WHERE user_id = ?",
+                         (json.dumps(partner), session_id, user['id']))
+        sessions.append((session_id, first['id'], second['id']))
+    return sessions
+
+# Shared presence (CHAT_APP_BACKEND=sqlite); last_seen is unix seconds
+@timed
+def touch_presence(user, last_seen):
+    return write(_touch_presence, user, last_seen)
+
+def _touch_presence(conn, user, last_seen):
+    conn.execute("""
+        INSERT INTO presence (user_id, user, gender, preference, last_seen) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET last_seen = excluded.last_seen
+    """, (user['id'], json.dumps(user), user['gender'], user['preference'], last_seen))
+
+@timed
+def remove_presence(user_id):
+    return write(_remove_presence, user_id)
+
+def _remove_presence(conn, user_id):
+    conn.execute("DELETE FROM presence WHERE user_id = ?", (user_id,))
+
+@timed
+def get_last_seen(user_id):
+    with connection() as conn:
+        row = conn.execute("SELECT last_seen FROM presence WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else None
+
+@timed
+def count_present_users():
+    with connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM presence").fetchone()[0]
+
+# Remove users last seen before `before` and return their user dicts; the
+# delete claims them, so each is returned to exactly one process
+@timed
+def expire_presence(before):
+    return write(_expire_presence, before, wait=True)
+
+def _expire_presence(conn, before):
+    rows = conn.execute("DELETE FROM presence WHERE last_seen < ? RETURNING user", (before,)).fetchall()
+    return [json.loads(row[0]) for row in rows]
@@ -0,0 +1,22 @@
+# Fixed interest vocabulary.
+# Each interest owns one bit of users.interests_mask, so shared interests
+# between two users are popcount(mask_a & mask_b).
+INTERESTS = ["Music", "Sports", "Movies", "Books", "Travel", "Food", "Art", "Technology", "Gaming", "Fitness"]
+
+INTEREST_BITS = {interest: 1 << i for i, interest in enumerate(INTERESTS)}
+
+def encode_interests(interests):
+    mask = 0
+    for interest in interests:
+        mask |= INTEREST_BITS.get(interest, 0)
+    return mask
+
+def decode_interests(mask):
+    return [interest for interest in INTERESTS if mask & INTEREST_BITS[interest]]
+
+def overlap(mask_a, mask_b):
+    return (mask_a & mask_b).bit_count()
+
+# SQL expression counting the set bits of `column` (SQLite has no popcount)
+def popcount_sql(column):
+    return ' + '.join(f"(({column} >> {i}) & 1)" for i in range(len(INTERESTS)))
@@ -0,0 +1,155 @@
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from database import (
+    delete_login_token,
+    get_active_chat,
+    get_login_token_user_id,
+    get_or_create_setting,
+    get_user,
+    save_login_token,
+)
+from matchmaking import partner_info
+
+# How long a login token stays valid, and how long a resolved token is
+# served from memory before SQLite is consulted again
+TOKEN_LIFETIME = 7 * 24 * 3600  # seconds
+CACHE_TTL = 15 * 60             # seconds
+CACHE_SIZE = 100000
+
+_secret = None
+_secret_lock = threading.Lock()
+
+# Signing key: CHAT_APP_SECRET, or one generated once and kept in SQLite so
+# every process (and restart) agrees on it
+def _signing_key():
+    global _secret
+    with _secret_lock:
+        if _secret is None:
+            secret = os.environ.get('CHAT_APP_SECRET') or get_or_create_setting('token_secret', secrets.token_hex(32))
+            _secret = secret.encode()
+        return _secret
+
+def _sign(payload):
+    digest = hmac.new(_signing_key(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+def _token_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+# Token -> {'user', 'chat', 'expires_at', 'cached_until'}.
+# 'chat' is the active chat ({'session_id', 'partner'}) or None, so a
+# returning browser gets its user and conversation back from one lookup.
+class TokenCache:
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            if entry['cached_until'] < time.time():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return entry
+
+    def put(self, token, user, chat, expires_at):
+        entry = {
+            'user': user,
+            'chat': chat,
+            'expires_at': expires_at,
+            'cached_until': min(expires_at, time.time() + CACHE_TTL),
+        }
+        with self._lock:
+            self._entries[token] = entry
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def set_chat(self, token, chat):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                entry['chat'] = chat
+
+    def discard(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+
+_cache = TokenCache()
+
+# Create a signed login token for a user
+def issue_token(user):
+    expires_at = int(time.time()) + TOKEN_LIFETIME
+    payload = f"{user['id']}.{expires_at}.{secrets.token_urlsafe(16)}"
+    token = f"{payload}.{_sign(payload)}"
+    save_login_token(_token_hash(token), user['id'], expires_at)
+    _cache.put(token, user, None, expires_at)
+    return token
+
+# Check the token's signature and expiry without touching any storage.
+# Signatures are compared as bytes: compare_digest refuses non-ASCII str.
+def _verify(token):
+    try:
+        user_id, expires_at, nonce, signature = token.split('.')
+        user_id, expires_at = int(user_id), int(expires_at)
+        signature = signature.encode()
+    except (AttributeError, ValueError):
+        return None
+    if not hmac.compare_digest(signature, _sign(f"{user_id}.{expires_at}.{nonce}").encode()):
+        return None
+    if expires_at <= time.time():
+        return None
+    return user_id, expires_at
+
+# Resolve a token to {'user', 'chat'}; None if invalid, expired or revoked
+def resolve_token(token):
+    verified = _verify(token)
+    if verified is None:
+        return None
+
+    entry = _cache.get(token)
+    if entry is not None:
+        return entry
+
+    # Not cached (other process, restart or expired entry): fall back to SQLite
+    user_id, expires_at = verified
+    if get_login_token_user_id(_token_hash(token), int(time.time())) != user_id:
+        return None
+    user = get_user(user_id)
+    if user is None:
+        return None
+
+    chat = None
+    active = get_active_chat(user_id)
+    if active is not None:
+        session_id, partner_id = active
+        partner = get_user(partner_id)
+        if partner is not None:
+            chat = {'session_id': session_id, 'partner': partner_info(user, partner)}
+    return _cache.put(token, user, chat, expires_at)
+
+# Remember (or clear, with session_id None) the chat a token's user is in
+def remember_chat(token, session_id=None, partner=None):
+    if token is None:
+        return
+    chat = {'session_id': session_id, 'partner': partner} if session_id is not None else None
+    _cache.set_chat(token, chat)
+
+# Log a token out everywhere
+def revoke_token(token):
+    if token is None:
+        return
+    _cache.discard(token)
+    delete_login_token(_token_hash(token))
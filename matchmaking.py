@@ -0,0 +1,534 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from itertools import combinations
+
+from coordination import get_backend, get_redis
+from database import (
+    count_match_requests,
+    delete_match_request,
+    end_chat_session,
+    enqueue_match_request,
+    get_match_request,
+    match_waiting_users,
+    start_chat_session,
+    start_chat_sessions,
+)
+from interests import decode_interests, encode_interests, overlap
+from metrics import increment, registry, timed
+
+logger = logging.getLogger(__name__)
+
+# Seconds between batch matchmaking rounds. Set CHAT_APP_MATCH_INTERVAL=0 to
+# pair each user the moment they ask instead.
+ROUND_INTERVAL = float(os.environ.get('CHAT_APP_MATCH_INTERVAL', '0.25'))
+# Shared interests a batch round tells apart; partners sharing more than this
+# rank the same (see pair_tickets)
+MATCH_INTEREST_DEPTH = 3
+
+# (gender, preference) buckets a user is willing to be matched with.
+# Mirrors the rules encoded in find_match's SQL: the user who is searching
+# decides, exactly as find_match does for whoever clicks first.
+def target_buckets(gender, preference):
+    if preference == 'Straight':
+        target_gender = 'Female' if gender == 'Male' else 'Male'
+        return {(target_gender, 'Straight'), (target_gender, 'Bisexual')}
+    elif preference == 'Gay':
+        return {('Male', 'Gay'), ('Male', 'Bisexual')}
+    elif preference == 'Lesbian':
+        return {('Female', 'Lesbian'), ('Female', 'Bisexual')}
+    else:  # Bisexual
+        return {('Male', 'Bisexual'), ('Male', 'Gay'),
+                ('Female', 'Bisexual'), ('Female', 'Lesbian')}
+
+def interests_mask(user):
+    mask = user.get('interests_mask')
+    return encode_interests(user['interests']) if mask is None else mask
+
+# Partner details handed to the UI (same shape find_match returns)
+def partner_info(user, other):
+    return {
+        'id': other['id'],
+        'username': other['username'],
+        'gender': other['gender'],
+        'preference': other['preference'],
+        'common_interests': decode_interests(interests_mask(user) & interests_mask(other))
+    }
+
+# A user's place in the waiting pool.
+# status is 'waiting' until someone claims it, then 'matched' with the chat
+# session and partner filled in, or 'cancelled' if the user gave up.
+class MatchTicket:
+    def __init__(self, user):
+        self.user = user
+        self.mask = interests_mask(user)
+        self.status = 'waiting'
+        self.partner = None
+        self.session_id = None
+        self.created_at = time.time()
+
+    @property
+    def matched(self):
+        return self.status == 'matched'
+
+# Whether two (gender, preference) buckets may be paired in a batch round.
+# Either user's find_match rule is enough, as on the per-click path where
+# whoever searches decides.
+def compatible_buckets(a, b):
+    return b in target_buckets(*a) or a in target_buckets(*b)
+
+# Every submask of an interests mask with at most `depth` interests (cached:
+# waiters share a few hundred distinct masks at most)
+@functools.lru_cache(maxsize=4096)
+def _submasks(mask, depth):
+    bits = [1 << bit for bit in range(mask.bit_length()) if mask >> bit & 1]
+    return tuple(sum(combination) for size in range(min(depth, len(bits)) + 1)
+                 for combination in combinations(bits, size))
+
+# Oldest ticket in the queue that is not paired yet (paired ones are dropped)
+def _next_free(queue, paired):
+    while queue and queue[0].user['id'] in paired:
+        queue.popleft()
+    return queue[0] if queue else None
+
+# Pair waiting tickets, heaviest edges first.
+# An edge joins two compatible users and weighs their shared interest count.
+# Taking the heaviest remaining edge each time is the greedy 1/2-approximation
+# of maximum-weight matching (exact blossom matching is O(n³) in the number of
+# waiters). Edges are never listed: every ticket is indexed under each subset
+# of its interests, and subsets are visited largest first, pairing compatible
+# users found under the same subset. Two users still unpaired when their
+# largest shared subset comes up therefore share exactly that many interests.
+# Only subsets of up to `depth` interests are indexed (176 per user with all
+# ten instead of 1024), so users sharing `depth` or more rank the same, and a
+# round costs O(waiters × subsets per user) instead of O(waiters²).
+# Among equally good partners the longest-waiting users are paired first.
+def pair_tickets(tickets, depth=MATCH_INTEREST_DEPTH):
+    index = {}  # bucket -> {interests subset: deque of MatchTickets, oldest first}
+    for ticket in sorted(tickets, key=lambda t: t.created_at):
+        queues = index.setdefault((ticket.user['gender'], ticket.user['preference']), {})
+        for submask in _submasks(ticket.mask, depth):
+            queue = queues.get(submask)
+            if queue is None:
+                queue = queues[submask] = deque()
+            queue.append(ticket)
+
+    buckets = sorted(index)
+    queue_pairs = [(index[a], index[b]) for i, a in enumerate(buckets) for b in buckets[i:] if compatible_buckets(a, b)]
+    submasks = sorted({submask for queues in index.values() for submask in queues}, key=lambda m: (-m.bit_count(), m))
+
+    paired = set()
+    pairs = []
+    for submask in submasks:
+        for left_queues, right_queues in queue_pairs:
+            left = left_queues.get(submask)
+            right = right_queues.get(submask)
+            if not left or not right:
+                continue
+            while True:
+                first = _next_free(left, paired)
+                if first is None:
+                    break
+                left.popleft()
+                second = _next_free(right, paired)
+                if second is None:
+                    left.appendleft(first)
+                    break
+                right.popleft()
+                paired.update((first.user['id'], second.user['id']))
+                pairs.append((first, second))
+    return pairs
+
+# Process-wide matchmaking pool.
+# Waiting users are kept in FIFO buckets keyed by (gender, preference). In
+# batch mode a scheduler thread pairs the whole pool every ROUND_INTERVAL
+# seconds (see pair_tickets), so matchmaking costs one pass per round rather
+# than one query per click. A round pairs a snapshot of the pool without
+# holding the lock, which every waiting screen's poll needs. In instant mode
+# an arriving user only inspects the heads of the handful of buckets
+# compatible with them. Either way, claiming waiting users and removing them
+# from the pool happens under one lock, so each ticket is paired exactly once.
+class Matchmaker:
+    def __init__(self, round_interval=ROUND_INTERVAL):
+        self.round_interval = round_interval
+        self.is_alive = None  # user id -> whether their page is still open (set by presence)
+        self._lock = threading.Lock()
+        self._waiting = {}   # (gender, preference) -> OrderedDict[user_id, MatchTicket]
+        self._tickets = {}   # user_id -> MatchTicket (waiting or recently matched)
+
+    @property
+    def batched(self):
+        return self.round_interval > 0
+
+    # Join the pool; in instant mode get paired right away if someone
+    # compatible is waiting
+    @timed(family='matchmaking')
+    def request_match(self, user):
+        with self._lock:
+            ticket = self._tickets.get(user['id'])
+            if ticket is not None and ticket.status in ('waiting', 'matched'):
+                return ticket
+
+            ticket = MatchTicket(user)
+            candidate = None if self.batched else self._claim_candidate(user)
+            if candidate is None:
+                self._tickets[user['id']] = ticket
+                self._bucket(user).setdefault(user['id'], ticket)
+                return ticket
+
+        # Create the chat session outside the lock; the candidate is already
+        # out of the pool so nobody else can claim them meanwhile
+        try:
+            session_id = start_chat_session(candidate.user['id'], user['id'])
+        except Exception:
+            with self._lock:
+                self._requeue(candidate)
+            raise
+
+        with self._lock:
+            abandoned = self._tickets.get(candidate.user['id']) is not candidate
+            if not abandoned:
+                ticket.status = candidate.status = 'matched'
+                ticket.session_id = candidate.session_id = session_id
+                ticket.partner = partner_info(user, candidate.user)
+                candidate.partner = partner_info(candidate.user, user)
+                self._tickets[user['id']] = ticket
+
+        if abandoned:
+            # The candidate cancelled while the session was being created
+            end_chat_session(session_id)
+            return self.request_match(user)
+        return ticket
+
+    # Current ticket for a user, or None if they are not in the pool
+    def poll(self, user_id):
+        with self._lock:
+            return self._tickets.get(user_id)
+
+    # Forget a user's ticket once the UI has picked up the match
+    def acknowledge(self, user_id):
+        with self._lock:
+            ticket = self._tickets.get(user_id)
+            if ticket is not None and ticket.status == 'matched':
+                del self._tickets[user_id]
+
+    # Leave the pool
+    def cancel(self, user_id):
+        with self._lock:
+            ticket = self._tickets.pop(user_id, None)
+            if ticket is None:
+                return
+            if ticket.status == 'waiting':
+                self._bucket(ticket.user).pop(user_id, None)
+                ticket.status = 'cancelled'
+
+    # Pair everyone currently waiting in one pass; returns the number of pairs
+    @timed(family='matchmaking')
+    def run_round(self):
+        with self._lock:
+            tickets = [ticket for bucket in self._waiting.values() for ticket in bucket.values()]
+        tickets = self._drop_gone(tickets)
+
+        # Claim the pairs whose users are both still waiting; anyone who
+        # cancelled meanwhile leaves their partner for the next round
+        pairs = []
+        proposed = pair_tickets(tickets)
+        with self._lock:
+            for first, second in proposed:
+                if self._queued(first) and self._queued(second):
+                    del self._bucket(first.user)[first.user['id']]
+                    del self._bucket(second.user)[second.user['id']]
+                    pairs.append((first, second))
+        if not pairs:
+            return 0
+
+        # Create the chat sessions outside the lock; the paired users are
+        # already out of the pool so nobody else can claim them meanwhile
+        try:
+            session_ids = start_chat_sessions([(first.user['id'], second.user['id']) for first, second in pairs])
+        except Exception:
+            with self._lock:
+                for first, second in pairs:
+                    self._requeue(first)
+                    self._requeue(second)
+            raise
+
+        abandoned = []
+        with self._lock:
+            for (first, second), session_id in zip(pairs, session_ids):
+                first_left = self._tickets.get(first.user['id']) is not first
+                second_left = self._tickets.get(second.user['id']) is not second
+                if first_left or second_left:
+                    # Someone cancelled while the session was being created;
+                    # the other goes back to the pool for the next round
+                    abandoned.append(session_id)
+                    if not first_left:
+                        self._requeue(first)
+                    if not second_left:
+                        self._requeue(second)
+                    continue
+                first.status = second.status = 'matched'
+                first.session_id = second.session_id = session_id
+                first.partner = partner_info(first.user, second.user)
+                second.partner = partner_info(second.user, first.user)
+
+        for session_id in abandoned:
+            end_chat_session(session_id)
+        increment('matches', len(pairs) - len(abandoned))
+        return len(pairs) - len(abandoned)
+
+    def waiting_count(self):
+        with self._lock:
+            return sum(len(bucket) for bucket in self._waiting.values())
+
+    def _bucket(self, user):
+        return self._waiting.setdefault((user['gender'], user['preference']), OrderedDict())
+
+    # Leave out (and cancel) the tickets of users whose page has closed, so
+    # nobody is dropped into a chat with them before the presence sweep
+    def _drop_gone(self, tickets):
+        if self.is_alive is None:
+            return tickets
+        alive = []
+        for ticket in tickets:
+            if self.is_alive(ticket.user['id']):
+                alive.append(ticket)
+            else:
+                self.cancel(ticket.user['id'])
+        return alive
+
+    # Whether a ticket is in the pool; caller holds the lock
+    def _queued(self, ticket):
+        bucket = self._waiting.get((ticket.user['gender'], ticket.user['preference']))
+        return bucket is not None and bucket.get(ticket.user['id']) is ticket
+
+    # Put a still-waiting ticket back in the pool; caller holds the lock
+    def _requeue(self, ticket):
+        if self._tickets.get(ticket.user['id']) is ticket:
+            self._bucket(ticket.user)[ticket.user['id']] = ticket
+
+    # Pop the best waiting candidate: the longest-waiting user of each
+    # compatible bucket, preferring the one with most shared interests.
+    # Heads whose page has closed are dropped from the pool on the way.
+    def _claim_candidate(self, user):
+        best = None
+        best_bucket = None
+        best_score = -1
+        user_mask = interests_mask(user)
+        for target in sorted(target_buckets(user['gender'], user['preference'])):
+            bucket = self._waiting.get(target)
+            head = self._live_head(bucket)
+            if head is None or head.user['id'] == user['id']:
+                continue
+            score = overlap(user_mask, head.mask)
+            if score > best_score:
+                best, best_bucket, best_score = head, bucket, score
+        if best is None:
+            return None
+        del best_bucket[best.user['id']]
+        return best
+
+    # Longest-waiting ticket of a bucket whose user is still there; caller
+    # holds the lock
+    def _live_head(self, bucket):
+        while bucket:
+            head = next(iter(bucket.values()))
+            if self.is_alive is None or self.is_alive(head.user['id']):
+                return head
+            del bucket[head.user['id']]
+            self._tickets.pop(head.user['id'], None)
+            head.status = 'cancelled'
+        return None
+
+# Ticket for a shared-pool request (see enqueue_match_request for its shape)
+def _ticket_from_request(request):
+    ticket = MatchTicket(request['user'])
+    ticket.status = request['status']
+    ticket.session_id = request['session_id']
+    ticket.created_at = request['created_at']
+    if request['partner'] is not None:
+        ticket.partner = partner_info(request['user'], request['partner'])
+    return ticket
+
+# Pair shared-pool requests with pair_tickets, leaving out users whose page
+# has closed (the presence sweep takes them out of the pool); returns
+# (user, user) pairs
+def _pair_requests(requests, is_alive=None):
+    tickets = [_ticket_from_request(request) for request in requests
+               if is_alive is None or is_alive(request['user']['id'])]
+    return [(first.user, second.user) for first, second in pair_tickets(tickets)]
+
+# Matchmaking pool kept in the database (CHAT_APP_BACKEND=sqlite), so users
+# of every app process on the host wait in one pool. Each process runs
+# rounds; a round is a single write transaction (see match_waiting_users),
+# which SQLite's write lock serializes across processes.
+class SqliteMatchmaker:
+    def __init__(self, round_interval=ROUND_INTERVAL):
+        self.round_interval = round_interval
+        # Seconds without a heartbeat in the presence table before a waiting
+        # user is left out of rounds (set by presence.get_presence)
+        self.waiting_ttl = None
+
+    @property
+    def batched(self):
+        return self.round_interval > 0
+
+    @timed(family='matchmaking')
+    def request_match(self, user):
+        request = enqueue_match_request(user, time.time())
+        if request['status'] == 'waiting' and not self.batched:
+            self.run_round()
+            return self.poll(user['id']) or _ticket_from_request(request)
+        return _ticket_from_request(request)
+
+    def poll(self, user_id):
+        request = get_match_request(user_id)
+        return _ticket_from_request(request) if request else None
+
+    def acknowledge(self, user_id):
+        delete_match_request(user_id, 'matched', wait=False)
+
+    def cancel(self, user_id):
+        delete_match_request(user_id)
+
+    def waiting_count(self):
+        return count_match_requests()
+
+    @timed(family='matchmaking')
+    def run_round(self):
+        # Cheap read first, so idle rounds don't take the write lock
+        if count_match_requests() < 2:
+            return 0
+        seen_since = time.time() - self.waiting_ttl if self.waiting_ttl is not None else None
+        sessions = match_waiting_users(_pair_requests, seen_since)
+        increment('matches', len(sessions))
+        return len(sessions)
+
+# Only replace both tickets if neither changed since the round read them
+_CLAIM_PAIR = """
+if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[3] or redis.call('HGET', KEYS[1], ARGV[2]) ~= ARGV[4] then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[5], ARGV[2], ARGV[6])
+return 1
+"""
+
+# Release the round lock only if this process still holds it
+_RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Matchmaking pool kept in Redis (CHAT_APP_BACKEND=redis).
+# Requests live in one hash (user id -> JSON, same shape as the SQLite pool).
+# Every process runs rounds, but a short-lived lock lets only one at a time
+# pair the pool; each pair is then claimed with a compare-and-set, so a user
+# who cancelled while their session was being created is not matched.
+class RedisMatchmaker:
+    TICKETS_KEY = 'chat:match:tickets'
+    ROUND_LOCK_KEY = 'chat:match:round'
+    ROUND_LOCK_MS = 10000
+
+    def __init__(self, round_interval=ROUND_INTERVAL):
+        self.round_interval = round_interval
+        self.is_alive = None
+        self._redis = get_redis()
+        self._claim_pair = self._redis.register_script(_CLAIM_PAIR)
+        self._release_lock = self._redis.register_script(_RELEASE_LOCK)
+
+    @property
+    def batched(self):
+        return self.round_interval > 0
+
+    @timed(family='matchmaking')
+    def request_match(self, user):
+        request = {'user': user, 'status': 'waiting', 'partner': None, 'session_id': None, 'created_at': time.time()}
+        if not self._redis.hsetnx(self.TICKETS_KEY, user['id'], json.dumps(request)):
+            return self.poll(user['id']) or self.request_match(user)
+        if not self.batched:
+            self.run_round()
+            return self.poll(user['id']) or _ticket_from_request(request)
+        return _ticket_from_request(request)
+
+    def poll(self, user_id):
+        raw = self._redis.hget(self.TICKETS_KEY, user_id)
+        return _ticket_from_request(json.loads(raw)) if raw else None
+
+    def acknowledge(self, user_id):
+        ticket = self.poll(user_id)
+        if ticket is not None and ticket.matched:
+            self._redis.hdel(self.TICKETS_KEY, user_id)
+
+    def cancel(self, user_id):
+        self._redis.hdel(self.TICKETS_KEY, user_id)
+
+    def waiting_count(self):
+        return sum(1 for raw in self._redis.hvals(self.TICKETS_KEY) if json.loads(raw)['status'] == 'waiting')
+
+    @timed(family='matchmaking')
+    def run_round(self):
+        token = uuid.uuid4().hex
+        if not self._redis.set(self.ROUND_LOCK_KEY, token, nx=True, px=self.ROUND_LOCK_MS):
+            return 0  # another process is running this round
+        try:
+            raw_requests = {}
+            for raw in self._redis.hvals(self.TICKETS_KEY):
+                request = json.loads(raw)
+                if request['status'] == 'waiting':
+                    raw_requests[request['user']['id']] = (raw, request)
+            pairs = _pair_requests([request for raw, request in raw_requests.values()], self.is_alive)
+            if not pairs:
+                return 0
+            session_ids = start_chat_sessions([(first['id'], second['id']) for first, second in pairs])
+
+            matched = 0
+            for (first, second), session_id in zip(pairs, session_ids):
+                (first_raw, first_request), (second_raw, second_request) = raw_requests[first['id']], raw_requests[second['id']]
+                updates = [dict(request, status='matched', partner=partner, session_id=session_id)
+                           for request, partner in ((first_request, second), (second_request, first))]
+                if self._claim_pair(keys=[self.TICKETS_KEY],
+                                    args=[first['id'], second['id'], first_raw, second_raw,
+                                          json.dumps(updates[0]), json.dumps(updates[1])]):
+                    matched += 1
+                else:
+                    # Someone cancelled while the session was being created;
+                    # the other stays in the pool for the next round
+                    end_chat_session(session_id)
+            increment('matches', matched)
+            return matched
+        finally:
+            self._release_lock(keys=[self.ROUND_LOCK_KEY], args=[token])
+
+def _round_loop(matchmaker):
+    while True:
+        time.sleep(matchmaker.round_interval)
+        try:
+            matchmaker.run_round()
+        except Exception:
+            logger.exception("Matchmaking round failed")
+
+_matchmaker = None
+_matchmaker_lock = threading.Lock()
+
+def get_matchmaker():
+    global _matchmaker
+    with _matchmaker_lock:
+        if _matchmaker is None:
+            backend = get_backend()
+            if backend == 'sqlite':
+                _matchmaker = SqliteMatchmaker()
+            elif backend == 'redis':
+                _matchmaker = RedisMatchmaker()
+            else:
+                _matchmaker = Matchmaker()
+            registry.register_gauge('waiting_users', _matchmaker.waiting_count)
+            if _matchmaker.batched:
+                threading.Thread(target=_round_loop, args=(_matchmaker,), name='matchmaking-rounds', daemon=True).start()
+        return _matchmaker
@@ -0,0 +1,268 @@
+import json
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+
+from coordination import get_backend, get_redis
+from database import (
+    flush_writes,
+    get_max_message_id,
+    get_new_messages,
+    get_recent_messages,
+    insert_message,
+    insert_messages,
+    message_participants,
+)
+from metrics import timed
+from rate_limit import get_limiter
+
+# Messages kept in memory per chat session
+RING_SIZE = 500
+# Chat sessions kept in memory before the least recently used is dropped
+MAX_SESSIONS = 10000
+# Seconds a chat session's messages stay in Redis after its last message
+REDIS_SESSION_TTL = 24 * 60 * 60
+
+def _timestamp():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+# Recent messages of one chat session.
+# Every message of the session with id > floor is in `messages`, so a reader
+# whose cursor is at or past floor can be served without touching SQLite.
+class _SessionBuffer:
+    def __init__(self, messages, floor):
+        self.messages = deque(messages, maxlen=RING_SIZE)
+        self.floor = floor
+
+    def append(self, message):
+        if len(self.messages) == self.messages.maxlen:
+            self.floor = self.messages[0][0]
+        self.messages.append(message)
+
+    # Messages newer than after_id, walking back only over the new ones
+    def after(self, after_id):
+        newer = []
+        for message in reversed(self.messages):
+            if message[0] <= after_id:
+                break
+            newer.append(message)
+        newer.reverse()
+        return newer
+
+# Process-wide chat message bus.
+# Senders publish into the session's ring buffer and the partner's next poll
+# reads it straight from memory. Message ids are allocated here, so the id
+# cursor used by the chat screen stays valid, and rows are handed to the
+# database writer, which persists them in the background (write-behind).
+# The lock is shared by every chat in the process, so nothing that can touch
+# SQLite (flushes, loading a buffer, seeding the id counter) runs under it.
+class MessageBus:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # chat session id -> _SessionBuffer
+        self._last_id = None
+
+    # Deliver a message to the session and queue it for persistence
+    @timed(family='bus')
+    def publish(self, session_id, sender_id, text):
+        timestamp = _timestamp()
+        participants = message_participants([session_id])
+        if self._last_id is None:
+            self._seed_ids()
+        while True:
+            buffer = self._buffer(session_id)
+            with self._lock:
+                if self._sessions.get(session_id) is not buffer:
+                    continue  # evicted while loading; load it again
+                self._last_id += 1
+                message = (self._last_id, sender_id, text, timestamp)
+                buffer.append(message)
+                insert_messages([(message[0], session_id, sender_id, text, timestamp)], participants=participants)
+            return message
+
+    # Messages of a session with id greater than after_id, oldest first
+    @timed(family='bus')
+    def fetch(self, session_id, after_id=0):
+        buffer = self._buffer(session_id)
+        with self._lock:
+            if after_id >= buffer.floor:
+                return buffer.after(after_id)
+            recent = list(buffer.messages)
+
+        # Cursor is older than the ring buffer: read the gap from SQLite once
+        # pending writes are in, then top it up with anything published since
+        self.flush()
+        messages = get_new_messages(session_id, after_id)
+        last_id = messages[-1][0] if messages else after_id
+        messages.extend(m for m in recent if m[0] > last_id)
+        return messages
+
+    # Wait until every published message is in SQLite
+    def flush(self):
+        flush_writes()
+
+    # Start the id counter past every id in the database (first publish in
+    # this process)
+    def _seed_ids(self):
+        self.flush()
+        last_id = get_max_message_id()
+        with self._lock:
+            if self._last_id is None:
+                self._last_id = last_id
+
+    # Get (or load) a session's buffer; takes the lock itself
+    def _buffer(self, session_id):
+        with self._lock:
+            buffer = self._sessions.get(session_id)
+            if buffer is not None:
+                self._sessions.move_to_end(session_id)
+                return buffer
+
+        # First use in this process: seed from SQLite once everything
+        # already published has been written. Anything published to the
+        # session meanwhile went into a buffer another thread loaded, which
+        # then wins.
+        self.flush()
+        recent = get_recent_messages(session_id, RING_SIZE)
+        floor = recent[0][0] - 1 if len(recent) == RING_SIZE else 0
+        with self._lock:
+            buffer = self._sessions.get(session_id)
+            if buffer is None:
+                buffer = self._sessions[session_id] = _SessionBuffer(recent, floor)
+                if len(self._sessions) > MAX_SESSIONS:
+                    self._sessions.popitem(last=False)
+            return buffer
+
+# Message fan-out through the database (CHAT_APP_BACKEND=sqlite).
+# Several app processes can't share in-memory ring buffers or an id counter,
+# so SQLite allocates each message id and every poll reads the session's new
+# rows back (an index range scan on (session_id, id)).
+class SqliteMessageBus:
+    @timed(family='bus')
+    def publish(self, session_id, sender_id, text):
+        timestamp = _timestamp()
+        return (insert_message(session_id, sender_id, text, timestamp), sender_id, text, timestamp)
+
+    @timed(family='bus')
+    def fetch(self, session_id, after_id=0):
+        return get_new_messages(session_id, after_id)
+
+    def flush(self):
+        flush_writes()
+
+# Allocate the next message id and add the message to the session's ring,
+# atomically, so readers never see a later id before an earlier one. Returns
+# -1 if the id counter is missing (new or restarted Redis) and needs seeding.
+_PUBLISH = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+local id = redis.call('INCR', KEYS[1])
+redis.call('ZADD', KEYS[2], id, id .. ':' .. ARGV[1])
+local excess = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[2])
+if excess > 0 then
+    local dropped = redis.call('ZRANGE', KEYS[2], excess - 1, excess - 1, 'WITHSCORES')
+    redis.call('SET', KEYS[3], dropped[2])
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, excess - 1)
+end
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('EXPIRE', KEYS[3], ARGV[3])
+return id
+"""
+
+# Message fan-out through Redis (CHAT_APP_BACKEND=redis).
+# Works like MessageBus with the ring buffers and id counter moved to Redis:
+# each session's recent messages are a sorted set scored by id, with a floor
+# key once it has been trimmed, and rows are still persisted write-behind by
+# the publishing process.
+class RedisMessageBus:
+    ID_KEY = 'chat:message_id'
+
+    def __init__(self):
+        self._redis = get_redis()
+        self._publish = self._redis.register_script(_PUBLISH)
+
+    @staticmethod
+    def _keys(session_id):
+        return f'chat:messages:{session_id}', f'chat:messages:{session_id}:floor'
+
+    @staticmethod
+    def _decode(member):
+        message_id, payload = member.split(':', 1)
+        sender_id, text, timestamp = json.loads(payload)
+        return (int(message_id), sender_id, text, timestamp)
+
+    @timed(family='bus')
+    def publish(self, session_id, sender_id, text):
+        timestamp = _timestamp()
+        payload = json.dumps([sender_id, text, timestamp])
+        ring_key, floor_key = self._keys(session_id)
+        while True:
+            message_id = self._publish(keys=[self.ID_KEY, ring_key, floor_key],
+                                       args=[payload, RING_SIZE, REDIS_SESSION_TTL])
+            if message_id != -1:
+                break
+            # Seed the counter past every id already in the database
+            self.flush()
+            self._redis.set(self.ID_KEY, get_max_message_id(), nx=True)
+        insert_messages([(message_id, session_id, sender_id, text, timestamp)])
+        return (message_id, sender_id, text, timestamp)
+
+    @timed(family='bus')
+    def fetch(self, session_id, after_id=0):
+        ring_key, floor_key = self._keys(session_id)
+        pipe = self._redis.pipeline()
+        pipe.exists(ring_key)
+        pipe.get(floor_key)
+        pipe.zrangebyscore(ring_key, f'({after_id}', '+inf')
+        exists, floor, members = pipe.execute()
+        recent = [self._decode(member) for member in members]
+        if exists and after_id >= int(floor or 0):
+            return recent
+
+        # Nothing in Redis for this session, or the cursor is older than the
+        # ring: read the gap from SQLite and top it up from the ring
+        self.flush()
+        messages = get_new_messages(session_id, after_id)
+        last_id = messages[-1][0] if messages else after_id
+        messages.extend(m for m in recent if m[0] > last_id)
+        return messages
+
+    def flush(self):
+        flush_writes()
+
+_message_bus = None
+_message_bus_lock = threading.Lock()
+
+def get_message_bus():
+    global _message_bus
+    with _message_bus_lock:
+        if _message_bus is None:
+            backend = get_backend()
+            if backend == 'sqlite':
+                _message_bus = SqliteMessageBus()
+            elif backend == 'redis':
+                _message_bus = RedisMessageBus()
+            else:
+                _message_bus = MessageBus()
+        return _message_bus
+
+# Send a message to a chat session
+def send_message(session_id, sender_id, message):
+    return get_message_bus().publish(session_id, sender_id, message)
+
+# Send a message unless the sender or the chat is over its send rate, or the
+# database writer is backed up (raises RateLimited)
+def send_message_limited(session_id, sender_id, message):
+    get_limiter().acquire(sender_id, session_id)
+    return send_message(session_id, sender_id, message)
+
+# Messages of a chat session newer than the given message id
+def fetch_messages(session_id, after_id=0):
+    return get_message_bus().fetch(session_id, after_id)
+
+# Page of history older than before_id (for "load earlier messages"), or
+# the latest messages when before_id is None (to open a chat with)
+def fetch_earlier_messages(session_id, before_id, limit):
+    flush_writes()
+    return get_recent_messages(session_id, limit, before_id=before_id)
@@ -0,0 +1,172 @@
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Set CHAT_APP_METRICS=0 to turn recording off; instrumented calls then cost
+# one flag check
+_enabled = os.environ.get('CHAT_APP_METRICS', '1') != '0'
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+def is_enabled():
+    return _enabled
+
+def set_enabled(enabled):
+    global _enabled
+    _enabled = enabled
+
+# Latency histogram with Prometheus-style cumulative buckets
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+
+    # Upper bound of the bucket holding the given quantile
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+        return float('inf')
+
+# Process-wide metric registry.
+# Histograms are keyed by (family, name), e.g. ('db', 'find_match') or
+# ('phase', 'render'); counters by name; gauges are callables read on export.
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def observe(self, family, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get((family, name))
+            if histogram is None:
+                histogram = self._histograms[(family, name)] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def register_gauge(self, name, read):
+        with self._lock:
+            self._gauges[name] = read
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    # Rows for the admin view: one per histogram
+    def summary(self):
+        with self._lock:
+            items = sorted(self._histograms.items())
+            return [{
+                'family': family,
+                'name': name,
+                'count': histogram.count,
+                'mean_ms': histogram.sum / histogram.count * 1000 if histogram.count else 0.0,
+                'p50_ms': histogram.quantile(0.5) * 1000,
+                'p99_ms': histogram.quantile(0.99) * 1000,
+            } for (family, name), histogram in items]
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def gauges(self):
+        with self._lock:
+            gauges = dict(self._gauges)
+        values = {}
+        for name, read in sorted(gauges.items()):
+            try:
+                values[name] = read()
+            except Exception:
+                values[name] = float('nan')
+        return values
+
+    # Prometheus text exposition format
+    def export_prometheus(self):
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        families = {}
+        for (family, name), histogram in histograms:
+            families.setdefault(family, []).append((name, histogram))
+        for family, entries in families.items():
+            metric = f'chat_app_{family}_seconds'
+            lines.append(f'# TYPE {metric} histogram')
+            for name, histogram in entries:
+                cumulative = 0
+                for bound, n in zip(BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += n
+                    lines.append(f'{metric}_bucket{{name="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{name="{name}"}} {histogram.sum}')
+                lines.append(f'{metric}_count{{name="{name}"}} {histogram.count}')
+
+        for name, value in counters:
+            lines.append(f'# TYPE chat_app_{name}_total counter')
+            lines.append(f'chat_app_{name}_total {value}')
+
+        for name, value in self.gauges().items():
+            lines.append(f'# TYPE chat_app_{name} gauge')
+            lines.append(f'chat_app_{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+# Decorator recording a function's latency under (family, function name)
+def timed(func=None, *, family='db', name=None):
+    if func is None:
+        return functools.partial(timed, family=family, name=name)
+    metric_name = name or func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            registry.observe(family, metric_name, time.perf_counter() - started)
+    return wrapper
+
+# Context manager timing one phase of a script run
+@contextmanager
+def phase(name):
+    if not _enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe('phase', name, time.perf_counter() - started)
+
+def increment(name, amount=1):
+    if _enabled:
+        registry.increment(name, amount)
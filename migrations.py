@@ -0,0 +1,340 @@
+import sqlite3
+
+from interests import encode_interests
+
+# Versioned schema migrations.
+# The schema version lives in PRAGMA user_version; each migration brings the
+# database from version N-1 to N and runs in its own write transaction, so a
+# database that is already current costs one PRAGMA read at startup.
+
+# Add a column unless it is already there (pre-versioning databases)
+def _add_column(c, table, column_def):
+    try:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column_def}")
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+
+def _create_messages_table(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS messages
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  session_id INTEGER,
+                  sender_id INTEGER,
+                  message TEXT,
+                  timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  read BOOLEAN DEFAULT FALSE)''')
+
+# Version 1: base tables
+def _create_tables(c):
+    # Users table with online status
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  username TEXT UNIQUE,
+                  password TEXT,
+                  gender TEXT,
+                  preference TEXT,
+                  interests TEXT,
+                  online BOOLEAN DEFAULT FALSE,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+    # Chat sessions table
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_sessions
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user1_id INTEGER,
+                  user2_id INTEGER,
+                  start_time TIMESTAMP,
+                  end_time TIMESTAMP,
+                  active BOOLEAN DEFAULT TRUE)''')
+
+    # Messages table
+    _create_messages_table(c)
+
+    # Active sessions table for matching
+    c.execute('''CREATE TABLE IF NOT EXISTS active_sessions
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  session_key TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+    # Columns added after the first release
+    _add_column(c, 'users', 'online BOOLEAN DEFAULT FALSE')
+    _add_column(c, 'chat_sessions', 'active BOOLEAN DEFAULT TRUE')
+    _add_column(c, 'messages', 'read BOOLEAN DEFAULT FALSE')
+
+# Version 2: indexes for matching, message polling and session lookups
+def _create_indexes(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_online_gender_pref ON users (online, gender, preference)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_session_id ON messages (session_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chat_sessions_active_users ON chat_sessions (active, user1_id, user2_id)")
+
+# Version 3: interests as a bitmask for popcount-based overlap scoring
+def _add_interests_mask(c):
+    _add_column(c, 'users', 'interests_mask INTEGER NOT NULL DEFAULT 0')
+    for (interests,) in c.execute("SELECT DISTINCT interests FROM users WHERE interests != ''").fetchall():
+        c.execute("UPDATE users SET interests_mask = ? WHERE interests = ?",
+                  (encode_interests(interests.split(',')), interests))
+
+# Version 4: persistent login tokens and app-wide settings (signing secret)
+def _create_login_tokens(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS login_tokens
+                 (token_hash TEXT PRIMARY KEY,
+                  user_id INTEGER NOT NULL,
+                  expires_at INTEGER NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_login_tokens_user ON login_tokens (user_id)")
+    c.execute('''CREATE TABLE IF NOT EXISTS app_settings
+                 (key TEXT PRIMARY KEY,
+                  value TEXT)''')
+
+# Version 5: find ended sessions by age for archiving
+def _index_ended_sessions(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chat_sessions_ended ON chat_sessions (active, end_time)")
+
+# Version 6: matchmaking pool and presence shared between app processes
+# (used when CHAT_APP_BACKEND=sqlite)
+def _create_shared_state(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS match_queue
+                 (user_id INTEGER PRIMARY KEY,
+                  user TEXT NOT NULL,
+                  status TEXT NOT NULL DEFAULT 'waiting',
+                  partner TEXT,
+                  session_id INTEGER,
+                  created_at REAL NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_match_queue_status ON match_queue (status, created_at)")
+    c.execute('''CREATE TABLE IF NOT EXISTS presence
+                 (user_id INTEGER PRIMARY KEY,
+                  user TEXT NOT NULL,
+                  gender TEXT,
+                  preference TEXT,
+                  last_seen REAL NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_presence_last_seen ON presence (last_seen)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_presence_gender_pref ON presence (gender, preference)")
+
+# Version 7: full-text search over messages.
+# messages_fts is an external-content FTS5 index over a view that adds each
+# message's participants ("u<user1_id> u<user2_id>"), so a search scoped to
+# one user is an index intersection rather than a filter over every hit.
+# Triggers keep it in step with the messages table.
+def _create_message_search(c):
+    c.execute('''CREATE VIEW IF NOT EXISTS messages_search_content AS
+                 SELECT m.id AS id,
+                        m.message AS message,
+                        'u' || s.user1_id || ' u' || s.user2_id AS participants
+                 FROM messages m JOIN chat_sessions s ON s.id = m.session_id''')
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5
+                 (message, participants,
+                  content = 'messages_search_content', content_rowid = 'id')''')
+    participants = "(SELECT 'u' || user1_id || ' u' || user2_id FROM chat_sessions WHERE id = {}.session_id)"
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                      INSERT INTO messages_fts (rowid, message, participants)
+                      VALUES (new.id, new.message, {participants.format('new')});
+                  END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                      INSERT INTO messages_fts (messages_fts, rowid, message, participants)
+                      VALUES ('delete', old.id, old.message, {participants.format('old')});
+                  END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+                      INSERT INTO messages_fts (messages_fts, rowid, message, participants)
+                      VALUES ('delete', old.id, old.message, {participants.format('old')});
+                      INSERT INTO messages_fts (rowid, message, participants)
+                      VALUES (new.id, new.message, {participants.format('new')});
+                  END''')
+    c.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+# Upper bounds (seconds) of the session length histogram buckets; longer
+# sessions land in an open-ended bucket stored as -1
+SESSION_LENGTH_BUCKETS = [30, 60, 120, 300, 600, 1800, 3600]
+
+# Minute a rollup row is counted in (UTC, when the row was written)
+_NOW_MINUTE = "strftime('%Y-%m-%d %H:%M', 'now')"
+
+def _length_bucket(seconds):
+    return "CASE " + ' '.join(f"WHEN {seconds} <= {bound} THEN {bound}" for bound in SESSION_LENGTH_BUCKETS) + " ELSE -1 END"
+
+def _create_rollup_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_minutely
+                 (minute TEXT PRIMARY KEY,
+                  sessions_started INTEGER NOT NULL DEFAULT 0,
+                  sessions_ended INTEGER NOT NULL DEFAULT 0,
+                  messages INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_session_length
+                 (max_seconds INTEGER PRIMARY KEY,
+                  sessions INTEGER NOT NULL DEFAULT 0)''')
+    # One row per interest bit (see interests.py); a session counts towards
+    # every interest its two users share
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_interest
+                 (bit INTEGER PRIMARY KEY,
+                  sessions INTEGER NOT NULL DEFAULT 0,
+                  messages INTEGER NOT NULL DEFAULT 0)''')
+
+# messages_only: just the per-minute message count (message shards)
+def _create_rollup_triggers(c, messages_only=False):
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS stats_message_sent AFTER INSERT ON messages BEGIN
+                      INSERT INTO stats_minutely (minute, messages) VALUES ({_NOW_MINUTE}, 1)
+                      ON CONFLICT (minute) DO UPDATE SET messages = messages + 1;
+                  END''')
+    if messages_only:
+        return
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS stats_session_started AFTER INSERT ON chat_sessions BEGIN
+                      INSERT INTO stats_minutely (minute, sessions_started) VALUES ({_NOW_MINUTE}, 1)
+                      ON CONFLICT (minute) DO UPDATE SET sessions_started = sessions_started + 1;
+                  END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS stats_session_ended AFTER UPDATE OF active ON chat_sessions
+                  WHEN old.active AND NOT new.active BEGIN
+                      INSERT INTO stats_minutely (minute, sessions_ended) VALUES ({_NOW_MINUTE}, 1)
+                      ON CONFLICT (minute) DO UPDATE SET sessions_ended = sessions_ended + 1;
+                      INSERT INTO stats_session_length (max_seconds, sessions)
+                      VALUES ({_length_bucket("(julianday(new.end_time) - julianday(new.start_time)) * 86400")}, 1)
+                      ON CONFLICT (max_seconds) DO UPDATE SET sessions = sessions + 1;
+                      INSERT INTO stats_interest (bit, sessions, messages)
+                      SELECT bits.value, 1, (SELECT COUNT(*) FROM messages WHERE session_id = new.id)
+                      FROM json_each('{list(range(63))}') bits
+                      WHERE (SELECT u1.interests_mask & u2.interests_mask
+                             FROM users u1, users u2
+                             WHERE u1.id = new.user1_id AND u2.id = new.user2_id) >> bits.value & 1
+                      ON CONFLICT (bit) DO UPDATE SET sessions = sessions + 1, messages = messages + excluded.messages;
+                  END''')
+
+# Count the history that is already there
+def _backfill_rollups(c, messages_only=False):
+    c.execute('''INSERT INTO stats_minutely (minute, messages)
+                 SELECT strftime('%Y-%m-%d %H:%M', timestamp), COUNT(*)
+                 FROM messages WHERE timestamp IS NOT NULL GROUP BY 1
+                 ON CONFLICT (minute) DO UPDATE SET messages = messages + excluded.messages''')
+    if messages_only:
+        return
+    c.execute('''INSERT INTO stats_minutely (minute, sessions_started)
+                 SELECT strftime('%Y-%m-%d %H:%M', start_time, 'utc'), COUNT(*)
+                 FROM chat_sessions WHERE start_time IS NOT NULL GROUP BY 1
+                 ON CONFLICT (minute) DO UPDATE SET sessions_started = sessions_started + excluded.sessions_started''')
+    c.execute('''INSERT INTO stats_minutely (minute, sessions_ended)
+                 SELECT strftime('%Y-%m-%d %H:%M', end_time, 'utc'), COUNT(*)
+                 FROM chat_sessions WHERE NOT active AND end_time IS NOT NULL GROUP BY 1
+                 ON CONFLICT (minute) DO UPDATE SET sessions_ended = sessions_ended + excluded.sessions_ended''')
+    c.execute(f'''INSERT INTO stats_session_length (max_seconds, sessions)
+                  SELECT {_length_bucket("(julianday(end_time) - julianday(start_time)) * 86400")}, COUNT(*)
+                  FROM chat_sessions WHERE NOT active AND end_time IS NOT NULL GROUP BY 1
+                  ON CONFLICT (max_seconds) DO UPDATE SET sessions = sessions + excluded.sessions''')
+    c.execute(f'''INSERT INTO stats_interest (bit, sessions, messages)
+                  SELECT bits.value, COUNT(*), SUM(counts.messages)
+                  FROM (SELECT s.id, u1.interests_mask & u2.interests_mask AS shared,
+                               (SELECT COUNT(*) FROM messages WHERE session_id = s.id) AS messages
+                        FROM chat_sessions s
+                        JOIN users u1 ON u1.id = s.user1_id
+                        JOIN users u2 ON u2.id = s.user2_id
+                        WHERE NOT s.active AND s.end_time IS NOT NULL) counts,
+                       json_each('{list(range(63))}') bits
+                  WHERE counts.shared >> bits.value & 1
+                  GROUP BY bits.value
+                  ON CONFLICT (bit) DO UPDATE SET sessions = sessions + excluded.sessions,
+                                                  messages = messages + excluded.messages''')
+
+# Version 8: rollup tables for the admin dashboard.
+# Triggers fold each session start, session end and message into small
+# aggregate tables, so the dashboard reads a bounded number of rows however
+# much history there is. Minutes are UTC (the time the row was written).
+# Rollups only ever count up: archiving sessions leaves them in place.
+def _create_rollups(c):
+    _create_rollup_tables(c)
+    _create_rollup_triggers(c)
+    _backfill_rollups(c)
+
+# Version 9: find expired login tokens to purge
+def _index_login_token_expiry(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_login_tokens_expires_at ON login_tokens (expires_at)")
+
+# Version 10: find a user's chat sessions (to scope their searches)
+def _index_session_users(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chat_sessions_user1 ON chat_sessions (user1_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chat_sessions_user2 ON chat_sessions (user2_id)")
+
+MIGRATIONS = [
+    _create_tables,
+    _create_indexes,
+    _add_interests_mask,
+    _create_login_tokens,
+    _index_ended_sessions,
+    _create_shared_state,
+    _create_message_search,
+    _create_rollups,
+    _index_login_token_expiry,
+    _index_session_users,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Message shard databases (CHAT_APP_MESSAGE_SHARDS, see database.py) hold the
+# messages of the sessions hashed to them, the participants of those sessions
+# (all the search index needs from chat_sessions), their own search index and
+# per-minute message counts. They are versioned separately from the main
+# database.
+def _create_message_shard(c):
+    _create_messages_table(c)
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_sessions
+                 (id INTEGER PRIMARY KEY,
+                  user1_id INTEGER,
+                  user2_id INTEGER)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_session_id ON messages (session_id, id)")
+    _create_message_search(c)
+    _create_rollup_tables(c)
+    _create_rollup_triggers(c, messages_only=True)
+
+SHARD_MIGRATIONS = [
+    _create_message_shard,
+]
+
+# Triggers keeping derived data (the search index and the dashboard rollups)
+# in step with users, chat_sessions and messages. Bulk loads drop them and
+# then restore them (or rebuild everything) once at the end, which is far
+# cheaper than firing them row by row.
+DERIVED_TRIGGERS = [
+    'messages_fts_insert', 'messages_fts_delete', 'messages_fts_update',
+    'stats_session_started', 'stats_session_ended', 'stats_message_sent',
+]
+
+def drop_derived_triggers(c):
+    for trigger in DERIVED_TRIGGERS:
+        c.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+# Make the messages table hand out ids above `highest` from now on (after
+# bulk loads that insert ids of their own into the main database or shards)
+def raise_message_sequence(c, highest):
+    if not c.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'messages'", (highest,)).rowcount:
+        c.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('messages', ?)", (highest,))
+
+# Recreate the triggers and rebuild the search index, leaving the rollups as
+# they are (for loads that only move existing rows around)
+def restore_derived_triggers(c, shard=False):
+    _create_message_search(c)
+    _create_rollup_triggers(c, messages_only=shard)
+
+# Recreate the triggers and recompute the search index and rollups from scratch
+def rebuild_derived_data(c, shard=False):
+    for table in ('stats_minutely', 'stats_session_length', 'stats_interest'):
+        c.execute(f"DELETE FROM {table}")
+    restore_derived_triggers(c, shard)
+    _backfill_rollups(c, messages_only=shard)
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+# Apply every pending migration, returning the resulting version
+def migrate(conn, migrations=MIGRATIONS):
+    current = get_schema_version(conn)
+    if current >= len(migrations):
+        return current
+
+    for version, migration in enumerate(migrations, start=1):
+        # Take the write lock before re-checking so concurrent starters
+        # don't apply the same migration twice
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            migration(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    return get_schema_version(conn)
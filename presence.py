@@ -0,0 +1,209 @@
+import functools
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from coordination import get_backend, get_redis
+from database import (
+    count_present_users,
+    end_user_chat_sessions,
+    expire_presence,
+    get_last_seen,
+    remove_presence,
+    set_user_offline,
+    touch_presence,
+)
+from matchmaking import get_matchmaker
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Seconds without a heartbeat before a user counts as gone
+PRESENCE_TTL = 30
+# Seconds between sweeps for expired users
+SWEEP_INTERVAL = 5
+# Shared backends store a user's heartbeat at most this often per process
+HEARTBEAT_WRITE_INTERVAL = 5
+# Waiting screens heartbeat every second, so a waiting user not seen for this
+# long has closed the page; matchmaking skips them rather than wait for the
+# sweep
+WAITING_TTL = 2 * HEARTBEAT_WRITE_INTERVAL
+
+# In-memory presence map fed by UI heartbeats.
+# Users are kept in heartbeat order, so expiring them only looks at the
+# oldest entries.
+class PresenceTracker:
+    def __init__(self, ttl=PRESENCE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._last_seen = OrderedDict()  # user_id -> (monotonic time, user)
+
+    # Record that a user's page is still open
+    def heartbeat(self, user):
+        now = time.monotonic()
+        with self._lock:
+            self._last_seen[user['id']] = (now, user)
+            self._last_seen.move_to_end(user['id'])
+
+    # Forget a user right away (logout)
+    def leave(self, user_id):
+        with self._lock:
+            self._remove(user_id)
+
+    def is_alive(self, user_id, ttl=None):
+        with self._lock:
+            entry = self._last_seen.get(user_id)
+        return entry is not None and time.monotonic() - entry[0] < (ttl or self.ttl)
+
+    def alive_count(self):
+        with self._lock:
+            return len(self._last_seen)
+
+    # Drop users whose last heartbeat is older than the TTL and return them
+    def expire(self):
+        cutoff = time.monotonic() - self.ttl
+        expired = []
+        with self._lock:
+            while self._last_seen:
+                user_id, (seen, user) = next(iter(self._last_seen.items()))
+                if seen >= cutoff:
+                    break
+                self._remove(user_id)
+                expired.append(user)
+        return expired
+
+    def _remove(self, user_id):
+        self._last_seen.pop(user_id, None)
+
+# Presence kept in the database (CHAT_APP_BACKEND=sqlite), so every app
+# process sees the same live users. Heartbeats are wall-clock times and are
+# written at most every HEARTBEAT_WRITE_INTERVAL seconds per user; expiring
+# deletes the stale rows in one write, so each expired user is handed to
+# exactly one process's sweep.
+class SqlitePresenceTracker:
+    def __init__(self, ttl=PRESENCE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._written = {}  # user_id -> time this process last stored a heartbeat
+
+    def heartbeat(self, user):
+        now = time.time()
+        with self._lock:
+            if now - self._written.get(user['id'], 0) < HEARTBEAT_WRITE_INTERVAL:
+                return
+            self._written[user['id']] = now
+        self._touch(user, now)
+
+    def leave(self, user_id):
+        with self._lock:
+            self._written.pop(user_id, None)
+        self._remove(user_id)
+
+    def is_alive(self, user_id, ttl=None):
+        seen = get_last_seen(user_id)
+        return seen is not None and time.time() - seen < (ttl or self.ttl)
+
+    def alive_count(self):
+        return count_present_users()
+
+    def expire(self):
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            self._written = {user_id: seen for user_id, seen in self._written.items() if seen >= cutoff}
+        return self._expire(cutoff)
+
+    def _touch(self, user, now):
+        touch_presence(user, now)
+
+    def _remove(self, user_id):
+        remove_presence(user_id)
+
+    def _expire(self, cutoff):
+        return expire_presence(cutoff)
+
+# Claim every user last seen before the cutoff and return their user JSON
+_EXPIRE = """
+local users = {}
+for _, user_id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1])) do
+    redis.call('ZREM', KEYS[1], user_id)
+    local user = redis.call('HGET', KEYS[2], user_id)
+    if user then
+        users[#users + 1] = user
+        redis.call('HDEL', KEYS[2], user_id)
+    end
+end
+return users
+"""
+
+# Presence kept in Redis (CHAT_APP_BACKEND=redis): a sorted set of last
+# heartbeat times and a hash of user details.
+class RedisPresenceTracker(SqlitePresenceTracker):
+    SEEN_KEY = 'chat:presence'
+    USERS_KEY = 'chat:presence:users'
+
+    def __init__(self, ttl=PRESENCE_TTL):
+        super().__init__(ttl)
+        self._redis = get_redis()
+        self._expire_script = self._redis.register_script(_EXPIRE)
+
+    def is_alive(self, user_id, ttl=None):
+        seen = self._redis.zscore(self.SEEN_KEY, user_id)
+        return seen is not None and time.time() - seen < (ttl or self.ttl)
+
+    def alive_count(self):
+        return self._redis.zcard(self.SEEN_KEY)
+
+    def _touch(self, user, now):
+        pipe = self._redis.pipeline()
+        pipe.zadd(self.SEEN_KEY, {user['id']: now})
+        pipe.hset(self.USERS_KEY, user['id'], json.dumps(user))
+        pipe.execute()
+
+    def _remove(self, user_id):
+        pipe = self._redis.pipeline()
+        pipe.zrem(self.SEEN_KEY, user_id)
+        pipe.hdel(self.USERS_KEY, user_id)
+        pipe.execute()
+
+    def _expire(self, cutoff):
+        return [json.loads(raw) for raw in self._expire_script(keys=[self.SEEN_KEY, self.USERS_KEY], args=[cutoff])]
+
+# Take expired users offline, out of the waiting pool and out of their chats
+def sweep(tracker):
+    for user in tracker.expire():
+        set_user_offline(user['id'])
+        get_matchmaker().cancel(user['id'])
+        end_user_chat_sessions(user['id'])
+
+def _sweep_loop(tracker):
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        try:
+            sweep(tracker)
+        except Exception:
+            logger.exception("Presence sweep failed")
+
+_presence = None
+_presence_lock = threading.Lock()
+
+def get_presence():
+    global _presence
+    with _presence_lock:
+        if _presence is None:
+            backend = get_backend()
+            if backend == 'sqlite':
+                _presence = SqlitePresenceTracker()
+            elif backend == 'redis':
+                _presence = RedisPresenceTracker()
+            else:
+                _presence = PresenceTracker()
+            registry.register_gauge('online_users', _presence.alive_count)
+            if backend == 'sqlite':
+                # The shared pool checks heartbeats in its own round query
+                get_matchmaker().waiting_ttl = WAITING_TTL
+            else:
+                get_matchmaker().is_alive = functools.partial(_presence.is_alive, ttl=WAITING_TTL)
+            threading.Thread(target=_sweep_loop, args=(_presence,), name='presence-sweep', daemon=True).start()
+        return _presence
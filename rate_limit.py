@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from database import pending_writes
+from metrics import increment, registry
+
+# Token buckets in front of send_message: messages per second and burst size,
+# per user and per chat session
+USER_SEND_RATE = float(os.environ.get('CHAT_APP_SEND_RATE', '1'))
+USER_SEND_BURST = float(os.environ.get('CHAT_APP_SEND_BURST', '5'))
+SESSION_SEND_RATE = float(os.environ.get('CHAT_APP_SESSION_SEND_RATE', '2'))
+SESSION_SEND_BURST = float(os.environ.get('CHAT_APP_SESSION_SEND_BURST', '10'))
+# Writes queued for the database writer beyond which sends are refused
+WRITE_QUEUE_LIMIT = int(os.environ.get('CHAT_APP_WRITE_QUEUE_LIMIT', '5000'))
+# Buckets kept in memory before the least recently used is dropped (a dropped
+# bucket comes back full, which only ever errs towards letting a send through)
+MAX_BUCKETS = 100000
+
+# Raised when a send is refused. reason is 'rate' (the sender or the chat is
+# over its limit; retry_after says when the next send fits) or 'busy' (the
+# database writer is backed up)
+class RateLimited(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"send refused ({reason}), retry in {retry_after:.1f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until one token is available (0 if one is available now)
+    def wait_time(self):
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+# Per-user and per-session send limits.
+# A send takes a token from both the sender's bucket and the chat's bucket,
+# or from neither, so a refused send costs nothing.
+class SendLimiter:
+    def __init__(self, user_rate=USER_SEND_RATE, user_burst=USER_SEND_BURST,
+                 session_rate=SESSION_SEND_RATE, session_burst=SESSION_SEND_BURST,
+                 write_queue_limit=WRITE_QUEUE_LIMIT):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.write_queue_limit = write_queue_limit
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # ('user' | 'session', id) -> TokenBucket
+
+    # Take a send token for the user and the session, or raise RateLimited
+    def acquire(self, user_id, session_id):
+        if self.backpressured():
+            increment('sends_refused_busy')
+            raise RateLimited('busy', 1.0)
+
+        now = time.monotonic()
+        with self._lock:
+            buckets = [
+                self._bucket(('user', user_id), self.user_rate, self.user_burst),
+                self._bucket(('session', session_id), self.session_rate, self.session_burst),
+            ]
+            for bucket in buckets:
+                bucket.refill(now)
+            retry_after = max(bucket.wait_time() for bucket in buckets)
+            if retry_after == 0:
+                for bucket in buckets:
+                    bucket.tokens -= 1
+                return
+        increment('sends_rate_limited')
+        raise RateLimited('rate', retry_after)
+
+    # Global backpressure: a database writer (main or message shard) has too much queued
+    def backpressured(self):
+        return pending_writes() >= self.write_queue_limit
+
+    def _bucket(self, key, rate, burst):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+            if len(self._buckets) > MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def get_limiter():
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = SendLimiter()
+            registry.register_gauge('write_backpressure', lambda: int(_limiter.backpressured()))
+        return _limiter
@@ -0,0 +1,209 @@
+"""Full-text search over chat history (SQLite FTS5).
+
+Messages are indexed by triggers as they are written (see migration 7), and
+again when their session is archived (see archive.py), so a search covers the
+live tables and the archive alike. Searches are scoped to one user's chat
+sessions unless run by a moderator, ranked by BM25 and paginated, with
+matches highlighted in a snippet. A user's own messages are few enough to be
+indexed on the fly for each search; only moderators query the full indexes.
+
+    python search.py rebuild
+    python search.py query "pizza tonight" --user 42
+    python search.py bench --messages 10000000
+"""
+import html
+import re
+import sqlite3
+import sys
+import time
+
+from archive import get_archived_user_messages, search_archived_messages
+from database import get_session_messages, get_user_session_ids, rebuild_search_index, search_messages
+from metrics import timed
+
+# Results per page
+SEARCH_PAGE = 20
+
+_TERM = re.compile(r'\w+')
+
+# FTS5 query for free text typed by a user: every word must appear (the last
+# one as a prefix, for search-as-you-type). Words are quoted, so FTS5
+# operators and punctuation in the input are taken literally. Returns None if
+# there is nothing to find.
+def build_match_query(text):
+    terms = _TERM.findall(text)
+    if not terms:
+        return None
+    phrases = [f'message : "{term}"' for term in terms]
+    phrases[-1] += '*'
+    return ' AND '.join(phrases)
+
+# Escape a snippet and turn its match markers into <mark> tags
+def highlight(snippet):
+    return html.escape(snippet).replace('\x02', '<mark>').replace('\x03', '</mark>')
+
+# One page of search results, best match first.
+# user_id limits the search to that user's chat sessions (None searches every
+# chat, for moderators). Returns (results, has_more); each result is a dict
+# with the message id, session_id, sender_id, timestamp and snippet_html.
+@timed(family='search')
+def search(text, user_id=None, page=0, page_size=SEARCH_PAGE):
+    match_query = build_match_query(text)
+    if match_query is None:
+        return [], False
+    limit = (page + 1) * page_size + 1
+    if user_id is None:
+        # Top matches of the live tables and the archive, merged. A session
+        # being archived is briefly in both, hence the dict.
+        rows = {row[0]: row for row in search_archived_messages(match_query, limit)}
+        rows.update((row[0], row) for row in search_messages(match_query, limit))
+        rows = sorted(rows.values(), key=lambda row: (row[5], -row[0]))
+    else:
+        rows = _search_user_messages(match_query, limit, user_id)
+    rows = rows[page * page_size:]
+    results = [{
+        'id': message_id,
+        'session_id': session_id,
+        'sender_id': sender_id,
+        'timestamp': timestamp,
+        'snippet_html': highlight(snippet),
+    } for message_id, session_id, sender_id, timestamp, snippet, rank in rows[:page_size]]
+    return results, len(rows) > page_size
+
+# Search one user's messages, live and archived, through an in-memory index
+# of just those. A user has hundreds of messages, while in the full index a
+# common word or a short prefix matches millions (BM25 alone counts every
+# message holding each term), so this is the cheaper way to scope a search.
+def _search_user_messages(match_query, limit, user_id):
+    messages = {row[1]: row for row in get_archived_user_messages(user_id)}
+    messages.update((row[1], row) for row in get_session_messages(get_user_session_ids(user_id)))
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.execute("CREATE VIRTUAL TABLE messages_fts USING fts5 "
+                     "(message, session_id UNINDEXED, sender_id UNINDEXED, timestamp UNINDEXED)")
+        conn.executemany("INSERT INTO messages_fts (session_id, rowid, sender_id, message, timestamp) "
+                         "VALUES (?, ?, ?, ?, ?)", messages.values())
+        return conn.execute("""
+            SELECT rowid, session_id, sender_id, timestamp,
+                   snippet(messages_fts, 0, char(2), char(3), '…', 12),
+                   bm25(messages_fts) AS rank
+            FROM messages_fts
+            WHERE messages_fts MATCH ?
+            ORDER BY rank, rowid DESC
+            LIMIT ?
+        """, (match_query, limit)).fetchall()
+    finally:
+        conn.close()
+
+# Made-up words for synthetic chat text, most common first, with Zipf-like
+# cumulative weights (the word of rank r weighs 1/r) for rng.choices, so
+# text drawn from them has a few common words and many rare ones like real
+# chat. Returns (words, cum_weights).
+def zipf_vocabulary(rng, size=20000):
+    import itertools
+
+    syllables = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'po', 'da', 'fu']
+    vocabulary = sorted({''.join(rng.choices(syllables, k=rng.randint(2, 4))) for _ in range(size)})
+    rng.shuffle(vocabulary)
+    return vocabulary, list(itertools.accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))
+
+# Synthetic chat history for the benchmark: sessions of ~50 messages between
+# random users, words drawn from zipf_vocabulary
+def _generate_history(messages, users, seed):
+    import random
+
+    from database import transaction
+
+    rng = random.Random(seed)
+    vocabulary, cum_weights = zipf_vocabulary(rng)
+
+    message_id = 0
+    session_id = 0
+    with transaction() as conn:
+        while message_id < messages:
+            sessions, rows = [], []
+            while message_id < messages and len(rows) < 100000:
+                session_id += 1
+                user1, user2 = rng.sample(range(1, users + 1), 2)
+                sessions.append((session_id, user1, user2))
+                for _ in range(min(rng.randint(10, 90), messages - message_id)):
+                    message_id += 1
+                    text = ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(3, 12)))
+                    rows.append((message_id, session_id, rng.choice((user1, user2)), text))
+            conn.executemany("INSERT INTO chat_sessions (id, user1_id, user2_id, active) VALUES (?, ?, ?, FALSE)",
+                             sessions)
+            conn.executemany("INSERT INTO messages (id, session_id, sender_id, message) VALUES (?, ?, ?, ?)", rows)
+    return vocabulary
+
+def _bench(args):
+    import os
+    import random
+    import tempfile
+
+    from benchmark import percentile
+    from database import close_pool, init_db
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['CHAT_APP_DB'] = os.path.join(tmp, 'search_bench.db')
+        init_db()
+        started = time.perf_counter()
+        vocabulary = _generate_history(args.messages, args.users, args.seed)
+        print(f"Indexed {args.messages} messages in {time.perf_counter() - started:.1f}s")
+
+        rng = random.Random(args.seed)
+        cases = {
+            'user, common word': lambda: (vocabulary[rng.randint(0, 9)], rng.randint(1, args.users)),
+            'user, rare word': lambda: (rng.choice(vocabulary[1000:]), rng.randint(1, args.users)),
+            'user, two words': lambda: (' '.join(rng.sample(vocabulary[:200], 2)), rng.randint(1, args.users)),
+            'user, prefix': lambda: (vocabulary[rng.randint(0, 99)][:3], rng.randint(1, args.users)),
+            'moderator, rare word': lambda: (rng.choice(vocabulary[1000:]), None),
+            'moderator, two words': lambda: (' '.join(rng.sample(vocabulary[:200], 2)), None),
+        }
+        print(f"  {'query':<24}{'p50 ms':>10}{'p99 ms':>10}")
+        for name, make_query in cases.items():
+            samples = []
+            for _ in range(args.queries):
+                text, user_id = make_query()
+                query_started = time.perf_counter()
+                search(text, user_id)
+                samples.append(time.perf_counter() - query_started)
+            print(f"  {name:<24}{percentile(samples, 50) * 1000:>10.2f}{percentile(samples, 99) * 1000:>10.2f}")
+        close_pool()
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('rebuild', help='rebuild the search index from the messages table')
+    query = commands.add_parser('query', help='run one search')
+    query.add_argument('text')
+    query.add_argument('--user', type=int, help='only this user\'s chats (default: all, as a moderator)')
+    query.add_argument('--page', type=int, default=0)
+    bench = commands.add_parser('bench', help='query latency against a synthetic history in a temp database')
+    bench.add_argument('--messages', type=int, default=10000000)
+    bench.add_argument('--users', type=int, default=100000)
+    bench.add_argument('--queries', type=int, default=200, help='queries per case')
+    bench.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    if args.command == 'bench':
+        _bench(args)
+        return 0
+
+    from database import init_db
+    init_db()
+    if args.command == 'rebuild':
+        started = time.perf_counter()
+        rebuild_search_index()
+        print(f"Rebuilt the search index in {time.perf_counter() - started:.1f}s")
+    else:
+        results, has_more = search(args.text, args.user, args.page)
+        for result in results:
+            print(f"[session {result['session_id']} message {result['id']}] {result['snippet_html']}")
+        if has_more:
+            print(f"More: --page {args.page + 1}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
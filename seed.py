@@ -0,0 +1,265 @@
+"""Bulk-load synthetic users, chat sessions and messages.
+
+Rows go straight into the existing schema with executemany, a batch per
+transaction, for tuning indexes and matchmaking against realistic volume.
+The search index and dashboard rollup triggers are dropped during the load
+and rebuilt once at the end, so stop the app (or point CHAT_APP_DB at a
+copy) while seeding. Messages go to the shards CHAT_APP_MESSAGE_SHARDS
+routes them to, like the app's own. The same seed, options and --until on the same
+starting database always produce the same rows.
+
+    python seed.py --users 1000000 --sessions 2000000 --messages-per-session 20
+    python seed.py --users 50000 --gender Male=45,Female=45,Other=10 --online 0.2
+"""
+import random
+import sys
+import time
+from datetime import datetime
+
+from database import (
+    close_pool,
+    connection,
+    get_max_message_id,
+    get_message_shards,
+    hash_password,
+    init_db,
+    shard_for_session,
+    transaction,
+)
+from interests import INTERESTS
+from matchmaking import target_buckets
+from migrations import drop_derived_triggers, raise_message_sequence, rebuild_derived_data
+from search import zipf_vocabulary
+
+GENDERS = "Male=48,Female=48,Other=4"
+PREFERENCES = "Straight=70,Gay=10,Lesbian=8,Bisexual=12"
+# Rows per executemany / transaction
+SEED_BATCH = 100000
+# Distinct sentences messages are drawn from
+SENTENCES = 20000
+
+# "Male=48,Female=52" -> {'Male': 48.0, 'Female': 52.0}
+def parse_weights(text):
+    weights = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        weights[name.strip()] = float(weight)
+    return weights
+
+# Chance of each interest: --interest-rate, overridden per interest by --interests
+def _interest_rates(args):
+    rates = dict.fromkeys(INTERESTS, args.interest_rate)
+    if args.interests:
+        for interest, rate in parse_weights(args.interests).items():
+            if interest not in rates:
+                raise SystemExit(f"Unknown interest {interest!r} (one of {', '.join(INTERESTS)})")
+            rates[interest] = rate
+    return rates
+
+# Short sentences over search.zipf_vocabulary, so message text has common
+# and rare words like real chat
+def _sentences(rng, count):
+    vocabulary, cum_weights = zipf_vocabulary(rng)
+    return [' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(2, 12))) for _ in range(count)]
+
+def _insert_batches(rows, sql, batch_size):
+    for start in range(0, len(rows), batch_size):
+        with transaction() as conn:
+            conn.executemany(sql, rows[start:start + batch_size])
+
+SESSION_SQL = "INSERT INTO chat_sessions (id, user1_id, user2_id, start_time, end_time, active) VALUES (?, ?, ?, ?, ?, FALSE)"
+MESSAGE_SQL = "INSERT INTO messages (id, session_id, sender_id, message, timestamp, read) VALUES (?, ?, ?, ?, ?, TRUE)"
+
+# Insert sessions into the main database and their messages into the
+# databases holding them: the main one, or each message's shard along with
+# the participants the shard's search index needs
+def _insert_sessions(sessions, messages):
+    shards = get_message_shards()
+    with transaction() as conn:
+        conn.executemany(SESSION_SQL, sessions)
+        if not shards:
+            conn.executemany(MESSAGE_SQL, messages)
+            return
+
+    participants = {session[0]: session[:3] for session in sessions}
+    by_shard = {}
+    for message in messages:
+        by_shard.setdefault(shard_for_session(message[1], len(shards)), []).append(message)
+    for index, shard_messages in by_shard.items():
+        with shards[index].connection() as conn, conn:
+            conn.executemany("INSERT OR IGNORE INTO chat_sessions (id, user1_id, user2_id) VALUES (?, ?, ?)",
+                             [participants[session_id] for session_id in {message[1] for message in shard_messages}])
+            conn.executemany(MESSAGE_SQL, shard_messages)
+
+# Insert the users; returns {(gender, preference): [user ids]}
+def seed_users(rng, args, first_id):
+    genders = parse_weights(args.gender)
+    preferences = parse_weights(args.preference)
+    rates = list(_interest_rates(args).items())
+    password = hash_password(args.password)
+
+    buckets = {}
+    rows = []
+    for user_id in range(first_id, first_id + args.users):
+        gender = rng.choices(list(genders), list(genders.values()))[0]
+        preference = rng.choices(list(preferences), list(preferences.values()))[0]
+        interests = [interest for interest, rate in rates if rng.random() < rate]
+        mask = sum(1 << INTERESTS.index(interest) for interest in interests)
+        rows.append((user_id, f'{args.prefix}{user_id}', password, gender, preference,
+                     ','.join(interests), mask, rng.random() < args.online))
+        buckets.setdefault((gender, preference), []).append(user_id)
+    _insert_batches(rows, """
+        INSERT INTO users (id, username, password, gender, preference, interests, interests_mask, online)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, args.batch_size)
+    return buckets
+
+# Insert ended chat sessions between compatible seeded users, spread over the
+# last --days before --until, with their messages. Conversation lengths are
+# exponentially distributed around --messages-per-session.
+# Yields (sessions, messages) inserted per transaction.
+def seed_sessions(rng, args, buckets, first_session_id, first_message_id):
+    # For each bucket, the buckets its users can be matched with (skipping a
+    # lone user whose only possible partner would be themselves)
+    targets = {}
+    for bucket, ids in buckets.items():
+        compatible = [buckets[target] for target in sorted(target_buckets(*bucket)) if buckets.get(target)]
+        sizes = [len(target_ids) for target_ids in compatible]
+        if sum(sizes) > (1 if any(target_ids is ids for target_ids in compatible) else 0):
+            targets[bucket] = (compatible, sizes)
+    initiators = [bucket for bucket in buckets if bucket in targets]
+    if not initiators:
+        return
+    initiator_weights = [len(buckets[bucket]) for bucket in initiators]
+
+    sentences = _sentences(rng, SENTENCES)
+    until = args.until.timestamp()
+    window = args.days * 86400
+    message_id = first_message_id
+    sessions, messages = [], []
+    for session_id in range(first_session_id, first_session_id + args.sessions):
+        bucket = rng.choices(initiators, initiator_weights)[0]
+        user1 = rng.choice(buckets[bucket])
+        compatible, sizes = targets[bucket]
+        user2 = user1
+        while user2 == user1:
+            user2 = rng.choice(rng.choices(compatible, sizes)[0])
+
+        started = until - rng.random() * window
+        sent = started
+        for _ in range(round(rng.expovariate(1 / args.messages_per_session))):
+            sent += rng.expovariate(1 / args.message_gap)
+            messages.append((message_id, session_id, user1 if rng.random() < 0.5 else user2, rng.choice(sentences),
+                             time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(sent))))
+            message_id += 1
+        ended = sent + rng.expovariate(1 / args.message_gap)
+        sessions.append((session_id, user1, user2, datetime.fromtimestamp(started).isoformat(' '),
+                         datetime.fromtimestamp(ended).isoformat(' ')))
+
+        if len(messages) >= args.batch_size:
+            _insert_sessions(sessions, messages)
+            yield len(sessions), len(messages)
+            sessions, messages = [], []
+    if sessions:
+        _insert_sessions(sessions, messages)
+        yield len(sessions), len(messages)
+
+def _next_id(table):
+    with connection() as conn:
+        return conn.execute(f"""
+            SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = '{table}'), 0),
+                       COALESCE((SELECT MAX(id) FROM {table}), 0)) + 1
+        """).fetchone()[0]
+
+# rebuild_derived_data counts the messages of ended sessions per shared
+# interest from the main messages table; add the ones the shards hold
+def _count_shard_messages(conn, shards):
+    conn.execute("CREATE TEMP TABLE shard_message_counts (session_id INTEGER PRIMARY KEY, messages INTEGER)")
+    for shard in shards:
+        with shard.connection() as shard_conn:
+            conn.executemany("INSERT INTO shard_message_counts (session_id, messages) VALUES (?, ?)",
+                             shard_conn.execute("SELECT session_id, COUNT(*) FROM messages GROUP BY session_id"))
+    conn.execute("""
+        WITH shared AS (
+            SELECT u1.interests_mask & u2.interests_mask AS mask, SUM(counts.messages) AS messages
+            FROM shard_message_counts counts
+            JOIN chat_sessions s ON s.id = counts.session_id
+            JOIN users u1 ON u1.id = s.user1_id
+            JOIN users u2 ON u2.id = s.user2_id
+            WHERE NOT s.active AND s.end_time IS NOT NULL
+            GROUP BY 1)
+        UPDATE stats_interest
+        SET messages = messages + COALESCE((SELECT SUM(messages) FROM shared WHERE mask >> stats_interest.bit & 1), 0)
+    """)
+    conn.execute("DROP TABLE temp.shard_message_counts")
+
+def seed(args):
+    init_db()
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+
+    shards = get_message_shards()
+    with connection() as conn:
+        drop_derived_triggers(conn)
+    for shard in shards:
+        with shard.connection() as conn:
+            drop_derived_triggers(conn)
+    try:
+        buckets = seed_users(rng, args, _next_id('users'))
+        print(f"{args.users} users in {time.perf_counter() - started:.1f}s")
+
+        total_sessions = total_messages = 0
+        for sessions, messages in seed_sessions(rng, args, buckets, _next_id('chat_sessions'),
+                                                  get_max_message_id() + 1):
+            total_sessions += sessions
+            total_messages += messages
+            print(f"\r{total_sessions} sessions, {total_messages} messages "
+                  f"in {time.perf_counter() - started:.1f}s", end='', flush=True)
+        print()
+        loaded = time.perf_counter() - started
+    finally:
+        rebuilding = time.perf_counter()
+        # Seeded ids are spread over the shards without regard to the ids
+        # each one hands out (see insert_message), so lift every floor
+        highest = get_max_message_id()
+        for shard in shards:
+            with shard.connection() as conn, conn:
+                rebuild_derived_data(conn, shard=True)
+                raise_message_sequence(conn, highest)
+        with transaction() as conn:
+            rebuild_derived_data(conn)
+            _count_shard_messages(conn, shards)
+            raise_message_sequence(conn, highest)
+        print(f"Rebuilt the search index and rollups in {time.perf_counter() - rebuilding:.1f}s")
+
+    rows = args.users + total_sessions + total_messages
+    print(f"Loaded {rows} rows in {loaded:.1f}s ({rows / loaded * 60 / 1e6:.2f}M rows/min), "
+          f"{time.perf_counter() - started:.1f}s in total")
+    close_pool()
+    return rows
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--sessions', type=int, default=200000, help='chat sessions (all ended)')
+    parser.add_argument('--messages-per-session', type=float, default=20, help='mean conversation length')
+    parser.add_argument('--message-gap', type=float, default=15, help='mean seconds between messages')
+    parser.add_argument('--gender', default=GENDERS, help='gender weights')
+    parser.add_argument('--preference', default=PREFERENCES, help='preference weights')
+    parser.add_argument('--interest-rate', type=float, default=0.3, help='chance a user has any one interest')
+    parser.add_argument('--interests', help='per-interest chances, e.g. Music=0.6,Gaming=0.1')
+    parser.add_argument('--online', type=float, default=0.05, help='share of users marked online')
+    parser.add_argument('--days', type=float, default=30, help='days of history the sessions are spread over')
+    parser.add_argument('--until', type=datetime.fromisoformat, default=datetime.now(),
+                        help='end of the history (default: now; fix it for reproducible rows)')
+    parser.add_argument('--password', default='password', help='password of every seeded user')
+    parser.add_argument('--prefix', default='seed', help='username prefix (usernames are <prefix><id>)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=SEED_BATCH, help='rows per transaction')
+    seed(parser.parse_args(argv))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
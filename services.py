@@ -0,0 +1,17 @@
+import streamlit as st
+
+from archive import start_archiving
+from database import init_db
+from matchmaking import get_matchmaker
+from presence import get_presence
+
+# Process-wide setup: migrations, the matchmaking pool, presence tracking and
+# the archiver. Cached as a resource, so it runs once per server process
+# instead of on every script run; returns (matchmaker, presence).
+@st.cache_resource(show_spinner=False)
+def start_services():
+    init_db()
+    matchmaker = get_matchmaker()
+    presence = get_presence()
+    start_archiving()
+    return matchmaker, presence
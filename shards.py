@@ -0,0 +1,241 @@
+"""Move chat messages between the main database and message shards.
+
+CHAT_APP_MESSAGE_SHARDS (see database.py) sets how many SQLite files hold
+chat messages, routed by a hash of the chat session id; 0 keeps them in the
+main database. The app refuses to start when the setting doesn't match where
+the existing messages are, so after changing it, stop the app and run:
+
+    python shards.py rebalance                # to CHAT_APP_MESSAGE_SHARDS
+    python shards.py rebalance --shards 4     # import into / reshape to 4 shards
+    python shards.py rebalance --shards 0     # back into the main database
+
+Every message is copied to its new home before it is deleted from the old
+one, so an interrupted run can simply be repeated. The write throughput of
+different shard counts can be compared with:
+
+    python shards.py bench --shards 0,1,2,4,8 --processes 4
+"""
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from database import (
+    BUSY_TIMEOUT_MS,
+    _max_message_id,
+    get_db_path,
+    get_message_shard_count,
+    get_message_shard_path,
+    shard_for_session,
+)
+from migrations import (
+    MIGRATIONS,
+    SHARD_MIGRATIONS,
+    drop_derived_triggers,
+    migrate,
+    raise_message_sequence,
+    restore_derived_triggers,
+)
+
+# Messages moved per transaction
+REBALANCE_BATCH = 10000
+
+def _open(path, shard):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    migrate(conn, SHARD_MIGRATIONS if shard else MIGRATIONS)
+    return conn
+
+def _recorded_shards(main):
+    row = main.execute("SELECT value FROM app_settings WHERE key = 'message_shards'").fetchone()
+    return int(row[0]) if row else 0
+
+# Copy one source database's misplaced messages to where `shards` says they
+# belong, then delete them from the source. Returns the number moved.
+def _move_messages(source, main, targets, shards, batch_size):
+    moved = 0
+    after_id = 0
+    while True:
+        rows = source.execute("""
+            SELECT id, session_id, sender_id, message, timestamp, read
+            FROM messages WHERE id > ? ORDER BY id LIMIT ?
+        """, (after_id, batch_size)).fetchall()
+        if not rows:
+            return moved
+        after_id = rows[-1][0]
+
+        by_target = {}
+        for row in rows:
+            target = targets[shard_for_session(row[1], shards) if shards else 0]
+            if target is not source:
+                by_target.setdefault(target, []).append(row)
+        for target, target_rows in by_target.items():
+            with target:
+                if target is not main:
+                    session_ids = json.dumps(sorted({row[1] for row in target_rows}))
+                    target.executemany(
+                        "INSERT OR IGNORE INTO chat_sessions (id, user1_id, user2_id) VALUES (?, ?, ?)",
+                        main.execute("SELECT id, user1_id, user2_id FROM chat_sessions "
+                                     "WHERE id IN (SELECT value FROM json_each(?))", (session_ids,)).fetchall())
+                target.executemany("""
+                    INSERT OR IGNORE INTO messages (id, session_id, sender_id, message, timestamp, read)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, target_rows)
+            with source:
+                source.execute("DELETE FROM messages WHERE id IN (SELECT value FROM json_each(?))",
+                               (json.dumps([row[0] for row in target_rows]),))
+            moved += len(target_rows)
+
+# The dashboard only reads the shards in use, so fold the per-minute message
+# counts of a shard that is going away into the main database's
+def _merge_rollups(shard, main):
+    counts = shard.execute("SELECT minute, messages FROM stats_minutely WHERE messages > 0").fetchall()
+    with main:
+        main.executemany("""
+            INSERT INTO stats_minutely (minute, messages) VALUES (?, ?)
+            ON CONFLICT (minute) DO UPDATE SET messages = messages + excluded.messages
+        """, counts)
+    with shard:
+        shard.execute("DELETE FROM stats_minutely")
+
+# Move every message to the database the given shard count routes it to.
+# Returns the number of messages moved.
+def rebalance(shards, batch_size=REBALANCE_BATCH):
+    db_path = get_db_path()
+    main = _open(db_path, shard=False)
+    recorded = _recorded_shards(main)
+    shard_conns = [_open(get_message_shard_path(i, db_path), shard=True) for i in range(max(recorded, shards))]
+    databases = [main] + shard_conns
+    targets = shard_conns[:shards] if shards else [main]
+    try:
+        # Derived data is rebuilt once at the end instead of row by row;
+        # rollups stay where they were counted (the dashboard adds them up)
+        # unless that database stops being read
+        for conn in databases:
+            with conn:
+                drop_derived_triggers(conn)
+
+        moved = sum(_move_messages(source, main, targets, shards, batch_size) for source in databases)
+        for conn in shard_conns[shards:]:
+            _merge_rollups(conn, main)
+
+        # Ids handed out from now on start above every id that exists anywhere
+        highest = max(_max_message_id(conn) for conn in databases)
+        for conn in databases:
+            with conn:
+                raise_message_sequence(conn, highest)
+                if conn is not main:
+                    conn.execute("DELETE FROM chat_sessions WHERE id NOT IN (SELECT session_id FROM messages)")
+    finally:
+        for conn in databases:
+            with conn:
+                restore_derived_triggers(conn, shard=conn is not main)
+
+    with main:
+        main.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('message_shards', ?)", (str(shards),))
+    for conn in databases:
+        conn.close()
+    return moved
+
+# Benchmark worker (a separate process; the environment picks the database
+# and shard count). `threads` senders each queue their share of `messages`
+# into random sessions the way the memory and Redis message buses do (ids
+# assigned up front, one insert_messages call per message, written behind);
+# returns once everything is committed, with the writers' lock waits and
+# failed writes.
+def _send_messages(messages, threads, sessions, process, start_at):
+    import random
+    import threading
+
+    import database
+
+    database.init_db()
+    first_id = process * messages * 10 + 1
+
+    def sender(index):
+        rng = random.Random(process * 1000 + index)
+        for message_id in range(first_id + index, first_id + messages, threads):
+            session_id = rng.randint(1, sessions)
+            database.insert_messages([(message_id, session_id, session_id * 2, f'message {message_id}',
+                                       time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()))])
+
+    workers = [threading.Thread(target=sender, args=(i,)) for i in range(threads)]
+    time.sleep(max(0, start_at - time.time()))
+    started = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    database.flush_writes()
+    finished = time.time()
+    writers = [database.get_writer()] + [shard.writer for shard in database.get_message_shards()]
+    lock_wait = sum(writer.stats['lock_wait'] for writer in writers)
+    failed = sum(writer.stats['failed'] for writer in writers)
+    database.close_pool()
+    return started, finished, lock_wait, failed
+
+# Messages per second sent by `processes` processes into a fresh database
+# with the given shard count, seconds the writers spent waiting for write
+# locks, and writes that failed (lock timeouts)
+def measure_throughput(shards, messages, processes, threads, sessions):
+    import multiprocessing
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+
+    import database
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['CHAT_APP_DB'] = os.path.join(tmp, 'shard_bench.db')
+        os.environ['CHAT_APP_MESSAGE_SHARDS'] = str(shards)
+        database.init_db()
+        database.start_chat_sessions([(2 * i + 1, 2 * i + 2) for i in range(sessions)])
+        database.close_pool()
+
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+            # Start everyone together once the workers have imported and
+            # opened their databases
+            start_at = time.time() + 2
+            futures = [pool.submit(_send_messages, messages // processes + (p < messages % processes), threads,
+                                   sessions, p, start_at) for p in range(processes)]
+            results = [future.result() for future in futures]
+    elapsed = max(result[1] for result in results) - min(result[0] for result in results)
+    return messages / elapsed, sum(result[2] for result in results), sum(result[3] for result in results)
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    move = commands.add_parser('rebalance', help='move messages to match a shard count')
+    move.add_argument('--shards', type=int, default=get_message_shard_count(),
+                      help='target shard count (default: CHAT_APP_MESSAGE_SHARDS; 0 = main database)')
+    move.add_argument('--batch-size', type=int, default=REBALANCE_BATCH, help='messages moved per transaction')
+    bench = commands.add_parser('bench', help='message write throughput per shard count, on temp databases')
+    bench.add_argument('--shards', default='0,1,2,4,8', help='comma-separated shard counts to compare')
+    bench.add_argument('--messages', type=int, default=200000, help='messages sent per run')
+    bench.add_argument('--processes', type=int, default=4, help='sending processes (like app server processes)')
+    bench.add_argument('--threads', type=int, default=4, help='concurrent senders per process')
+    bench.add_argument('--sessions', type=int, default=1000, help='chat sessions the messages are spread over')
+    args = parser.parse_args(argv)
+
+    if args.command == 'rebalance':
+        started = time.perf_counter()
+        moved = rebalance(args.shards, args.batch_size)
+        layout = f"{args.shards} shard(s)" if args.shards else "the main database"
+        print(f"Moved {moved} messages in {time.perf_counter() - started:.1f}s; messages are now in {layout}")
+        return 0
+
+    print(f"{args.messages} messages from {args.processes} processes x {args.threads} senders")
+    print(f"  {'shards':>6}{'msg/s':>10}{'speedup':>9}{'lock wait s':>13}{'failed':>8}")
+    baseline = None
+    for shards in (int(count) for count in args.shards.split(',')):
+        throughput, lock_wait, failed = measure_throughput(shards, args.messages, args.processes, args.threads,
+                                                           args.sessions)
+        baseline = baseline or throughput
+        print(f"  {shards:>6}{throughput:>10.0f}{throughput / baseline:>8.2f}x{lock_wait:>13.1f}{failed:>8}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,44 @@
+# Page CSS, sent with every script run (Streamlit rebuilds the page each
+# run, so it has to be re-emitted); whitespace is squeezed out once at import
+_CSS = """
+    .main {
+        background-color: #f8f9fa;
+    }
+    .stButton>button {
+        width: 100%;
+        background-color: #4CAF50;
+        color: white;
+    }
+    .chat-container {
+        background-color: #f0f2f6;
+        border-radius: 10px;
+        padding: 20px;
+        height: 500px;
+        overflow-y: scroll;
+    }
+    .message {
+        padding: 10px;
+        border-radius: 10px;
+        margin-bottom: 10px;
+    }
+    .user-message {
+        background-color: #dcf8c6;
+        margin-left: 20%;
+    }
+    .partner-message {
+        background-color: #ffffff;
+        margin-right: 20%;
+    }
+    .waiting {
+        text-align: center;
+        padding: 40px;
+    }
+    /* Auto-refresh styling */
+    .stAlert {
+        padding: 10px;
+        border-radius: 5px;
+        margin-bottom: 10px;
+    }
+"""
+
+APP_CSS = '<style>' + ''.join(line.strip() for line in _CSS.splitlines() if not line.strip().startswith('/*')) + '</style>'
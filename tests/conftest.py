@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Every test gets its own database file. Queued writes are flushed before the
+# test ends, or they would land in the next test's database.
+@pytest.fixture(autouse=True)
+def database_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'chat.db')
+    monkeypatch.setenv('CHAT_APP_DB', path)
+    yield path
+    if 'database' in sys.modules:
+        sys.modules['database'].flush_writes()
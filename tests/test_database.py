@@ -0,0 +1,39 @@
+from datetime import datetime
+
+import database
+
+def test_ended_session_counts_messages_still_queued_on_its_shard(monkeypatch):
+    monkeypatch.setenv('CHAT_APP_MESSAGE_SHARDS', '2')
+    database.init_db()
+    for username in ('alice', 'bob'):
+        assert database.register_user(username, 'pw', 'Female', 'Any', ['Music'])
+    alice, bob = (database.authenticate_user(username, 'pw') for username in ('alice', 'bob'))
+    session_id = database.start_chat_session(alice['id'], bob['id'])
+
+    database.insert_messages([(i, session_id, alice['id'], 'hi', datetime.now()) for i in range(1, 201)])
+    database.end_chat_session(session_id)
+    database.flush_writes()
+
+    assert [messages for bit, sessions, messages in database.get_interest_stats() if sessions] == [200]
+
+def test_shared_pool_round_skips_users_without_a_recent_heartbeat():
+    import time
+
+    from matchmaking import SqliteMatchmaker
+
+    database.init_db()
+    users = [{'id': i, 'username': f'u{i}', 'gender': gender, 'preference': 'Straight',
+              'interests': ['Music'], 'interests_mask': None}
+             for i, gender in [(1, 'Male'), (2, 'Male'), (3, 'Female')]]
+    now = time.time()
+    database.touch_presence(users[0], now - 60)  # page closed a minute ago
+    database.touch_presence(users[1], now)
+    database.touch_presence(users[2], now)
+    matchmaker = SqliteMatchmaker(round_interval=1)
+    matchmaker.waiting_ttl = 10
+    for user in users:
+        matchmaker.request_match(user)
+
+    assert matchmaker.run_round() == 1
+    assert matchmaker.poll(1).status == 'waiting'
+    assert matchmaker.poll(3).partner['id'] == 2
@@ -0,0 +1,68 @@
+import time
+
+import pytest
+
+import database
+import login_tokens
+
+@pytest.fixture
+def user(monkeypatch):
+    monkeypatch.setenv('CHAT_APP_SECRET', 'test-secret')
+    monkeypatch.setattr(login_tokens, '_secret', None)
+    monkeypatch.setattr(login_tokens, '_cache', login_tokens.TokenCache())
+    database.init_db()
+    assert database.register_user('alice', 'pw', 'Female', 'Any', ['Music'])
+    return database.authenticate_user('alice', 'pw')
+
+def test_issued_token_resolves(user):
+    token = login_tokens.issue_token(user)
+    assert login_tokens.resolve_token(token)['user']['id'] == user['id']
+
+def test_token_resolves_from_the_database_after_a_restart(user, monkeypatch):
+    token = login_tokens.issue_token(user)
+    database.flush_writes()
+    monkeypatch.setattr(login_tokens, '_cache', login_tokens.TokenCache())
+    assert login_tokens.resolve_token(token)['user']['id'] == user['id']
+
+def test_revoked_token_does_not_resolve(user):
+    token = login_tokens.issue_token(user)
+    login_tokens.revoke_token(token)
+    database.flush_writes()
+    assert login_tokens.resolve_token(token) is None
+
+@pytest.mark.parametrize('token', [
+    None,
+    '',
+    'garbage',
+    '1.2.3',
+    '1.2.3.4.5',
+    'a.b.c.d',
+    '1.2.3.é',
+    'é.2.3.4',
+    '1.2.3.\ud800',
+    f'1.{int(time.time()) + 3600}.nonce.' + 'A' * 43,
+])
+def test_malformed_token_does_not_resolve(user, token):
+    assert login_tokens.resolve_token(token) is None
+
+def test_tampered_token_does_not_resolve(user):
+    token = login_tokens.issue_token(user)
+    user_id, rest = token.split('.', 1)
+    assert login_tokens.resolve_token(f"{int(user_id) + 1}.{rest}") is None
+    assert login_tokens.resolve_token(token[:-1] + ('A' if token[-1] != 'A' else 'B')) is None
+
+def test_expired_token_does_not_resolve(user, monkeypatch):
+    monkeypatch.setattr(login_tokens, 'TOKEN_LIFETIME', -1)
+    token = login_tokens.issue_token(user)
+    assert login_tokens.resolve_token(token) is None
+
+def test_expired_tokens_are_purged(user, monkeypatch):
+    import archive
+    kept = login_tokens.issue_token(user)
+    monkeypatch.setattr(login_tokens, 'TOKEN_LIFETIME', -1)
+    login_tokens.issue_token(user)
+    database.flush_writes()
+    assert archive.purge_expired_tokens() == 1
+    assert archive.purge_expired_tokens() == 0
+    monkeypatch.setattr(login_tokens, '_cache', login_tokens.TokenCache())
+    assert login_tokens.resolve_token(kept)['user']['id'] == user['id']
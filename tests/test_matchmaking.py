@@ -0,0 +1,133 @@
+import random
+from itertools import product
+
+import pytest
+
+import database
+import matchmaking
+from interests import INTERESTS
+from matchmaking import MatchTicket, Matchmaker, pair_tickets, target_buckets
+
+GENDERS = ['Male', 'Female', 'Other']
+PREFERENCES = ['Straight', 'Gay', 'Lesbian', 'Bisexual']
+
+def _user(user_id, gender, preference, interests=()):
+    return {'id': user_id, 'username': f'u{user_id}', 'gender': gender, 'preference': preference,
+            'interests': list(interests), 'interests_mask': None}
+
+def _random_users(seed, count=300):
+    rng = random.Random(seed)
+    return [_user(user_id, rng.choice(GENDERS), rng.choice(PREFERENCES), rng.sample(INTERESTS, rng.randint(0, 5)))
+            for user_id in range(1, count + 1)]
+
+def _tickets(users):
+    tickets = [MatchTicket(user) for user in users]
+    for age, ticket in enumerate(tickets):
+        ticket.created_at = age
+    return tickets
+
+# Whether either user would get the other from find_match
+def _compatible(a, b):
+    return ((b['gender'], b['preference']) in target_buckets(a['gender'], a['preference'])
+            or (a['gender'], a['preference']) in target_buckets(b['gender'], b['preference']))
+
+def _check_pairs(users, pairs):
+    paired = [user['id'] for pair in pairs for user in pair]
+    assert len(paired) == len(set(paired)), "a user was paired twice"
+    for first, second in pairs:
+        assert _compatible(first, second), (first, second)
+    unpaired = [user for user in users if user['id'] not in set(paired)]
+    for i, a in enumerate(unpaired):
+        for b in unpaired[i + 1:]:
+            assert not _compatible(a, b), f"{a} and {b} were both left waiting"
+
+def test_target_buckets_match_find_match():
+    database.init_db()
+    users = {}
+    for gender, preference in product(GENDERS, PREFERENCES):
+        username = f'{gender}-{preference}'
+        assert database.register_user(username, 'pw', gender, preference, [])
+        users[gender, preference] = database.authenticate_user(username, 'pw')
+    database.flush_writes()
+
+    for bucket, user in users.items():
+        found = {match['id'] for match in database.find_matches(user, limit=len(users))}
+        expected = {other['id'] for other_bucket, other in users.items()
+                    if other_bucket != bucket and other_bucket in target_buckets(*bucket)}
+        assert found == expected, bucket
+
+@pytest.mark.parametrize('seed', range(5))
+def test_pair_tickets_pairs_once_compatibly_and_maximally(seed):
+    users = _random_users(seed)
+    pairs = pair_tickets(_tickets(users))
+    _check_pairs(users, [(first.user, second.user) for first, second in pairs])
+
+def test_pair_tickets_prefers_shared_interests_then_waiting_time():
+    users = [
+        _user(1, 'Male', 'Straight', ['Music', 'Art', 'Food']),
+        _user(2, 'Female', 'Straight', ['Sports']),
+        _user(3, 'Female', 'Straight', ['Music', 'Art']),
+        _user(4, 'Female', 'Straight', ['Music', 'Art']),
+    ]
+    pairs = pair_tickets(_tickets(users))
+    assert [(first.user['id'], second.user['id']) for first, second in pairs] == [(3, 1)]
+
+@pytest.mark.parametrize('seed', range(3))
+def test_run_round_matches_the_pool(seed):
+    database.init_db()
+    users = _random_users(seed, count=100)
+    matchmaker = Matchmaker(round_interval=1)
+    for user in users:
+        matchmaker.request_match(user)
+
+    matched = matchmaker.run_round()
+
+    tickets = {user['id']: matchmaker.poll(user['id']) for user in users}
+    pairs = {tuple(sorted((user_id, ticket.partner['id']))) for user_id, ticket in tickets.items() if ticket.matched}
+    assert len(pairs) == matched
+    users_by_id = {user['id']: user for user in users}
+    _check_pairs(users, [(users_by_id[a], users_by_id[b]) for a, b in pairs])
+    for a, b in pairs:
+        assert tickets[a].session_id == tickets[b].session_id
+        assert database.get_session_state(tickets[a].session_id)['user_ids'] in ((a, b), (b, a))
+    assert matchmaker.waiting_count() == len(users) - 2 * matched
+
+def test_user_who_cancels_after_the_snapshot_is_not_matched(monkeypatch):
+    database.init_db()
+    matchmaker = Matchmaker(round_interval=1)
+    for user in [_user(1, 'Male', 'Straight'), _user(2, 'Female', 'Straight'),
+                 _user(3, 'Male', 'Gay'), _user(4, 'Male', 'Gay')]:
+        matchmaker.request_match(user)
+
+    cancelled = []
+    def pair_then_cancel(tickets):
+        proposed = pair_tickets(tickets)
+        cancelled.append(proposed[0][0].user['id'])
+        matchmaker.cancel(cancelled[0])
+        return proposed
+    monkeypatch.setattr(matchmaking, 'pair_tickets', pair_then_cancel)
+
+    assert matchmaker.run_round() == 1
+    assert matchmaker.poll(cancelled[0]) is None
+    partner_id = {1: 2, 2: 1, 3: 4, 4: 3}[cancelled[0]]
+    assert matchmaker.poll(partner_id).status == 'waiting'
+    assert matchmaker.waiting_count() == 1
+
+def test_user_who_cancels_while_sessions_are_created_is_not_matched(monkeypatch):
+    database.init_db()
+    matchmaker = Matchmaker(round_interval=1)
+    matchmaker.request_match(_user(1, 'Male', 'Straight'))
+    matchmaker.request_match(_user(2, 'Female', 'Straight'))
+
+    start_chat_sessions = matchmaking.start_chat_sessions
+    def cancel_then_start(pairs):
+        matchmaker.cancel(1)
+        return start_chat_sessions(pairs)
+    monkeypatch.setattr(matchmaking, 'start_chat_sessions', cancel_then_start)
+
+    assert matchmaker.run_round() == 0
+    assert matchmaker.poll(1) is None
+    assert matchmaker.poll(2).status == 'waiting'
+    assert matchmaker.waiting_count() == 1
+    database.flush_writes()
+    assert database.get_active_chat(2) is None
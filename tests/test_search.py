@@ -0,0 +1,59 @@
+from datetime import datetime
+
+import pytest
+
+import archive
+import database
+from search import search
+
+@pytest.fixture(params=[0, 2], ids=['unsharded', 'sharded'])
+def chats(request, monkeypatch):
+    monkeypatch.setenv('CHAT_APP_MESSAGE_SHARDS', str(request.param))
+    database.init_db()
+    sessions = {}
+    for user1_id, user2_id, text in [(1, 2, 'pizza tonight'), (3, 4, 'pizza tomorrow'), (1, 5, 'pasta tonight')]:
+        session_id = database.start_chat_session(user1_id, user2_id)
+        database.insert_message(session_id, user1_id, text, datetime.now())
+        sessions[user1_id, user2_id] = session_id
+    return sessions
+
+def _found(text, user_id=None):
+    results, has_more = search(text, user_id)
+    return sorted((result['session_id'], result['snippet_html']) for result in results)
+
+def test_user_searches_only_their_own_chats(chats):
+    assert _found('pizza', 1) == [(chats[1, 2], '<mark>pizza</mark> tonight')]
+    assert _found('pizza', 4) == [(chats[3, 4], '<mark>pizza</mark> tomorrow')]
+    assert _found('pizza', 5) == []
+    assert _found('to', 1) == [(chats[1, 2], 'pizza <mark>tonight</mark>'),
+                               (chats[1, 5], 'pasta <mark>tonight</mark>')]
+    assert _found('pizza') == [(chats[1, 2], '<mark>pizza</mark> tonight'),
+                               (chats[3, 4], '<mark>pizza</mark> tomorrow')]
+
+def test_archived_chats_stay_searchable(chats):
+    database.end_chat_session(chats[1, 2])
+    database.flush_writes()
+    assert archive.archive_ended_sessions(older_than=0) == (1, 1)
+
+    assert _found('pizza', 1) == [(chats[1, 2], '<mark>pizza</mark> tonight')]
+    assert _found('pizza', 2) == [(chats[1, 2], '<mark>pizza</mark> tonight')]
+    assert _found('pizza', 3) == [(chats[3, 4], '<mark>pizza</mark> tomorrow')]
+    assert _found('to', 1) == [(chats[1, 2], 'pizza <mark>tonight</mark>'),
+                               (chats[1, 5], 'pasta <mark>tonight</mark>')]
+    assert len(_found('pizza')) == 2
+
+    assert archive.purge_archive(retention_days=-1) == 1
+    assert _found('pizza', 1) == []
+
+def test_search_pages_through_live_and_archived_matches(chats):
+    session_id = database.start_chat_session(1, 2)
+    for i in range(5):
+        database.insert_message(session_id, 1, f'pizza {i}', datetime.now())
+    database.end_chat_session(chats[1, 2])
+    database.flush_writes()
+    archive.archive_ended_sessions(older_than=0)
+
+    pages = [search('pizza', 1, page, page_size=4) for page in range(2)]
+    assert [len(results) for results, has_more in pages] == [4, 2]
+    assert [has_more for results, has_more in pages] == [True, False]
+    assert len({result['id'] for results, has_more in pages for result in results}) == 6
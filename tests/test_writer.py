@@ -0,0 +1,76 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+
+import writer
+from writer import WriteBehindWriter
+
+@pytest.fixture
+def connect(database_path):
+    setup = sqlite3.connect(database_path)
+    setup.execute("PRAGMA journal_mode = WAL")
+    setup.execute("CREATE TABLE items (name TEXT UNIQUE)")
+    setup.commit()
+    setup.close()
+
+    @contextmanager
+    def connection():
+        conn = sqlite3.connect(database_path, timeout=0.1, check_same_thread=False)
+        try:
+            yield conn
+        finally:
+            conn.close()
+    return connection
+
+def _insert(conn, name):
+    conn.execute("INSERT INTO items (name) VALUES (?)", (name,))
+    return name
+
+def _names(connect):
+    with connect() as conn:
+        return sorted(name for name, in conn.execute("SELECT name FROM items"))
+
+def test_failing_write_is_rolled_back_alone(connect):
+    w = WriteBehindWriter(connect, max_delay=0.2)
+    first = w.submit(_insert, 'a')
+    duplicate = w.submit(_insert, 'a')
+    second = w.submit(_insert, 'b')
+    w.flush()
+
+    assert first.result() == 'a' and second.result() == 'b'
+    with pytest.raises(sqlite3.IntegrityError):
+        duplicate.result()
+    assert _names(connect) == ['a', 'b']
+    assert w.stats['failed'] == 1 and w.stats['writes'] == 2 and w.stats['batches'] == 1
+    w.close()
+
+def test_locked_batch_is_retried(connect, monkeypatch):
+    monkeypatch.setattr(writer, 'RETRY_DELAY', 0.01)
+    with connect() as blocker:
+        blocker.execute("BEGIN IMMEDIATE")
+        w = WriteBehindWriter(connect)
+        future = w.submit(_insert, 'kept')
+        time.sleep(0.5)  # several busy timeouts
+        assert not future.done()
+        blocker.rollback()
+        assert future.result(timeout=5) == 'kept'
+
+    assert _names(connect) == ['kept']
+    assert w.stats['failed'] == 0 and w.stats['retries'] >= 2
+    assert w.stats['lock_wait'] >= 0.2  # the timed-out waits count too
+    w.close()
+
+def test_flush_from_the_writer_thread_does_not_block(connect):
+    w = WriteBehindWriter(connect)
+    flushed = threading.Event()
+
+    def flush_inside(conn):
+        w.flush()
+        flushed.set()
+
+    w.submit(flush_inside).result(timeout=5)
+    assert flushed.is_set()
+    w.close()
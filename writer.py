@@ -0,0 +1,165 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import is_enabled, registry
+
+logger = logging.getLogger(__name__)
+
+# Group commit tuning: a batch is committed once it holds this many writes,
+# or once the oldest write in it has waited this long
+BATCH_MAX_WRITES = 500
+BATCH_MAX_DELAY = 0.05  # seconds
+# Backoff between attempts at a batch that couldn't get the write lock
+# (another process held it past SQLite's busy timeout), doubling up to the max
+RETRY_DELAY = 0.05  # seconds
+RETRY_MAX_DELAY = 2.0
+
+# Marks a flush request in the queue
+_FLUSH = object()
+
+# Whether SQLite gave up waiting for a lock held by another connection
+def _is_busy(error):
+    code = getattr(error, 'sqlite_errorcode', 0) & 0xff
+    return code in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+
+# Background writer that commits queued writes in grouped transactions.
+# A write is a function taking a connection (plus arguments). Each runs in its
+# own savepoint so a failing write (e.g. a duplicate username) is rolled back
+# alone, while the rest of the batch shares one commit and one fsync.
+# submit() returns a Future that resolves after the batch has committed, so
+# callers that need durability can wait on it and everyone else moves on.
+# A batch that can't get the write lock is retried until it can: most writes
+# are never waited on, so failing them would lose them silently.
+class WriteBehindWriter:
+    def __init__(self, connection, max_writes=BATCH_MAX_WRITES, max_delay=BATCH_MAX_DELAY):
+        self._connection = connection
+        self.max_writes = max_writes
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._closed = False
+        # Counters for benchmarks: batches committed, writes applied, writes
+        # that failed, batch attempts retried because the database was locked,
+        # and seconds spent waiting for SQLite's write lock
+        self.stats = {'batches': 0, 'writes': 0, 'failed': 0, 'retries': 0, 'lock_wait': 0.0}
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+
+    # Queue a write; the returned Future holds its result once committed
+    def submit(self, write, *args):
+        if self._closed:
+            raise RuntimeError("writer is closed")
+        future = Future()
+        self._queue.put((future, write, args))
+        return future
+
+    # Block until everything submitted so far has been committed
+    def flush(self):
+        if threading.current_thread() is self._thread:
+            return
+        done = Future()
+        self._queue.put((done, _FLUSH, ()))
+        done.result()
+
+    # Commit what is queued and stop the thread
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_writes and batch[-1][1] is not _FLUSH:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)  # stop after this batch
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        results = []
+        writes = [item for item in batch if item[1] is not _FLUSH]
+        try:
+            if writes:
+                results = self._apply_retrying(writes)
+        except Exception as e:
+            logger.exception("Write batch of %d failed", len(writes))
+            results = [(future, None, e) for future, write, args in writes]
+
+        for future, result, error in results:
+            if error is not None:
+                self.stats['failed'] += 1
+                future.set_exception(error)
+            else:
+                self.stats['writes'] += 1
+                future.set_result(result)
+        for future, write, args in batch:
+            if write is _FLUSH:
+                future.set_result(None)
+
+    # _apply, again after a backoff for as long as the database is locked
+    def _apply_retrying(self, writes):
+        delay = RETRY_DELAY
+        while True:
+            try:
+                return self._apply(writes)
+            except sqlite3.OperationalError as e:
+                if not _is_busy(e):
+                    raise
+                self.stats['retries'] += 1
+                logger.warning("Write batch of %d couldn't get the write lock (%s); retrying in %.2fs",
+                               len(writes), e, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, RETRY_MAX_DELAY)
+
+    # Run the writes in one transaction, one savepoint each. Errors raised by
+    # a write only fail that write; errors taking the lock or committing
+    # fail the batch.
+    def _apply(self, writes):
+        results = []
+        with self._connection() as conn:
+            started = time.perf_counter()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+            finally:
+                self.stats['lock_wait'] += time.perf_counter() - started
+            try:
+                for future, write, args in writes:
+                    conn.execute("SAVEPOINT write")
+                    try:
+                        result = write(conn, *args)
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO write")
+                        results.append((future, None, e))
+                    else:
+                        results.append((future, result, None))
+                    conn.execute("RELEASE write")
+                conn.commit()
+                self.stats['batches'] += 1
+                if is_enabled():
+                    registry.observe('db', 'write_batch', time.perf_counter() - started)
+            except Exception:
+                conn.rollback()
+                raise
+        return results